@@ -0,0 +1,298 @@
+"""
+Asynchronous (ASGI) entry point of the SuPerTreat API.
+
+The prediction routes are served by coroutines that query MongoDB through the
+non-blocking motor driver, or read the in-memory trajectory store when it has
+been preloaded, so many concurrent requests share one event loop instead of
+holding a thread each. Every other path (Swagger UI, apispec, monitoring) is
+delegated to the Flask application, so the API and its documentation in
+models.yml stay the same.
+
+Run with, e.g.:
+
+    SUPERTREAT_PRELOAD=1 uvicorn asgi:app --port 8001 --workers 4
+"""
+import json
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from motor.motor_asyncio import AsyncIOMotorClient
+from werkzeug.datastructures import Accept, MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import supertreat_api
+from compact_storage import COMPACT_PROJECTION, GRID_COLLECTION, GRID_FIELD, compact_collection_name, decode_documents
+from model_data import request_model_data
+from metrics import count_cache, count_documents, count_trajectories, finish_request, start_request, timed
+from response_cache import MISSING
+from response_compression import compress, negotiate_encoding
+from serializers import JSON_MIMETYPE, MAX_PRECISION, encode, negotiate, round_columns, to_json
+from supertreat_api import (HAZARD_RATIO_PROJECTION, RESTRICTED_MEAN_PROJECTION, configure_app, current_model_data,
+                            get_hazard_ratio_summary, get_patient_trajectory, get_restricted_mean_summary,
+                            in_memory_trajectories, mongo_client_options, request_validators, response_cache,
+                            scenario_queries, signature_model)
+from trajectory_store import TRAJECTORY_PROJECTION, make_key
+
+# The Flask routes keep using the synchronous driver
+flask_app = WsgiToAsgi(configure_app())
+
+# Created on first use, inside the event loop of the server
+motor_db = None
+
+# Scenario endpoints answering any error with {'error': ...} and status 400, as in supertreat_api
+tolerant_endpoints = {"base_model", "hpv_negative"}
+
+
+def get_motor_db():
+    global motor_db
+    if motor_db is None:
+        config = supertreat_api.app.config
+        motor_db = AsyncIOMotorClient(config['MONGO_URI'], **mongo_client_options(config))[config['MONGO_DATABASE']]
+    return motor_db
+
+
+async def fetch_trajectory(model_name, query):
+    """
+    Asynchronous counterpart of supertreat_api.fetch_trajectory.
+    """
+    data = current_model_data()
+    cache_key = (data.version, model_name, make_key(query))
+    result = response_cache.get(cache_key)
+    if result is not MISSING:
+        count_cache("response", 1, 0)
+        return result
+    count_cache("response", 0, 1)
+
+    in_memory = in_memory_trajectories(model_name, [query])
+    if in_memory is not None:
+        result = in_memory[0]
+    elif supertreat_api.app.config['COMPACT_STORAGE']:
+        result = await compact_trajectory(model_name, query)
+    else:
+        # The cursor is drained by motor, so its iteration is part of the query phase
+        with timed("query"):
+            single_patient_records = await get_motor_db()[data.collection_name(model_name)].find(
+                query, TRAJECTORY_PROJECTION).to_list(length=None)
+        count_documents(len(single_patient_records))
+        with timed("cursor"):
+            result = get_patient_trajectory(single_patient_records)
+    count_trajectories([result])
+
+    response_cache.set(cache_key, result)
+
+    return result
+
+
+async def compact_trajectory(model_name, query):
+    """
+    Asynchronous counterpart of supertreat_api.compact_trajectories for a single query, sharing its time grids.
+    """
+    data = current_model_data()
+    with timed("query"):
+        documents = await get_motor_db()[data.collection_name(compact_collection_name(model_name))].find(
+            query, COMPACT_PROJECTION).to_list(length=None)
+    count_documents(len(documents))
+
+    grids = {}
+    for migration in {document.get(GRID_FIELD) for document in documents}:
+        grids[migration] = data.time_grids.get((model_name, migration))
+        if grids[migration] is None:
+            document = await get_motor_db()[data.collection_name(GRID_COLLECTION)].find_one(
+                {"model": model_name, GRID_FIELD: migration}, {"_id": 0, "time": 1})
+            grids[migration] = list(document["time"]) if document else []
+            # No grid yet means the model has not been converted, so it is not cached
+            if grids[migration]:
+                data.time_grids[(model_name, migration)] = grids[migration]
+
+    return decode_documents(documents, [query], grids)[0]
+
+
+async def scenario_endpoint(endpoint, request_data):
+    try:
+        model_name, query = scenario_queries[endpoint](request_data)
+    except ValueError as e:
+        # /base_model reports every error as JSON, see the generic handler in app
+        if endpoint == "base_model":
+            raise
+        return 400, str(e)
+
+    result = await fetch_trajectory(model_name, query)
+
+    return 200, result
+
+
+async def hazard_ratios(request_data):
+    try:
+        with timed("validation"):
+            request_validators['hazard_ratios'].validate(request_data)
+        model_name = signature_model(request_data)
+    except ValueError as e:
+        return 400, str(e)
+
+    data = current_model_data()
+    hazard_ratio_cache = data.hazard_ratios
+    if model_name in hazard_ratio_cache:
+        return 200, hazard_ratio_cache[model_name]
+
+    if data.snapshot is not None:
+        return 200, supertreat_api.get_hazard_ratios(model_name)
+
+    with timed("query"):
+        hazard_ratio_data = await get_motor_db()[data.collection_name("hazard_ratios")].find(
+            {"model": model_name}, HAZARD_RATIO_PROJECTION).to_list(length=None)
+    count_documents(len(hazard_ratio_data))
+    response = get_hazard_ratio_summary(hazard_ratio_data)
+    if response["hazard_ratio"]:
+        hazard_ratio_cache[model_name] = response
+
+    return 200, response
+
+
+async def restricted_mean(request_data):
+    try:
+        with timed("validation"):
+            request_validators['restricted_mean'].validate(request_data)
+        model_name = signature_model(request_data)
+    except ValueError as e:
+        return 400, str(e)
+
+    data = current_model_data()
+    if data.snapshot is not None:
+        return 200, supertreat_api.get_restricted_mean(model_name)
+
+    cache_key = (data.version, "rmst", model_name)
+    response = response_cache.get(cache_key)
+    if response is MISSING:
+        with timed("query"):
+            restricted_mean_data = await get_motor_db()[data.collection_name("rmst")].find(
+                {"mod_name": model_name}, RESTRICTED_MEAN_PROJECTION).to_list(length=None)
+        count_documents(len(restricted_mean_data))
+        response = get_restricted_mean_summary(restricted_mean_data)
+        if response["rmst_diff"]:
+            response_cache.set(cache_key, response)
+
+    return 200, response
+
+
+async def read_body(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+def query_precision(query_string):
+    """
+    Parses the precision query parameter, see supertreat_api.request_precision.
+
+    Raises:
+        ValueError: If precision is not an integer between 1 and MAX_PRECISION.
+    """
+    precision = parse_qs(query_string.decode("latin-1")).get("precision", [""])[-1]
+    if precision == "":
+        return None
+    if not precision.isdigit() or not 1 <= int(precision) <= MAX_PRECISION:
+        raise ValueError("Bad request: precision must be an integer between 1 and " + str(MAX_PRECISION) + ".")
+    return int(precision)
+
+
+async def send_response(send, status, payload, accept="", timings=None, accept_encoding="", precision=None):
+    mimetype = negotiate(parse_accept_header(accept, MIMEAccept))
+    with timed("serialization"):
+        if isinstance(payload, str):
+            body, content_type = payload.encode(), "text/html; charset=utf-8"
+        elif mimetype == JSON_MIMETYPE:
+            body, content_type = to_json(round_columns(payload, precision)), mimetype
+        else:
+            body, content_type = encode(round_columns(payload, precision), mimetype), mimetype
+            if body is None:
+                status, content_type = 406, "text/html; charset=utf-8"
+                body = ("Not acceptable: " + mimetype + " is not available on this server.").encode()
+
+    # Same compression as the compress_response hook of the Flask app
+    config = supertreat_api.app.config
+    encoding = None
+    if status == 200 and config['COMPRESSION'] and len(body) >= config['COMPRESSION_MIN_SIZE']:
+        encoding = negotiate_encoding(parse_accept_header(accept_encoding, Accept), supertreat_api.content_encodings)
+    if encoding is not None:
+        with timed("compression"):
+            body = compress(body, encoding)
+
+    headers = [
+        (b"content-type", content_type.encode()),
+        (b"content-length", str(len(body)).encode()),
+        (b"vary", b"Accept, Accept-Encoding" if status == 200 and config['COMPRESSION'] else b"Accept"),
+        # Same headers as flask_cors.CORS(app) with its default settings
+        (b"access-control-allow-origin", b"*")
+    ]
+    if encoding is not None:
+        headers.append((b"content-encoding", encoding.encode()))
+
+    # Same metrics as the after_request hook of the Flask app
+    if timings is not None:
+        duration = finish_request(timings, status)
+        if supertreat_api.app.config['SERVER_TIMING']:
+            headers.append((b"server-timing", timings.server_timing(total=duration).encode()))
+
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def app(scope, receive, send):
+    """
+    ASGI application: asynchronous prediction routes, Flask for everything else.
+    """
+    endpoint = scope.get("path", "").strip("/")
+    is_async_route = endpoint in scenario_queries or endpoint in ("hazard_ratios", "restricted_mean")
+
+    if scope["type"] != "http" or scope["method"] != "POST" or not is_async_route:
+        await flask_app(scope, receive, send)
+        return
+
+    timings = start_request(endpoint)
+    # The request finishes on the model data served when it starts, as in supertreat_api.bind_model_data
+    supertreat_api.start_version_poller()
+    token = request_model_data.set(supertreat_api.model_data)
+    try:
+        await serve_prediction(scope, receive, send, endpoint, timings)
+    finally:
+        request_model_data.reset(token)
+
+
+async def serve_prediction(scope, receive, send, endpoint, timings):
+    try:
+        precision = query_precision(scope.get("query_string", b""))
+    except ValueError as e:
+        await send_response(send, 400, str(e), timings=timings)
+        return
+
+    try:
+        request_data = json.loads(await read_body(receive))
+    except ValueError:
+        await send_response(send, 400, "Bad request: invalid JSON body.", timings=timings)
+        return
+
+    try:
+        if endpoint == "hazard_ratios":
+            status, payload = await hazard_ratios(request_data)
+        elif endpoint == "restricted_mean":
+            status, payload = await restricted_mean(request_data)
+        else:
+            status, payload = await scenario_endpoint(endpoint, request_data)
+    except Exception as e:
+        if endpoint in tolerant_endpoints:
+            status, payload = 400, {'error': str(e)}
+        else:
+            supertreat_api.app.logger.exception("Exception on /%s [POST]", endpoint)
+            status, payload = 500, "Internal Server Error"
+
+    headers = dict(scope.get("headers", []))
+    await send_response(send, status, payload, headers.get(b"accept", b"").decode("latin-1"), timings,
+                        headers.get(b"accept-encoding", b"").decode("latin-1"), precision)
@@ -0,0 +1,481 @@
+"""
+Benchmarks of the SuPerTreat API against a local stand-in for MongoDB.
+
+A mongomock database is seeded with synthetic trajectories laid out as the real
+model collections (one document per time point, with the covariates of the
+model), for every model name select_model can produce, plus their hazard ratios
+and RMST. Every endpoint is then benchmarked through the Flask test client,
+sequentially and with concurrent clients, and the hot functions (model
+selection, trajectory extraction, serialization) are microbenchmarked.
+
+Usage:
+
+    python benchmark.py [--requests 200] [--concurrency 8] [--backend mongomock|compact|preload]
+                        [--output results.json] [--baseline previous.json]
+
+The results are written as JSON; with --baseline the change of every latency
+and throughput against a previous run is printed. mongomock scans the whole
+collection for each query, so the numbers compare versions of the API on the
+same machine rather than predict the latency of a production deployment.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Mapping, Optional, Sequence
+
+import numpy as np
+
+import supertreat_api
+from compact_storage import migrate_model
+from gene_signature_scores import signatures
+from model_registry import model_covariates, model_registry, select_model
+from response_compression import available_encodings, compress
+from serializers import ARROW_MIMETYPE, MSGPACK_MIMETYPE, encode, round_columns, to_json
+from supertreat_api import get_patient_trajectory, request_schemas, scenario_queries
+from trajectory_store import make_key
+from warmup import covariate_levels
+
+# Percentiles of the request latencies in the results
+PERCENTILES = (50, 90, 99)
+
+
+def synthetic_trajectory(rng: random.Random, time_points: int) -> Dict[str, List[float]]:
+    """
+    Draws a decreasing survival curve with its confidence band, one value per month.
+
+    Examples:
+        >>> trajectory = synthetic_trajectory(random.Random(0), 3)
+        >>> trajectory["time"], trajectory["survival_probability"][0]
+        ([0, 1, 2], 1.0)
+    """
+    hazard = rng.uniform(0.002, 0.03)
+    survival = np.exp(-hazard * np.arange(time_points))
+    width = rng.uniform(0.02, 0.1)
+
+    return {
+        "time": list(range(time_points)),
+        "survival_probability": survival.tolist(),
+        "ci_lower": np.clip(survival - width, 0.0, 1.0).tolist(),
+        "ci_upper": np.clip(survival + width, 0.0, 1.0).tolist()
+    }
+
+
+def random_payload(levels: Mapping[str, Sequence[object]], rng: random.Random) -> Dict[str, object]:
+    """
+    Draws a request body from the levels of each field, see warmup.covariate_levels.
+    """
+    payload = {field: rng.choice(list(values)) for field, values in levels.items()}
+    if payload.get("tumor_region") != "oropharynx":
+        payload["hpv_status"] = None
+    return payload
+
+
+def seed_database(database, patients_per_model: int = 20, time_points: int = 121,
+                  seed: int = 0) -> Dict[str, List[Dict[str, object]]]:
+    """
+    Fills a database with synthetic trajectories, hazard ratios and RMST for every model of the registry.
+
+    Args:
+        database: The database to fill, e.g. a mongomock database.
+        patients_per_model (int): The number of trajectories of each model.
+        time_points (int): The number of monthly time points of each trajectory.
+        seed (int): The seed of the random draws, so that runs are repeatable.
+
+    Returns:
+        Dict[str, List[Dict[str, object]]]: The request bodies of the seeded patients, keyed on endpoint.
+    """
+    rng = random.Random(seed)
+    payloads = {endpoint: [] for endpoint in model_registry.scenarios}
+
+    for model_name, model in model_registry.models.items():
+        endpoint = model.scenario.endpoint
+        levels = covariate_levels(model, request_schemas)
+        build_query = scenario_queries[endpoint]
+
+        documents = {}
+        for _ in range(patients_per_model):
+            payload = random_payload(levels, rng)
+            _, query = build_query(payload)
+            key = make_key(query)
+            if key in documents:
+                continue
+            trajectory = synthetic_trajectory(rng, time_points)
+            documents[key] = [
+                dict(query, **{field: values[position] for field, values in trajectory.items()})
+                for position in range(time_points)
+            ]
+            payloads[endpoint].append(payload)
+
+        database[model_name].insert_many([document for group in documents.values() for document in group])
+
+        if model.scenario.gene_signature is not None:
+            database["hazard_ratios"].insert_one({
+                "model": model_name, "HR": rng.uniform(0.5, 2.0), "HR_upper95": 2.5, "HR_lower95": 0.3,
+                "P_value": rng.uniform(0.0, 0.1), "comparison": "High / Low"
+            })
+            database["rmst"].insert_many([
+                {"mod_name": model_name, "RMST_diff": rng.uniform(-3.0, 3.0), "RMST_diff_upper": 4.0,
+                 "RMST_diff_lower": -4.0, "timepoint": timepoint, "comparison": "High / Low"}
+                for timepoint in (24, 60)
+            ])
+
+    return payloads
+
+
+def expression_csv(n_samples: int, seed: int = 0) -> bytes:
+    """
+    Builds a samples x genes expression matrix of the gs4 genes, as sent to /signature_scores.
+    """
+    rng = np.random.default_rng(seed)
+    genes = signatures["gs4"].genes
+    rows = [",".join(["sample"] + genes)]
+    for sample, values in enumerate(rng.normal(5.0, 2.0, size=(n_samples, len(genes)))):
+        rows.append(",".join(["s" + str(sample)] + ["%.4f" % value for value in values]))
+    return ("\n".join(rows) + "\n").encode()
+
+
+def endpoint_requests(payloads: Mapping[str, List[Dict[str, object]]], seed: int = 0) -> Dict[str, Callable]:
+    """
+    Builds a request factory for every endpoint, drawing the patients among the seeded ones.
+
+    Returns:
+        Dict[str, Callable]: Functions of (client, rng) sending one request and returning its response,
+            keyed on endpoint name.
+    """
+    signature_models = [model for model in model_registry.models.values() if model.scenario.gene_signature]
+    expression = expression_csv(1000, seed)
+
+    def scenario_request(endpoint):
+        return lambda client, rng: client.post("/" + endpoint, json=rng.choice(payloads[endpoint]))
+
+    def model_request(endpoint):
+        def send(client, rng):
+            model = rng.choice(signature_models)
+            return client.post("/" + endpoint, json={
+                "clinical_scenario": model.scenario.clinical_scenario, "outcome": model.outcome,
+                "gene_signature_type": model.gene_signature_type, "censoring_time": int(model.censoring_time)
+            })
+        return send
+
+    def batch(client, rng):
+        endpoint = rng.choice(list(payloads))
+        patients = [dict(rng.choice(payloads[endpoint]), endpoint=endpoint) for _ in range(20)]
+        return client.post("/batch", json={"patients": patients})
+
+    def cohort(client, rng):
+        patients = [rng.choice(payloads["base_model"]) for _ in range(50)]
+        return client.post("/cohort", json={"endpoint": "base_model", "patients": patients,
+                                            "counterfactuals": {"chemo_chemotherapy_treatment": ["yes", "no"]}})
+
+    def treatment_comparison(client, rng):
+        return client.post("/treatment_comparison", json=dict(rng.choice(payloads["base_model"]), endpoint="base_model"))
+
+    def report(client, rng):
+        # The fields of each scenario come from its own payloads, the outcomes and censoring times being enumerated
+        scenarios = {endpoint: rng.choice(payloads[endpoint]) for endpoint in payloads}
+        return client.post("/report", json={"patient": scenarios["base_model"], "scenarios": scenarios})
+
+    def signature_scores(client, rng):
+        response = client.post("/signature_scores?signature=gs4", data=expression, content_type="text/csv")
+        response.get_data()
+        return response
+
+    requests = {endpoint: scenario_request(endpoint) for endpoint in payloads}
+    requests.update({
+        "hazard_ratios": model_request("hazard_ratios"),
+        "restricted_mean": model_request("restricted_mean"),
+        "batch": batch,
+        "cohort": cohort,
+        "treatment_comparison": treatment_comparison,
+        "report": report,
+        "signature_scores": signature_scores
+    })
+    return requests
+
+
+def latency_summary(latencies: Sequence[float], elapsed: float, errors: int) -> Dict[str, object]:
+    """
+    Summarizes request latencies (in seconds) into throughput and percentiles in milliseconds.
+
+    Examples:
+        >>> latency_summary([0.001, 0.002, 0.003, 0.004], elapsed=0.01, errors=0)["latency_ms"]["p50"]
+        2.5
+    """
+    milliseconds = np.asarray(latencies) * 1000
+    summary = {"mean": round(float(milliseconds.mean()), 4), "max": round(float(milliseconds.max()), 4)}
+    for percentile in PERCENTILES:
+        summary["p" + str(percentile)] = round(float(np.percentile(milliseconds, percentile)), 4)
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "latency_ms": summary
+    }
+
+
+def run_endpoint(app, send: Callable, n_requests: int, concurrency: int = 1, seed: int = 0) -> Dict[str, object]:
+    """
+    Sends n_requests requests to an endpoint, spread over concurrent clients, each with its own thread.
+
+    Returns:
+        Dict[str, object]: The throughput and latency percentiles, see latency_summary.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client_loop(client_index, n_client_requests):
+        client = app.test_client()
+        rng = random.Random(seed * 1000 + client_index)
+        for _ in range(n_client_requests):
+            start = time.perf_counter()
+            response = send(client, rng)
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                if response.status_code >= 400:
+                    errors[0] += 1
+
+    # Warm-up request, so that lazy initializations are not measured
+    send(app.test_client(), random.Random(seed))
+
+    shares = [n_requests // concurrency + (1 if index < n_requests % concurrency else 0) for index in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(client_loop, index, share) for index, share in enumerate(shares) if share]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    return latency_summary(latencies, elapsed, errors[0])
+
+
+def microbenchmark(function: Callable[[], object], repeat: int = 5) -> Dict[str, object]:
+    """
+    Times a function with timeit, the number of calls per repetition being chosen to last about 0.2 s.
+
+    Returns:
+        Dict[str, object]: The calls per repetition and the best and median time per call in microseconds.
+    """
+    timer = timeit.Timer(function)
+    calls, _ = timer.autorange()
+    per_call = [total / calls * 1e6 for total in timer.repeat(repeat=repeat, number=calls)]
+
+    return {"calls": calls, "best_us": round(min(per_call), 3), "median_us": round(float(np.median(per_call)), 3)}
+
+
+def run_microbenchmarks(payloads: Mapping[str, List[Dict[str, object]]], time_points: int) -> Dict[str, object]:
+    """
+    Microbenchmarks model selection, request validation, trajectory extraction and serialization.
+    """
+    rng = random.Random(0)
+    trajectory = synthetic_trajectory(rng, time_points)
+    documents = [{field: values[position] for field, values in trajectory.items()} for position in range(time_points)]
+    payload = payloads["hpv_negative"][0]
+
+    benchmarks = {
+        "select_model": lambda: select_model("3", "dfs", "score", 24),
+        "model_registry.resolve": lambda: model_registry.resolve("3", "dfs", "score", 24),
+        "scenario_query[hpv_negative]": lambda: scenario_queries["hpv_negative"](payload),
+        "get_patient_trajectory[" + str(time_points) + "]": lambda: get_patient_trajectory(documents),
+        "json.dumps[trajectory]": lambda: json.dumps(trajectory),
+        "to_json[trajectory]": lambda: to_json(trajectory),
+        "to_json[trajectory, precision=4]": lambda: to_json(round_columns(trajectory, 4))
+    }
+    body = to_json(trajectory)
+    for encoding in available_encodings():
+        benchmarks["compress[" + encoding + "]"] = lambda encoding=encoding: compress(body, encoding)
+    with supertreat_api.app.app_context():
+        flask_json = supertreat_api.app.json
+        benchmarks["flask.json.dumps[trajectory]"] = lambda: flask_json.dumps(trajectory)
+        for mimetype in (ARROW_MIMETYPE, MSGPACK_MIMETYPE):
+            # The binary formats need their optional packages
+            if encode(trajectory, mimetype) is not None:
+                benchmarks["encode[" + mimetype + "]"] = lambda mimetype=mimetype: encode(trajectory, mimetype)
+
+        return {name: microbenchmark(function) for name, function in benchmarks.items()}
+
+
+class StandInCollection:
+    """
+    A mongomock collection safe for concurrent reads.
+
+    mongomock pops '_id' from the projection it is given while projecting, and the
+    endpoints share their projections (e.g. TRAJECTORY_PROJECTION) between threads,
+    so each query gets its own copy.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, filter=None, projection=None, *args, **kwargs):
+        return self.collection.find(filter, dict(projection) if projection is not None else None, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+class StandInDatabase:
+    """
+    A mongomock database returning StandInCollection collections.
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def __getitem__(self, collection_name):
+        return StandInCollection(self.database[collection_name])
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+
+class StandInClient:
+    """
+    A mongomock client returning StandInDatabase databases, used in place of the pooled client of the API.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getitem__(self, database_name):
+        return StandInDatabase(self.client[database_name])
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def use_mongomock(backend: str = "mongomock", patients_per_model: int = 20, time_points: int = 121,
+                  seed: int = 0) -> Dict[str, List[Dict[str, object]]]:
+    """
+    Points the API to a seeded mongomock database, see seed_database.
+
+    With the "compact" backend the model collections are converted to compact storage and
+    served from it, as with SUPERTREAT_COMPACT=1. With the "preload" backend the trajectories
+    are loaded into the in-memory store, as with SUPERTREAT_PRELOAD=1, and MongoDB only
+    serves hazard ratios and RMST.
+    """
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("The benchmarks need mongomock: pip install mongomock")
+
+    supertreat_api.mongo_client = StandInClient(mongomock.MongoClient())
+    supertreat_api.mongo_client_pid = os.getpid()
+    database = supertreat_api.get_db()
+    payloads = seed_database(database, patients_per_model, time_points, seed)
+
+    if backend == "compact":
+        for model_name in model_registry.models:
+            migrate_model(database, model_name, model_covariates(model_name))
+        supertreat_api.app.config['COMPACT_STORAGE'] = True
+    elif backend == "preload":
+        supertreat_api.preload_trajectories(database)
+
+    return payloads
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Mapping[str, object], baseline: Mapping[str, object]) -> List[str]:
+    """
+    Lists the change of the p50/p99 latencies and throughput of every endpoint against a previous run.
+
+    Examples:
+        >>> run = {"endpoints": {"base_model": {"sequential": {"throughput_rps": 110.0, "latency_ms": {"p50": 9.0, "p99": 12.0}}}}}
+        >>> old = {"endpoints": {"base_model": {"sequential": {"throughput_rps": 100.0, "latency_ms": {"p50": 10.0, "p99": 12.0}}}}}
+        >>> compare(run, old)
+        ['base_model sequential: p50 -10.0%, p99 +0.0%, throughput +10.0%']
+    """
+    lines = []
+    for endpoint, modes in results["endpoints"].items():
+        for mode, summary in modes.items():
+            previous = baseline.get("endpoints", {}).get(endpoint, {}).get(mode)
+            if previous is None:
+                continue
+            changes = []
+            for percentile in ("p50", "p99"):
+                changes.append(percentile + " " + relative_change(summary["latency_ms"][percentile],
+                                                                   previous["latency_ms"][percentile]))
+            changes.append("throughput " + relative_change(summary["throughput_rps"], previous["throughput_rps"]))
+            lines.append(endpoint + " " + mode + ": " + ", ".join(changes))
+    return lines
+
+
+def relative_change(value: float, previous: float) -> str:
+    return "%+.1f%%" % ((value - previous) / previous * 100) if previous else "n/a"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SuPerTreat API benchmarks against a local stand-in for MongoDB")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint and mode")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--backend", choices=["mongomock", "compact", "preload"], default="mongomock",
+                        help="serve the trajectories from mongomock, its compact collections, or from memory")
+    parser.add_argument("--patients", type=int, default=20, help="trajectories seeded per model")
+    parser.add_argument("--time-points", type=int, default=121, help="monthly time points per trajectory")
+    parser.add_argument("--cache", action="store_true", help="keep the response cache enabled")
+    parser.add_argument("--endpoints", nargs="+", help="endpoints to benchmark, all by default")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data and requests")
+    parser.add_argument("--output", help="file to write the JSON results to, stdout by default")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    app = supertreat_api.app
+    app.logger.disabled = True
+    if not args.cache:
+        supertreat_api.response_cache.maxsize = 0
+
+    payloads = use_mongomock(args.backend, args.patients, args.time_points, args.seed)
+    requests = endpoint_requests(payloads, args.seed)
+
+    results = {
+        "environment": {
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        },
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "endpoints": {},
+        "microbenchmarks": run_microbenchmarks(payloads, args.time_points)
+    }
+
+    for endpoint in args.endpoints or list(requests):
+        results["endpoints"][endpoint] = {
+            "sequential": run_endpoint(app, requests[endpoint], args.requests, 1, args.seed),
+            "concurrent": run_endpoint(app, requests[endpoint], args.requests, args.concurrency, args.seed)
+        }
+        print(endpoint + ": " + json.dumps(results["endpoints"][endpoint]["sequential"]["latency_ms"]), file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            for line in compare(results, json.load(baseline_file)):
+                print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
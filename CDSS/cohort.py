@@ -0,0 +1,217 @@
+"""
+Population survival curves over the case mix of a cohort.
+
+A cohort is a list of patients, given explicitly or expanded from a covariate
+distribution, with a weight each. Their trajectories are put on a shared time
+grid (survival curves being step functions) and aggregated in one vectorized
+pass: the weighted mean curve and pointwise weighted quantile bands.
+
+A trajectory is not extended past its last time point: beyond it (e.g. a 24-month
+model on the grid of a 60-month one) the patient is left out of the aggregates.
+"""
+import itertools
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def expand_distribution(patient: Mapping[str, object],
+                        distribution: Mapping[str, Mapping[str, float]]) -> Tuple[List[Dict[str, object]], List[float]]:
+    """
+    Expands a covariate distribution into weighted patients, assuming independent covariates.
+
+    Args:
+        patient (Mapping[str, object]): The fields shared by every patient.
+        distribution (Mapping[str, Mapping[str, float]]): The proportion of each level of
+            the varying fields, e.g. {"clinical_sex": {"male": 0.7, "female": 0.3}}.
+
+    Returns:
+        Tuple[List[Dict[str, object]], List[float]]: One patient per combination of levels
+            and its weight, the product of the proportions.
+
+    Raises:
+        ValueError: If a field has no levels, a proportion that is not a non-negative
+            number, or only zero proportions.
+
+    Examples:
+        >>> patients, weights = expand_distribution({"outcome": "os"}, {"clinical_sex": {"male": 0.7, "female": 0.3}})
+        >>> [patient["clinical_sex"] for patient in patients], weights
+        (['male', 'female'], [0.7, 0.3])
+    """
+    fields = list(distribution)
+    for field in fields:
+        try:
+            if any(isinstance(proportion, bool) for proportion in distribution[field].values()):
+                raise TypeError
+            proportions = [float(proportion) for proportion in distribution[field].values()]
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError("Bad request: the distribution must map each field to the proportion of its levels.")
+        if not proportions or min(proportions) < 0 or sum(proportions) <= 0:
+            raise ValueError("Bad request: the proportions of " + str(field) +
+                             " must be non-negative and not all zero.")
+
+    patients, weights = [], []
+
+    for levels in itertools.product(*(distribution[field].items() for field in fields)):
+        combination = dict(patient)
+        weight = 1.0
+        for field, (level, proportion) in zip(fields, levels):
+            combination[field] = level
+            weight *= float(proportion)
+        patients.append(combination)
+        weights.append(weight)
+
+    return patients, weights
+
+
+def time_grid(trajectories: Iterable[Mapping[str, Sequence[float]]]) -> np.ndarray:
+    """
+    Returns the sorted union of the time points of the trajectories.
+    """
+    times = [np.asarray(trajectory["time"]) for trajectory in trajectories if len(trajectory["time"])]
+    return np.unique(np.concatenate(times)) if times else np.array([])
+
+
+def step_values(time: Sequence[float], values: Sequence[float], grid: np.ndarray) -> np.ndarray:
+    """
+    Evaluates a step function, given by its values at sorted time points, on a time grid.
+
+    Grid points before the first time point take the first value.
+
+    Examples:
+        >>> step_values([0, 12, 24], [1.0, 0.9, 0.8], np.array([0, 6, 12, 18, 24, 30]))
+        array([1. , 1. , 0.9, 0.9, 0.8, 0.8])
+    """
+    positions = np.searchsorted(np.asarray(time), grid, side="right") - 1
+    return np.asarray(values, dtype=np.float64)[np.clip(positions, 0, None)]
+
+
+def survival_at(trajectory: Mapping[str, Sequence[float]], times: Iterable[float]) -> List[Optional[float]]:
+    """
+    Reads the survival probability of a trajectory at given times.
+
+    Returns None for the times beyond the last time point of the trajectory.
+
+    Examples:
+        >>> survival_at({"time": [0, 12, 24], "survival_probability": [1.0, 0.9, 0.8]}, [18, 24, 60])
+        [0.9, 0.8, None]
+    """
+    time = trajectory["time"]
+    times = list(times)
+    if not len(time):
+        return [None] * len(times)
+
+    values = step_values(time, trajectory["survival_probability"], np.asarray(times))
+    return [None if t > time[-1] else float(value) for t, value in zip(times, values)]
+
+
+def curve_matrix(trajectories: Sequence[Mapping[str, Sequence[float]]], grid: np.ndarray,
+                 field: str = "survival_probability") -> np.ndarray:
+    """
+    Stacks a field of the trajectories into a patients x grid matrix.
+
+    Trajectories already on the grid, the usual case for the models of one scenario,
+    are stacked without interpolation. Grid points beyond the last time point of a
+    trajectory are NaN, as in survival_at.
+
+    Examples:
+        >>> curve_matrix([{"time": [0, 12], "survival_probability": [1.0, 0.9]}], np.array([0, 12, 24]))
+        array([[1. , 0.9, nan]])
+    """
+    rows = []
+    for trajectory in trajectories:
+        if len(trajectory["time"]) == len(grid) and np.array_equal(trajectory["time"], grid):
+            rows.append(np.asarray(trajectory[field], dtype=np.float64))
+        else:
+            row = step_values(trajectory["time"], trajectory[field], grid)
+            row[grid > trajectory["time"][-1]] = np.nan
+            rows.append(row)
+    return np.vstack(rows) if rows else np.empty((0, len(grid)))
+
+
+def weighted_quantiles(matrix: np.ndarray, weights: np.ndarray, quantiles: Sequence[float]) -> np.ndarray:
+    """
+    Computes pointwise weighted quantiles of the columns of a matrix.
+
+    NaN values are left out of their column; a column without any positive weight
+    left has NaN quantiles.
+
+    Args:
+        matrix (np.ndarray): The patients x time points curves.
+        weights (np.ndarray): The weight of each patient.
+        quantiles (Sequence[float]): The quantiles, between 0 and 1.
+
+    Returns:
+        np.ndarray: A quantiles x time points matrix.
+
+    Examples:
+        >>> weighted_quantiles(np.array([[0.9], [0.5], [0.7]]), np.array([1.0, 1.0, 2.0]), [0.25, 0.5, 1.0])
+        array([[0.5],
+               [0.7],
+               [0.9]])
+        >>> weighted_quantiles(np.array([[0.9, 0.8], [0.5, np.nan]]), np.array([1.0, 1.0]), [1.0])
+        array([[0.9, 0.8]])
+    """
+    if not matrix.shape[0]:
+        return np.full((len(quantiles), matrix.shape[1]), np.nan)
+
+    present = ~np.isnan(matrix)
+    column_weights = np.where(present, weights[:, None], 0.0)
+    totals = column_weights.sum(axis=0)
+
+    # NaN values sort last, after every present value of their column
+    order = np.argsort(matrix, axis=0)
+    sorted_values = np.take_along_axis(matrix, order, axis=0)
+    cumulative = np.cumsum(np.take_along_axis(column_weights, order, axis=0), axis=0) / np.where(totals > 0, totals, 1)
+    last = np.maximum(present.sum(axis=0) - 1, 0)
+
+    columns = np.arange(matrix.shape[1])
+    bands = []
+    for quantile in quantiles:
+        # First patient whose cumulative weight reaches the quantile
+        rows = np.minimum((cumulative < quantile - 1e-12).sum(axis=0), last)
+        bands.append(np.where(totals > 0, sorted_values[rows, columns], np.nan))
+
+    return np.vstack(bands) if bands else np.empty((0, matrix.shape[1]))
+
+
+def aggregate(trajectories: Sequence[Mapping[str, Sequence[float]]], weights: Sequence[float], grid: np.ndarray,
+              quantiles: Sequence[float] = DEFAULT_QUANTILES) -> Dict[str, object]:
+    """
+    Computes the population survival curve of a cohort.
+
+    Args:
+        trajectories (Sequence[Mapping[str, Sequence[float]]]): The patient trajectories, as
+            returned by get_patient_trajectory. Empty trajectories (covariates without a
+            precomputed trajectory) are left out and counted in n_missing.
+        weights (Sequence[float]): The weight of each patient.
+        grid (np.ndarray): The time points of the curves, see time_grid.
+        quantiles (Sequence[float]): The quantiles of the bands.
+
+    Returns:
+        Dict[str, object]: The weighted mean 'survival_probability' on the 'time' grid, the
+            'quantiles' bands keyed on quantile, and the 'n_patients' and 'n_missing' counts.
+            The patients whose trajectory ends before a time point are left out of it, and
+            the time points without any patient (or weight) left are None.
+    """
+    present = [position for position, trajectory in enumerate(trajectories) if len(trajectory["time"])]
+    matrix = curve_matrix([trajectories[position] for position in present], grid)
+    weights = np.asarray(weights, dtype=np.float64)[present]
+
+    totals = np.where(np.isnan(matrix), 0.0, weights[:, None]).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(totals > 0, (weights @ np.nan_to_num(matrix)) / totals, np.nan)
+    bands = weighted_quantiles(matrix, weights, quantiles)
+
+    mean = [None if np.isnan(value) else value for value in mean.tolist()]
+    bands = [[None if np.isnan(value) else value for value in band] for band in bands.tolist()]
+
+    return {
+        "time": grid.tolist(),
+        "survival_probability": mean,
+        "quantiles": {str(quantile): band for quantile, band in zip(quantiles, bands)},
+        "n_patients": len(present),
+        "n_missing": len(trajectories) - len(present)
+    }
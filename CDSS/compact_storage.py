@@ -0,0 +1,336 @@
+"""
+Compact storage of the model trajectories: one document per covariate tuple.
+
+The original model collections hold one document per time point, repeating the
+covariates and the time axis of every trajectory. In the compact collections
+(compact.<model name>) each trajectory is a single document holding its
+covariates and its curves as binary arrays, and the time axis shared by the
+trajectories of a model is stored once in the time_grids collection. Only the
+trajectories on another time axis carry their own 'time' array. Each conversion
+is identified by a migration id, carried by the compact documents and their time
+grid, so that a re-converted model never pairs its new curves with an old grid.
+
+Curves are quantized to 16 bits (survival probabilities and their confidence
+bounds lie in [0, 1], so the error is below 1e-5), delta-encoded and zlib
+compressed: the curves decrease slowly, so the deltas are small and compress
+well. Curves with values outside [0, 1] are stored losslessly as float64.
+
+Collections are converted with `python manage.py compact-storage`, and are read
+instead of the original ones when COMPACT_STORAGE is set.
+"""
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+import bson
+import numpy as np
+
+from model_data import versioned_name
+from trajectory_store import TRAJECTORY_FIELDS, make_key
+
+COMPACT_PREFIX = "compact."
+GRID_COLLECTION = "time_grids"
+# Field holding the migration id of the compact documents and of their time grid
+GRID_FIELD = "grid"
+
+# Encodings of the curves, stored in the 'encoding' field of each document
+QUANTIZED = "u16-delta-zlib"
+LOSSLESS = "f64-zlib"
+
+# Fields holding encoded curves, the other trajectory field being the time axis
+CURVE_FIELDS = ("survival_probability", "ci_lower", "ci_upper")
+
+QUANTIZATION_SCALE = 65535
+# Decoded values are rounded to this many decimals, the precision of the 16-bit quantization
+QUANTIZATION_DECIMALS = 5
+QUANTIZATION_ERROR = 0.5 / QUANTIZATION_SCALE + 0.5 * 10 ** -QUANTIZATION_DECIMALS
+
+# MongoDB projection of the compact documents, which hold nothing but the trajectory and its covariates
+COMPACT_PROJECTION = {"_id": 0}
+
+
+def compact_collection_name(model_name: str) -> str:
+    """
+    Examples:
+        >>> compact_collection_name("gs1_score_interaction_os_24m")
+        'compact.gs1_score_interaction_os_24m'
+    """
+    return COMPACT_PREFIX + model_name
+
+
+def encode_curve(values: Sequence[float], encoding: str = QUANTIZED) -> bytes:
+    """
+    Encodes a curve into bytes.
+
+    Args:
+        values (Sequence[float]): The curve values, in [0, 1] for the QUANTIZED encoding.
+        encoding (str): QUANTIZED or LOSSLESS.
+
+    Returns:
+        bytes: The compressed curve, see decode_curve.
+    """
+    values = np.asarray(values, dtype=np.float64)
+
+    if encoding == QUANTIZED:
+        quantized = np.rint(values * QUANTIZATION_SCALE).astype("<u2")
+        # Deltas wrap around modulo 2**16, and are summed back the same way
+        deltas = np.diff(quantized, prepend=np.zeros(1, dtype="<u2")).astype("<u2")
+        return zlib.compress(deltas.tobytes())
+    elif encoding == LOSSLESS:
+        return zlib.compress(values.astype("<f8").tobytes())
+
+    raise ValueError("Unknown curve encoding: " + encoding)
+
+
+def decode_curve(data: bytes, encoding: str) -> np.ndarray:
+    """
+    Decodes a curve encoded with encode_curve.
+
+    Examples:
+        >>> decode_curve(encode_curve([1.0, 0.95, 0.901234]), QUANTIZED)
+        array([1.     , 0.95   , 0.90123])
+        >>> decode_curve(encode_curve([1.0, 0.95, 0.901234], LOSSLESS), LOSSLESS)
+        array([1.      , 0.95    , 0.901234])
+    """
+    if encoding == QUANTIZED:
+        quantized = np.cumsum(np.frombuffer(zlib.decompress(data), dtype="<u2"), dtype=np.uint16)
+        return np.round(quantized / QUANTIZATION_SCALE, QUANTIZATION_DECIMALS)
+    elif encoding == LOSSLESS:
+        return np.frombuffer(zlib.decompress(data), dtype="<f8")
+
+    raise ValueError("Unknown curve encoding: " + encoding)
+
+
+def encode_trajectory(model_name: str, key: Tuple, trajectory: Mapping[str, Sequence[float]], grid: Sequence[float],
+                      encoding: str = QUANTIZED, migration: Optional[str] = None) -> Dict[str, object]:
+    """
+    Builds the compact document of a trajectory.
+
+    Args:
+        model_name (str): The model name, as returned by select_model.
+        key (Tuple): The covariate key of the trajectory, see make_key.
+        trajectory (Mapping[str, Sequence[float]]): The trajectory columns, sorted by time.
+        grid (Sequence[float]): The time grid of the model.
+        encoding (str): The encoding of the curves, LOSSLESS being used for values outside [0, 1].
+        migration (Optional[str]): The migration id of the time grid, see GRID_FIELD.
+
+    Returns:
+        Dict[str, object]: The document, with 'time' only if the trajectory is not on the grid.
+    """
+    if encoding == QUANTIZED:
+        curves = np.asarray([trajectory[field] for field in CURVE_FIELDS], dtype=np.float64)
+        if not ((curves >= 0.0) & (curves <= 1.0)).all():
+            encoding = LOSSLESS
+
+    document = dict(key, model=model_name, encoding=encoding)
+    if migration is not None:
+        document[GRID_FIELD] = migration
+    for field in CURVE_FIELDS:
+        document[field] = encode_curve(trajectory[field], encoding)
+    if list(trajectory["time"]) != list(grid):
+        document["time"] = list(trajectory["time"])
+
+    return document
+
+
+def decode_document(document: Mapping[str, object], grid: List[float]) -> Dict[str, list]:
+    """
+    Decodes a compact document into the trajectory returned by the endpoints.
+
+    Args:
+        document (Mapping[str, object]): The compact document, see encode_trajectory.
+        grid (List[float]): The time grid of the model, returned as is for the trajectories on it.
+
+    Returns:
+        Dict[str, list]: The trajectory, as returned by get_patient_trajectory.
+
+    Examples:
+        >>> document = encode_trajectory("clinical_base_os_24m", (("clinical_sex", "male"),),
+        ...                              {"time": [0, 12], "survival_probability": [1.0, 0.9],
+        ...                               "ci_lower": [1.0, 0.85], "ci_upper": [1.0, 0.95]}, [0, 12])
+        >>> decode_document(document, [0, 12])
+        {'survival_probability': [1.0, 0.90001], 'time': [0, 12], 'ci_lower': [1.0, 0.85], 'ci_upper': [1.0, 0.95]}
+    """
+    encoding = document["encoding"]
+    trajectory = {}
+    for field in TRAJECTORY_FIELDS:
+        if field == "time":
+            trajectory[field] = document.get("time", grid)
+        else:
+            trajectory[field] = decode_curve(document[field], encoding).tolist()
+
+    return trajectory
+
+
+def decode_documents(documents: Iterable[Mapping[str, object]], queries: List[Mapping[str, object]],
+                     grids: Mapping[Optional[str], List[float]]) -> List[Dict[str, list]]:
+    """
+    Decodes the compact documents returned for several queries of the same model.
+
+    Args:
+        documents (Iterable[Mapping[str, object]]): The compact documents.
+        queries (List[Mapping[str, object]]): The queries built by the endpoint.
+        grids (Mapping[Optional[str], List[float]]): The time grid of each migration id of
+            the documents, see read_grid.
+
+    Returns:
+        List[Dict[str, list]]: The trajectories in the order of the queries, empty for the
+            queries without document.
+    """
+    covariates = [field for field in queries[0] if field != "model"]
+    trajectories = {}
+    for document in documents:
+        key = tuple(sorted((field, document.get(field)) for field in covariates))
+        trajectories[key] = decode_document(document, grids[document.get(GRID_FIELD)])
+
+    return [trajectories.get(make_key(query)) or {field: [] for field in TRAJECTORY_FIELDS} for query in queries]
+
+
+def load_trajectories(collection, model_name: str, covariates: Iterable[str],
+                      grids: Mapping[Optional[str], Sequence[float]]) -> Dict[Tuple, Dict[str, np.ndarray]]:
+    """
+    Decodes every trajectory of a compact collection into arrays, for the in-memory TrajectoryStore.
+
+    Identical curves (e.g. of neighboring ages) are decoded once and shared, as is the time grid.
+
+    Args:
+        collection: The compact collection of the model.
+        model_name (str): The model name, as returned by select_model.
+        covariates (Iterable[str]): The fields the endpoints filter on, see model_covariates.
+        grids (Mapping[Optional[str], Sequence[float]]): The time grid of each migration id of
+            the collection, see collection_migrations.
+
+    Returns:
+        Dict[Tuple, Dict[str, np.ndarray]]: The trajectory columns, keyed on covariate key.
+    """
+    covariates = list(covariates)
+    times = {migration: np.asarray(grid) for migration, grid in grids.items()}
+    curves: Dict[Tuple[str, bytes], np.ndarray] = {}
+
+    trajectories = {}
+    for document in collection.find({"model": model_name}, COMPACT_PROJECTION):
+        key = tuple(sorted((field, document.get(field)) for field in covariates))
+        trajectory = {"time": np.asarray(document["time"]) if "time" in document else times[document.get(GRID_FIELD)]}
+        for field in CURVE_FIELDS:
+            encoded = (document["encoding"], document[field])
+            if encoded not in curves:
+                curves[encoded] = decode_curve(document[field], document["encoding"])
+            trajectory[field] = curves[encoded]
+        trajectories[key] = {field: trajectory[field] for field in TRAJECTORY_FIELDS}
+
+    return trajectories
+
+
+def collection_migrations(collection, model_name: str) -> List[Optional[str]]:
+    """
+    Lists the migration ids of the documents of a compact collection, None standing for
+    the documents converted before migration ids.
+    """
+    return [None] + [migration for migration in collection.distinct(GRID_FIELD, {"model": model_name})
+                     if migration is not None]
+
+
+def read_grid(database, model_name: str, grid_collection: str = GRID_COLLECTION,
+              migration: Optional[str] = None) -> List[float]:
+    """
+    Returns the time grid of a model conversion, empty if the model has not been converted.
+
+    Args:
+        database: The MongoDB database holding the time grids.
+        model_name (str): The model name, as returned by select_model.
+        grid_collection (str): The collection of the time grids.
+        migration (Optional[str]): The migration id of the compact documents, see GRID_FIELD.
+    """
+    document = database[grid_collection].find_one({"model": model_name, GRID_FIELD: migration}, {"_id": 0, "time": 1})
+    return list(document["time"]) if document else []
+
+
+def migrate_model(database, model_name: str, covariates: Iterable[str], encoding: str = QUANTIZED,
+                  batch_size: int = 1000, collection_version: Optional[str] = None) -> Dict[str, object]:
+    """
+    Converts the collection of a model into its compact collection.
+
+    The compact collection is written under a temporary name, indexed, checked against
+    the original trajectories and then renamed once the time grid is written, so readers
+    never see it partially written or without its grid. The documents and the grid carry
+    a new migration id, so the grid of the collection being replaced, which may be cached
+    by the readers, is never applied to the new documents. The original collection is
+    left untouched.
+
+    Args:
+        database: The MongoDB database holding the model collections.
+        model_name (str): The model name, as returned by select_model.
+        covariates (Iterable[str]): The fields the endpoints filter on, see model_covariates.
+        encoding (str): QUANTIZED, or LOSSLESS to keep the exact values.
+        batch_size (int): The number of documents per insert.
+        collection_version (Optional[str]): The version of the collections to convert, see model_data.
+
+    Returns:
+        Dict[str, object]: The numbers of trajectories and time point documents converted, of
+            trajectories off the time grid or stored losslessly, and the BSON sizes before and after.
+
+    Raises:
+        ValueError: If a decoded trajectory differs from the original one.
+    """
+    covariates = list(covariates)
+    projection = dict({field: 1 for field in covariates + list(TRAJECTORY_FIELDS)}, _id=0)
+
+    timepoints: Dict[Tuple, List[dict]] = {}
+    for timepoint in database[versioned_name(collection_version, model_name)].find({"model": model_name}, projection):
+        key = tuple(sorted((field, timepoint.get(field)) for field in covariates))
+        timepoints.setdefault(key, []).append(timepoint)
+
+    # The grid is the most common time axis of the model
+    axes = Counter()
+    for documents in timepoints.values():
+        documents.sort(key=lambda timepoint: timepoint["time"])
+        axes[tuple(timepoint["time"] for timepoint in documents)] += 1
+    grid = list(axes.most_common(1)[0][0]) if axes else []
+
+    target = versioned_name(collection_version, compact_collection_name(model_name))
+    staging = database[target + ".tmp"]
+    staging.drop()
+    migration = str(bson.ObjectId())
+
+    stats = {"model": model_name, "trajectories": len(timepoints), "documents": 0, "off_grid": 0, "lossless": 0,
+             "bytes_before": 0, "bytes_after": 0}
+    tolerance = QUANTIZATION_ERROR if encoding == QUANTIZED else 0.0
+
+    batch = []
+    for key, documents in timepoints.items():
+        trajectory = {field: [timepoint[field] for timepoint in documents] for field in TRAJECTORY_FIELDS}
+        document = encode_trajectory(model_name, key, trajectory, grid, encoding, migration)
+
+        decoded = decode_document(document, grid)
+        for field in CURVE_FIELDS:
+            if np.abs(np.asarray(decoded[field]) - np.asarray(trajectory[field], dtype=np.float64)).max() > tolerance:
+                raise ValueError("Compact trajectory of " + model_name + " differs from the original: " + repr(key))
+
+        stats["documents"] += len(documents)
+        stats["off_grid"] += "time" in document
+        stats["lossless"] += document["encoding"] == LOSSLESS
+        stats["bytes_before"] += sum(len(bson.encode(timepoint)) for timepoint in documents)
+        stats["bytes_after"] += len(bson.encode(document))
+
+        batch.append(document)
+        if len(batch) == batch_size:
+            staging.insert_many(batch)
+            batch = []
+    if batch:
+        staging.insert_many(batch)
+
+    # The grid is written first, so that readers never see the compact collection without it
+    grids = database[versioned_name(collection_version, GRID_COLLECTION)]
+    grids.insert_one({"model": model_name, GRID_FIELD: migration, "time": grid})
+    replaced = collection_migrations(database[target], model_name)
+
+    if timepoints:
+        staging.create_index([("model", 1)] + [(field, 1) for field in covariates], name=model_name + "_query")
+        staging.rename(target, dropTarget=True)
+    else:
+        database[target].drop()
+
+    # The grid of the replaced collection is kept for the readers still decoding its documents
+    grids.delete_many({"model": model_name, GRID_FIELD: {"$nin": replaced + [migration]}})
+
+    return stats
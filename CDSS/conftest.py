@@ -0,0 +1,62 @@
+"""
+Fixtures of the API tests: the Flask test client against a seeded mongomock database.
+
+The database is seeded as for the benchmarks (see benchmark.seed_database), with
+fewer and shorter trajectories, and every test gets its own database, model data
+and configuration.
+
+    pip install pytest mongomock
+    python -m pytest
+"""
+import os
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import supertreat_api
+from benchmark import StandInClient, seed_database
+from model_data import ModelData
+
+# Trajectories seeded per model, and their monthly time points
+PATIENTS_PER_MODEL = 4
+TIME_POINTS = 13
+
+
+@pytest.fixture
+def seeded():
+    config = dict(supertreat_api.app.config)
+    client, client_pid = supertreat_api.mongo_client, supertreat_api.mongo_client_pid
+
+    supertreat_api.mongo_client = StandInClient(mongomock.MongoClient())
+    supertreat_api.mongo_client_pid = os.getpid()
+    supertreat_api.model_data = ModelData()
+    supertreat_api.response_cache.clear()
+    database = supertreat_api.get_db()
+    payloads = seed_database(database, PATIENTS_PER_MODEL, TIME_POINTS)
+
+    yield database, payloads
+
+    supertreat_api.app.config.clear()
+    supertreat_api.app.config.update(config)
+    supertreat_api.mongo_client, supertreat_api.mongo_client_pid = client, client_pid
+    supertreat_api.model_data = ModelData()
+    supertreat_api.response_cache.clear()
+
+
+@pytest.fixture
+def database(seeded):
+    return seeded[0]
+
+
+@pytest.fixture
+def payloads(seeded):
+    """
+    The request bodies of the seeded patients, keyed on scenario endpoint.
+    """
+    return seeded[1]
+
+
+@pytest.fixture
+def client(database):
+    return supertreat_api.app.test_client()
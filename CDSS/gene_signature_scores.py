@@ -0,0 +1,282 @@
+"""
+Vectorized Python port of the gene signature scorers in gene_signatures/.
+
+A signature is a linear predictor over gene expression; the scores of a whole
+cohort are computed as one matrix-vector product over a samples x genes matrix.
+Genes that are not measured (absent from the matrix, listed as unmeasured, or
+NaN for a sample) are masked out, which is equivalent to imputing 0 for their
+expression, as in the R implementation.
+
+Expression matrices too large for a JSON body are read chunk by chunk with
+read_delimited (CSV/TSV) or read_parquet, keeping only the signature genes, so
+that a cohort of any size is scored in constant memory.
+"""
+import csv
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Cell values read as not measured in delimited expression matrices
+MISSING_VALUES = {"", "NA", "NaN", "nan", "null"}
+
+
+class GeneSignature:
+    """
+    A gene signature given by its gene symbols and regression coefficients.
+
+    Symbols may repeat (as BSPRY in gs4), in which case their coefficients add up.
+    """
+
+    def __init__(self, name: str, symbols: Sequence[str], coefficients: Sequence[float], intercept: float = 0.0,
+                 unmeasured_genes: Iterable[str] = ()):
+        self.name = name
+        self.intercept = intercept
+        self.unmeasured_genes = list(unmeasured_genes)
+
+        self.coefficients: Dict[str, float] = {}
+        for symbol, coefficient in zip(symbols, coefficients):
+            self.coefficients[symbol] = self.coefficients.get(symbol, 0.0) + coefficient
+
+    @property
+    def genes(self) -> List[str]:
+        return list(self.coefficients)
+
+    def linear_predictor(self, expression, genes: Optional[Sequence[str]] = None,
+                         unmeasured_genes: Optional[Iterable[str]] = None) -> np.ndarray:
+        """
+        Computes the linear predictor of every sample.
+
+        Args:
+            expression: samples x genes expression, a pandas DataFrame with gene symbols as
+                columns or a 2D array together with genes.
+            genes (Optional[Sequence[str]]): The gene symbols of the columns of an array.
+            unmeasured_genes (Optional[Iterable[str]]): Genes to remove from the predictor,
+                the signature defaults when None.
+
+        Returns:
+            np.ndarray: The linear predictor of each sample.
+        """
+        if genes is None:
+            genes = list(expression.columns)
+        matrix = np.asarray(expression, dtype=np.float64).reshape(-1, len(genes))
+
+        unmeasured = set(self.unmeasured_genes if unmeasured_genes is None else unmeasured_genes)
+        beta = np.array([0.0 if gene in unmeasured else self.coefficients.get(gene, 0.0) for gene in genes])
+
+        # Only the signature genes take part in the product; NaN means not measured
+        used = beta != 0.0
+        values = np.nan_to_num(matrix[:, used], nan=0.0)
+
+        return values @ beta[used] + self.intercept
+
+    def predict(self, expression, genes: Optional[Sequence[str]] = None, type: str = "prob",
+                p_threshold: float = 0.5, unmeasured_genes: Optional[Iterable[str]] = None) -> np.ndarray:
+        """
+        Predicts the response probability, or class, of every sample with the logistic function.
+
+        Args:
+            expression: samples x genes expression, see linear_predictor.
+            genes (Optional[Sequence[str]]): The gene symbols of the columns of an array.
+            type (str): "prob" for probabilities, "class" for 1/0 at p_threshold.
+            p_threshold (float): Probability threshold of the classes.
+            unmeasured_genes (Optional[Iterable[str]]): See linear_predictor.
+
+        Returns:
+            np.ndarray: The probability or class of each sample.
+
+        Examples:
+            >>> gs4_cisplatin.predict(np.array([[1.0], [2.0]]), genes=["SLFN11"]).round(4)
+            array([0.5195, 0.539 ])
+        """
+        probability = 1.0 / (1.0 + np.exp(-self.linear_predictor(expression, genes, unmeasured_genes)))
+
+        if type == "prob":
+            return probability
+        elif type == "class":
+            return (probability >= p_threshold).astype(np.int64)
+
+        raise ValueError("type must be 'prob' or 'class'.")
+
+
+def score_levels(scores: Iterable[float], levels: Mapping[str, float]) -> List[str]:
+    """
+    Bins signature scores to the nearest gs_score level expected by the scenario endpoints.
+
+    Args:
+        scores (Iterable[float]): The scores of the samples.
+        levels (Mapping[str, float]): The score value of each level, see model_registry.gs_score_levels.
+
+    Returns:
+        List[str]: The level of each sample.
+
+    Examples:
+        >>> score_levels([-1.5, 0.3], {"-2": -1.6, "-1": -1.1, "0": -0.6, "1": -0.1, "2": 0.4})
+        ['-2', '2']
+    """
+    names = list(levels)
+    values = np.array([levels[name] for name in names])
+    nearest = np.abs(np.asarray(list(scores), dtype=np.float64)[:, np.newaxis] - values).argmin(axis=1)
+
+    return [names[index] for index in nearest]
+
+
+def parse_expression(value: str) -> float:
+    """
+    Parses a cell of a delimited expression matrix, NaN when not measured.
+
+    Examples:
+        >>> parse_expression("2.5"), parse_expression("NA")
+        (2.5, nan)
+    """
+    return float("nan") if value.strip() in MISSING_VALUES else float(value)
+
+
+def read_delimited(lines: Iterable[str], genes: Iterable[str], delimiter: str = ",",
+                   chunk_size: int = 1000) -> Tuple[List[str], Iterator[Tuple[List[str], np.ndarray, Dict[int, str]]]]:
+    """
+    Reads a samples x genes expression matrix from CSV or TSV lines, chunk by chunk.
+
+    The first row holds the gene symbols and the first column the sample ids. Only
+    the columns of the given genes are parsed, the rest of each row is skipped.
+    The rows are parsed while the scores are streamed back, so a malformed row (too
+    short, or with a value that is not a number) does not fail the whole upload: it
+    is reported in the errors of its chunk, and its expression is NaN.
+
+    Args:
+        lines (Iterable[str]): The lines of the file, e.g. a text stream of the request body.
+        genes (Iterable[str]): The genes to keep, usually GeneSignature.genes.
+        delimiter (str): "," for CSV, "\t" for TSV.
+        chunk_size (int): The number of samples per chunk.
+
+    Returns:
+        Tuple[List[str], Iterator[Tuple[List[str], np.ndarray, Dict[int, str]]]]: The genes found in
+            the header, and an iterator of (sample ids, samples x found genes expression, errors)
+            chunks, the errors being keyed on the position of the malformed rows in the chunk.
+
+    Raises:
+        ValueError: If the matrix is empty or has none of the genes.
+
+    Examples:
+        >>> found, chunks = read_delimited(["id,SLFN11,GAPDH", "a,1.0,5.0", "b,NA,6.0"], ["SLFN11"])
+        >>> found, [(samples, matrix.tolist(), errors) for samples, matrix, errors in chunks]
+        (['SLFN11'], [(['a', 'b'], [[1.0], [nan]], {})])
+
+        >>> found, chunks = read_delimited(["id,SLFN11,GAPDH", "a,x,5.0", "b"], ["SLFN11"])
+        >>> [(samples, errors) for samples, _, errors in chunks]
+        [(['a', 'b'], {0: 'line 2: SLFN11 is not a number', 1: 'line 3: expected 3 columns, got 1'})]
+    """
+    reader = csv.reader(lines, delimiter=delimiter)
+    header = next(reader, None)
+    if not header:
+        raise ValueError("Bad request: the expression matrix is empty.")
+
+    genes = set(genes)
+    columns = [(position, gene) for position, gene in enumerate(header) if position and gene in genes]
+    if not columns:
+        raise ValueError("Bad request: none of the signature genes are in the expression matrix.")
+
+    def parse_row(row: List[str]) -> List[float]:
+        if len(row) < len(header):
+            raise ValueError("line " + str(reader.line_num) + ": expected " + str(len(header))
+                             + " columns, got " + str(len(row)))
+        values = []
+        for position, gene in columns:
+            try:
+                values.append(parse_expression(row[position]))
+            except ValueError:
+                raise ValueError("line " + str(reader.line_num) + ": " + gene + " is not a number")
+        return values
+
+    def chunks():
+        samples, rows, errors = [], [], {}
+        for row in reader:
+            if not row:
+                continue
+            samples.append(row[0])
+            try:
+                rows.append(parse_row(row))
+            except ValueError as e:
+                errors[len(rows)] = str(e)
+                rows.append([float("nan")] * len(columns))
+            if len(rows) == chunk_size:
+                yield samples, np.array(rows, dtype=np.float64), errors
+                samples, rows, errors = [], [], {}
+        if rows:
+            yield samples, np.array(rows, dtype=np.float64), errors
+
+    return [gene for _, gene in columns], chunks()
+
+
+def read_parquet(source, genes: Iterable[str],
+                 chunk_size: int = 1000) -> Tuple[List[str], Iterator[Tuple[List[str], np.ndarray, Dict[int, str]]]]:
+    """
+    Reads a samples x genes expression matrix from a Parquet file, chunk by chunk.
+
+    Laid out as read_delimited expects: the first column holds the sample ids and
+    the other columns are named by gene symbol. Only the columns of the given genes
+    are read from the file.
+
+    Args:
+        source: A path or seekable binary file.
+        genes (Iterable[str]): The genes to keep, usually GeneSignature.genes.
+        chunk_size (int): The maximum number of samples per chunk.
+
+    Returns:
+        Tuple[List[str], Iterator[Tuple[List[str], np.ndarray, Dict[int, str]]]]: See read_delimited.
+            The column types are checked upfront, so the errors of the chunks are always empty.
+
+    Raises:
+        ValueError: If the file has none of the genes, or a gene column that is not numeric.
+    """
+    import pyarrow.parquet as pq
+    import pyarrow.types
+
+    parquet_file = pq.ParquetFile(source)
+    schema = parquet_file.schema_arrow
+    names = schema.names
+    genes = set(genes)
+    found = [name for name in names[1:] if name in genes]
+    if not found:
+        raise ValueError("Bad request: none of the signature genes are in the expression matrix.")
+    for name in found:
+        column_type = schema.field(name).type
+        if not (pyarrow.types.is_integer(column_type) or pyarrow.types.is_floating(column_type)
+                or pyarrow.types.is_null(column_type)):
+            raise ValueError("Bad request: the " + name + " column is not numeric.")
+
+    def chunks():
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=[names[0]] + found):
+            samples = [str(sample) for sample in batch.column(0).to_pylist()]
+            matrix = np.column_stack([
+                batch.column(position).to_numpy(zero_copy_only=False).astype(np.float64)
+                for position in range(1, batch.num_columns)
+            ])
+            yield samples, matrix, {}
+
+    return found, chunks()
+
+
+# gs4: cisplatin-based chemotherapy response, see gene_signatures/gs4_cisplatin.R
+# J. D. Wells et al. 2021 DOI:10.1177/11769351211002494
+gs4_cisplatin = GeneSignature(
+    "gs4",
+    symbols=['SLFN11', 'TASOR', 'DDX50', 'BCAT1',
+             'SALL4', 'PDLIM4', 'METAP2',
+             'LRRC8C', 'QKI', 'STOML2', 'SLC35A2',
+             'NEBL', 'ABHD11', 'CALCOCO1', 'ZNF91',
+             'ZDHHC9', 'SLC25A45', 'MYO5B', 'TMC4',
+             'TFF3', 'BSPRY', 'CNPPD1', 'CLDN3', 'BSPRY'],
+    coefficients=[0.07806286, 0.0584335, 0.055776578, 0.029278636,
+                  0.025196954, 0.021625076, 0.020362816, 0.012095118,
+                  0.008967228, 0.001460649, -0.002316639, -0.002369246,
+                  -0.003712791, -0.007393136, -0.009960618, -0.01652152,
+                  -0.023694588, -0.034605258, -0.040749427, -0.044766622,
+                  -0.056125044, -0.056762982, -0.125547451, -0.146640606],
+    # Not measured in our data, as in the R defaults
+    unmeasured_genes=["SLC25A45", "TMC4", "MALAT1"]
+)
+
+# Signatures available in Python, keyed on the prefix used in the model names
+signatures = {
+    "gs4": gs4_cisplatin
+}
@@ -0,0 +1,15 @@
+"""
+Gunicorn settings of the SuPerTreat API, see wsgi.py.
+
+With preload_app the application (and the preloaded trajectories) is created
+once in the master process and shared copy-on-write by the forked workers;
+each worker opens its own MongoDB connection pool on first use.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('SUPERTREAT_BIND', '0.0.0.0:8001')
+workers = int(os.environ.get('SUPERTREAT_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('SUPERTREAT_THREADS', 4))
+preload_app = os.environ.get('SUPERTREAT_PRELOAD_APP', '1') == '1'
+timeout = int(os.environ.get('SUPERTREAT_WORKER_TIMEOUT', 60))
@@ -0,0 +1,142 @@
+"""
+Management commands of the SuPerTreat API.
+
+Usage:
+
+    python manage.py create-indexes [--data-version <version>]
+    python manage.py export-snapshot <directory> [--version <name>] [--data-version <version>]
+    python manage.py warmup [--workers <n>] [--gaps <n>] [--snapshot <directory>] [--strict] [--data-version <version>]
+    python manage.py compact-storage [--models <name> ...] [--lossless] [--data-version <version>]
+    python manage.py publish-version <version> [--force]
+
+--data-version selects the collections of a version of the model data (see
+model_data), the published version by default.
+"""
+import argparse
+import json
+import sys
+
+from compact_storage import LOSSLESS, QUANTIZED, compact_collection_name, migrate_model
+from model_data import ModelData, missing_collections, publish_version, read_current_version, versioned_name
+from model_registry import list_model_names, model_covariates
+from snapshot import export_snapshot
+from supertreat_api import app, create_hazard_ratio_index, get_db
+from warmup import warm_up
+
+
+def create_indexes(database, collection_version=None) -> None:
+    """
+    Creates the indexes matching the queries of every endpoint.
+
+    Each model collection gets a compound index on 'model' and the exact covariate
+    fields its endpoint filters on (including the gs*_score or gs*_class term),
+    followed by 'time' for the sorted reads of the streaming responses.
+
+    Args:
+        database: The MongoDB database holding the model collections.
+        collection_version (Optional[str]): The version of the collections, see model_data.
+    """
+    for model_name in list_model_names():
+        keys = [("model", 1)] + [(field, 1) for field in model_covariates(model_name)] + [("time", 1)]
+        collection_name = versioned_name(collection_version, model_name)
+        database[collection_name].create_index(keys, name=model_name + "_query")
+        print("Created index on " + collection_name + ": " + ", ".join(field for field, _ in keys))
+
+    create_hazard_ratio_index(database, versioned_name(collection_version, "hazard_ratios"))
+    print("Created index on " + versioned_name(collection_version, "hazard_ratios") + ": model")
+
+    database[versioned_name(collection_version, "rmst")].create_index("mod_name")
+    print("Created index on " + versioned_name(collection_version, "rmst") + ": mod_name")
+
+
+def publish(database, version, force=False) -> bool:
+    """
+    Makes a version of the model data current, once all its collections exist.
+
+    The servers pick it up on their next reload: POST /reload with the
+    SUPERTREAT_RELOAD_TOKEN, or every SUPERTREAT_RELOAD_INTERVAL seconds.
+
+    Returns:
+        bool: False if collections of the version are missing and force is not set.
+    """
+    models = list_model_names()
+    if app.config['COMPACT_STORAGE']:
+        models = [compact_collection_name(model_name) for model_name in models]
+    missing = missing_collections(database, version, models + ["hazard_ratios", "rmst"])
+    for name in missing:
+        print("Missing collection " + name)
+    if missing and not force:
+        return False
+
+    previous = read_current_version(database)
+    publish_version(database, version)
+    print("Published version " + version + ", previously " + (previous or "unversioned"))
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SuPerTreat API management commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    indexes_parser = subparsers.add_parser("create-indexes", help="create the indexes used by the endpoint queries")
+
+    export_parser = subparsers.add_parser("export-snapshot", help="dump the model data into a memory-mappable snapshot")
+    export_parser.add_argument("directory", help="root directory of the snapshots")
+    export_parser.add_argument("--version", help="name of the snapshot, a UTC timestamp by default")
+
+    warmup_parser = subparsers.add_parser("warmup", help="scan every model collection and report the coverage gaps")
+    warmup_parser.add_argument("--workers", type=int, help="number of worker processes, the number of CPUs by default")
+    warmup_parser.add_argument("--gaps", type=int, default=20, help="missing combinations listed per model")
+    warmup_parser.add_argument("--snapshot", help="root directory of the snapshots, to export one after the check")
+    warmup_parser.add_argument("--strict", action="store_true", help="exit with status 1 if any combination is missing")
+
+    compact_parser = subparsers.add_parser("compact-storage",
+                                           help="convert the model collections into compact collections")
+    compact_parser.add_argument("--models", nargs="+", help="models to convert, all by default")
+    compact_parser.add_argument("--lossless", action="store_true",
+                                help="store the curves as float64 instead of 16-bit quantized values")
+
+    publish_parser = subparsers.add_parser("publish-version", help="make a version of the model data current")
+    publish_parser.add_argument("version", help="version of the collections, e.g. 2024-05 for 2024-05.hazard_ratios")
+    publish_parser.add_argument("--force", action="store_true", help="publish even if collections are missing")
+
+    for subparser in (indexes_parser, export_parser, warmup_parser, compact_parser):
+        subparser.add_argument("--data-version", help="version of the collections, the published one by default")
+
+    args = parser.parse_args()
+
+    if args.command == "publish-version":
+        if not publish(get_db(), args.version, args.force):
+            sys.exit(1)
+        return
+
+    collection_version = args.data_version or read_current_version(get_db())
+
+    if args.command == "create-indexes":
+        create_indexes(get_db(), collection_version)
+    elif args.command == "export-snapshot":
+        directory = export_snapshot(get_db(), args.directory, list_model_names(), model_covariates, args.version,
+                                    collection_version)
+        print("Exported snapshot to " + directory)
+    elif args.command == "warmup":
+        report = warm_up(app.config, workers=args.workers, max_gaps=args.gaps, data=ModelData(collection_version))
+        print(json.dumps(report, indent=2))
+
+        if args.snapshot:
+            directory = export_snapshot(get_db(), args.snapshot, list_model_names(), model_covariates,
+                                        collection_version=collection_version)
+            print("Exported snapshot to " + directory)
+
+        if args.strict and report["found"] < report["expected"]:
+            sys.exit(1)
+    elif args.command == "compact-storage":
+        database = get_db()
+        for model_name in args.models or list_model_names():
+            stats = migrate_model(database, model_name, model_covariates(model_name),
+                                  LOSSLESS if args.lossless else QUANTIZED, collection_version=collection_version)
+            ratio = stats["bytes_before"] / stats["bytes_after"] if stats["bytes_after"] else 0.0
+            print(model_name + ": " + str(stats["trajectories"]) + " trajectories, "
+                  + str(stats["bytes_before"]) + " -> " + str(stats["bytes_after"]) + " bytes (" + "%.1f" % ratio + "x)")
+
+
+if __name__ == "__main__":
+    main()
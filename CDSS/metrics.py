@@ -0,0 +1,346 @@
+"""
+Latency and throughput metrics of the API, in the Prometheus text format.
+
+Each request is split into phases (validation, model selection, MongoDB query,
+cursor iteration, serialization) timed with the timed context manager; their
+durations go to histograms labelled by route, and are also kept per request to
+build a Server-Timing header. Counters record the documents read from MongoDB,
+the empty trajectories returned and the cache hits and misses.
+
+Metrics are kept in the memory of each process: with several server workers,
+every worker exposes its own counters and Prometheus aggregates them.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Route label of the work done outside of a request, e.g. at startup
+NO_ROUTE = "none"
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """
+    Formats the labels of a sample.
+
+    Examples:
+        >>> format_labels(("route", "phase"), ("base_model", "query"))
+        '{route="base_model",phase="query"}'
+    """
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(name + '="' + escaped + '"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float) -> str:
+    """
+    Examples:
+        >>> format_value(3.0), format_value(0.25), format_value(float("inf"))
+        ('3', '0.25', '+Inf')
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """
+    A monotonically increasing count, one per combination of label values.
+
+    Examples:
+        >>> documents = Counter("documents_total", "Documents read.", ("route",))
+        >>> documents.inc(3, route="base_model")
+        >>> documents.value(route="base_model")
+        3.0
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.labels), 0.0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name + format_labels(self.labels, key) + " " + format_value(value)
+
+
+class Histogram:
+    """
+    The distribution of observed durations in cumulative buckets, one per combination of label values.
+
+    Examples:
+        >>> latency = Histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1.0))
+        >>> latency.observe(0.05, route="base_model")
+        >>> latency.observe(0.5, route="base_model")
+        >>> print("\\n".join(latency.samples()))
+        latency_seconds_bucket{route="base_model",le="0.1"} 1
+        latency_seconds_bucket{route="base_model",le="1.0"} 2
+        latency_seconds_bucket{route="base_model",le="+Inf"} 2
+        latency_seconds_sum{route="base_model"} 0.55
+        latency_seconds_count{route="base_model"} 2
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = sorted(buckets)
+        # Per label values: the count of each bucket (not cumulative, the last one being +Inf) and the sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[position] += 1
+            total[0] += value
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + [float("inf")], counts):
+                cumulative += count
+                labels = format_labels(self.labels + ("le",), key + (format_bound(bound),))
+                yield self.name + "_bucket" + labels + " " + str(cumulative)
+            yield self.name + "_sum" + format_labels(self.labels, key) + " " + repr(round(total, 9))
+            yield self.name + "_count" + format_labels(self.labels, key) + " " + str(cumulative)
+
+
+def format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+class MetricsRegistry:
+    """
+    The metrics exposed by the /metrics endpoint.
+    """
+
+    def __init__(self):
+        self.metrics: List[object] = []
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Writes every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP " + metric.name + " " + metric.documentation)
+            lines.append("# TYPE " + metric.name + " " + metric.type)
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+request_seconds = registry.histogram(
+    "supertreat_request_duration_seconds", "Duration of the requests.", ("route", "status"))
+phase_seconds = registry.histogram(
+    "supertreat_phase_duration_seconds", "Duration of each phase of the requests.", ("route", "phase"))
+documents_total = registry.counter(
+    "supertreat_documents_total", "Time point documents read from MongoDB.", ("route",))
+empty_trajectories_total = registry.counter(
+    "supertreat_empty_trajectories_total", "Trajectories returned without any time point.", ("route",))
+cache_hits_total = registry.counter(
+    "supertreat_cache_hits_total", "Lookups answered from a cache.", ("route", "cache"))
+cache_misses_total = registry.counter(
+    "supertreat_cache_misses_total", "Lookups missing from a cache.", ("route", "cache"))
+
+
+class RequestTimings:
+    """
+    The phase durations of the request being served, see start_request.
+    """
+
+    def __init__(self, route: str):
+        self.route = route
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        # Phases may be added from the threads a request fans out to, see /report
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, duration: float) -> None:
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + duration
+
+    def server_timing(self, total: Optional[float] = None) -> str:
+        """
+        Formats the phase durations, in milliseconds, as a Server-Timing header.
+
+        Examples:
+            >>> timings = RequestTimings("base_model")
+            >>> timings.add("validation", 0.00012)
+            >>> timings.add("query", 0.0031)
+            >>> timings.server_timing(total=0.004)
+            'validation;dur=0.12, query;dur=3.1, total;dur=4.0'
+        """
+        entries = [(phase, duration) for phase, duration in self.phases.items()]
+        if total is not None:
+            entries.append(("total", total))
+        return ", ".join(phase + ";dur=" + str(round(duration * 1000, 3)) for phase, duration in entries)
+
+
+# The timings of the request served by the current thread or task, None outside of a request
+current_timings: "contextvars.ContextVar[Optional[RequestTimings]]" = contextvars.ContextVar(
+    "current_timings", default=None)
+
+
+def start_request(route: Optional[str]) -> RequestTimings:
+    """
+    Starts timing a request, to be called before the route runs.
+
+    Args:
+        route (Optional[str]): The route label, e.g. the Flask endpoint name.
+
+    Returns:
+        RequestTimings: The timings of the request, filled by timed.
+    """
+    timings = RequestTimings(route or NO_ROUTE)
+    current_timings.set(timings)
+    return timings
+
+
+def finish_request(timings: RequestTimings, status: int) -> float:
+    """
+    Records the duration of a request, to be called once the response is built.
+
+    Returns:
+        float: The duration of the request in seconds.
+    """
+    duration = time.perf_counter() - timings.start
+    request_seconds.observe(duration, route=timings.route, status=status)
+    return duration
+
+
+def current_route() -> str:
+    timings = current_timings.get()
+    return timings.route if timings is not None else NO_ROUTE
+
+
+def record_phase(phase: str, duration: float) -> None:
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(phase, duration)
+    phase_seconds.observe(duration, route=timings.route if timings is not None else NO_ROUTE, phase=phase)
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    """
+    Times a phase of the current request.
+
+    Examples:
+        >>> timings = start_request("base_model")
+        >>> with timed("validation"):
+        ...     pass
+        >>> list(timings.phases)
+        ['validation']
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - start)
+
+
+def timed_cursor(cursor: Iterable[Dict[str, object]], query_phase: str = "query",
+                 iteration_phase: str = "cursor") -> Iterator[Dict[str, object]]:
+    """
+    Times the iteration of a MongoDB cursor, and counts its documents.
+
+    The first document, which waits for the query to run on the server and its
+    first batch, is timed as query_phase, the rest of the iteration (further batches
+    and BSON decoding, and the work of the caller between documents) as iteration_phase.
+
+    Examples:
+        >>> [document["time"] for document in timed_cursor([{"time": 0}, {"time": 12}])]
+        [0, 12]
+    """
+    iterator = iter(cursor)
+    n_documents = 0
+    start = time.perf_counter()
+    try:
+        try:
+            document = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            record_phase(query_phase, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        n_documents = 1
+        yield document
+        for document in iterator:
+            n_documents += 1
+            yield document
+    finally:
+        if n_documents:
+            record_phase(iteration_phase, time.perf_counter() - start)
+        count_documents(n_documents)
+
+
+def count_documents(n_documents: int) -> None:
+    """
+    Counts the documents read from MongoDB.
+    """
+    documents_total.inc(n_documents, route=current_route())
+
+
+def count_trajectories(trajectories: Iterable[Dict[str, list]]) -> None:
+    """
+    Counts the trajectories returned without any time point (covariates without a precomputed trajectory).
+    """
+    n_empty = sum(1 for trajectory in trajectories if not len(trajectory["time"]))
+    if n_empty:
+        empty_trajectories_total.inc(n_empty, route=current_route())
+
+
+def count_cache(cache: str, hits: int, misses: int) -> None:
+    """
+    Counts the hits and misses of lookups in a cache ("response" or "hazard_ratios").
+    """
+    route = current_route()
+    if hits:
+        cache_hits_total.inc(hits, route=route, cache=cache)
+    if misses:
+        cache_misses_total.inc(misses, route=route, cache=cache)
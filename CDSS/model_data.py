@@ -0,0 +1,120 @@
+"""
+Versioned model data, reloaded in the background and swapped atomically.
+
+When the models are refitted, each release of the model data is loaded into its
+own set of collections named after its version: <version>.<model name>,
+<version>.hazard_ratios, <version>.rmst (and <version>.compact.<model name>,
+<version>.time_grids for compact storage). Once complete, the release is
+published by pointing the 'current' document of the data_versions collection
+to it, see `python manage.py publish-version`. The unversioned collections of
+the original layout are served while no version has been published.
+
+The API serves one ModelData at a time: the version, the trajectories held in
+memory and the caches of the hazard ratios and time grids. A reload builds the
+ModelData of the new version while the current one keeps serving, then replaces
+it with a single assignment. Each request binds the ModelData current when it
+starts, so it finishes on the version it started on. The response cache is
+keyed on the version too, so a swap invalidates it in O(1): entries of the old
+version are never looked up again and age out of the LRU.
+"""
+import contextvars
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from survival_engine import SurvivalEngine
+from trajectory_store import TrajectoryStore
+
+VERSIONS_COLLECTION = "data_versions"
+CURRENT_VERSION = "current"
+
+
+def versioned_name(version: Optional[str], name: str) -> str:
+    """
+    Returns the name of a collection in the collection set of a version.
+
+    Examples:
+        >>> versioned_name("2024-05", "clinical_base_os_24m")
+        '2024-05.clinical_base_os_24m'
+        >>> versioned_name(None, "hazard_ratios")
+        'hazard_ratios'
+    """
+    return version + "." + name if version else name
+
+
+def read_current_version(database) -> Optional[str]:
+    """
+    Returns the published version of the model data, None for the unversioned collections.
+    """
+    document = database[VERSIONS_COLLECTION].find_one({"_id": CURRENT_VERSION})
+    return document["version"] if document else None
+
+
+def publish_version(database, version: str) -> None:
+    """
+    Makes a version the current one, to be picked up by the next reload of every server.
+    """
+    database[VERSIONS_COLLECTION].replace_one(
+        {"_id": CURRENT_VERSION},
+        {"_id": CURRENT_VERSION, "version": version, "published": datetime.now(timezone.utc)},
+        upsert=True)
+
+
+def missing_collections(database, version: str, names: List[str]) -> List[str]:
+    """
+    Lists the collections of a version that do not exist yet.
+    """
+    existing = set(database.list_collection_names())
+    return [versioned_name(version, name) for name in names if versioned_name(version, name) not in existing]
+
+
+class ModelData:
+    """
+    The model data of one version and everything derived from it in memory.
+
+    Args:
+        collection_version (Optional[str]): The version of the MongoDB collections, None for the
+            unversioned ones.
+        snapshot (Optional[snapshot.Snapshot]): The snapshot served instead of MongoDB, if any.
+    """
+
+    def __init__(self, collection_version: Optional[str] = None, snapshot=None):
+        self.collection_version = collection_version
+        self.snapshot = snapshot
+        self.loaded_at = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S.%fZ")
+
+        # Precomputed trajectories, filled when PRELOAD_TRAJECTORIES is set or from the snapshot
+        self.trajectory_store = TrajectoryStore()
+        # Cox models computing trajectories from their coefficients, filled when COMPUTE_TRAJECTORIES is set
+        self.survival_engine = SurvivalEngine()
+        # Hazard ratios already retrieved, keyed on model name
+        self.hazard_ratios: Dict[str, Dict[str, list]] = {}
+        # Time grids of the models in compact storage, keyed on model name and migration id
+        self.time_grids: Dict[Tuple[str, Optional[str]], List[float]] = {}
+
+    @property
+    def version(self) -> str:
+        """
+        The identifier of the data: the collection or snapshot version, or the time the data
+        was loaded for the unversioned collections.
+        """
+        if self.collection_version:
+            return self.collection_version
+        if self.snapshot is not None:
+            return self.snapshot.version
+        return self.loaded_at
+
+    def collection_name(self, name: str) -> str:
+        return versioned_name(self.collection_version, name)
+
+    def clear(self) -> None:
+        """
+        Drops the caches derived from the data, after it has been modified in place.
+        """
+        self.loaded_at = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S.%fZ")
+        self.hazard_ratios.clear()
+        self.time_grids.clear()
+
+
+# The model data bound to the request being served, None outside of a request
+request_model_data: "contextvars.ContextVar[Optional[ModelData]]" = contextvars.ContextVar(
+    "request_model_data", default=None)
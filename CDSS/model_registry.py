@@ -0,0 +1,278 @@
+"""
+Registry of the survival models served by the scenario endpoints.
+
+Built once at import: each clinical scenario is described by data (endpoint,
+gene signature, covariates, accepted signature types and censoring times), and
+every model name it can select is resolved up front together with its
+covariates and gs_score levels. Endpoints thus select a model with a single
+dict lookup, and unknown combinations are rejected before any database work.
+Adding a signature scenario means adding a Scenario and its score levels below.
+"""
+from typing import Dict, List, Optional, Sequence
+
+OUTCOMES = ("os", "dfs")
+
+clinical_scenarios = {
+    "1": "clinical_base",
+    "2": "gs1",
+    "3": "gs2",
+    "4": "gs3",
+    "5": "gs4",
+    "6": "gs5"
+}
+
+gene_signature_types = {
+    "none": "",
+    "class": "class_interaction_",
+    "score": "score_interaction_"
+}
+
+
+def select_model(clinical_scenario: str, outcome: str, gene_signature_type: str, censoring_time: int) -> str:
+    """
+    Selects the appropriate model name based on the given parameters.
+
+    Args:
+        clinical_scenario (str): The clinical scenario code.
+        outcome (str): The desired outcome.
+        gene_signature_type (str): The type of gene signature.
+        censoring_time (int): The censoring time in minutes.
+
+    Returns:
+        str: The model name based on the given parameters.
+
+    Raises:
+        KeyError: If the provided clinical scenario or gene signature type is not valid.
+
+    Examples:
+        >>> select_model("3", "dfs", "score", 24)
+        'gs2_score_interaction_dfs_24m'
+
+        >>> select_model("1", "os", "none", 60)
+        'clinical_base_os_60m'
+    """
+    if clinical_scenario == "1":
+        gene_signature_type = "none"
+
+    try:
+        model_name = (
+            clinical_scenarios[clinical_scenario]
+            + "_"
+            + gene_signature_types[gene_signature_type]
+            + outcome
+            + "_"
+            + str(censoring_time)
+            + "m"
+        )
+    except KeyError as e:
+        raise KeyError("Invalid clinical scenario or gene signature type.") from e
+
+    return model_name
+
+
+# Covariates each scenario filters on, besides the gene signature term.
+clinical_covariates = [
+    "clinical_sex",
+    "clinical_age_at_diagnosis",
+    "ctn_disease_extension_diagnosis",
+    "surge_undergone_cancer_surgery",
+    "radio_radiotherapy_treatment",
+    "chemo_chemotherapy_treatment",
+    "smoking_category",
+    "tumor_region",
+    "hpv_status"
+]
+
+chemosensitivity_covariates = {
+    "gs4": ["clinical_sex", "clinical_age_at_diagnosis", "ctn_stage_7ed_modified",
+            "chemo_platin_agent", "smoking_category", "tumor_region", "hpv_status"],
+    "gs5": ["clinical_sex", "clinical_age_at_diagnosis", "ctn_stage_7ed_modified",
+            "chemo_cetuximab_agent", "smoking_category", "tumor_region", "hpv_status"]
+}
+
+# Covariates describing the treatment of the patient, compared by /treatment_comparison
+treatment_covariates = [
+    "surge_undergone_cancer_surgery",
+    "radio_radiotherapy_treatment",
+    "chemo_chemotherapy_treatment",
+    "chemo_platin_agent",
+    "chemo_cetuximab_agent"
+]
+
+# Dictionaries for gene signature scores for overall survival (OS) and disease-free survival (DFS),
+# mapping each gs_score level to the score value of the models.
+gs_score_levels = {
+    "gs1": {
+        "os": {"-2": -0.2931846, "-1": 0.4036082, "0": 1.100401, "1": 1.7971937, "2": 2.4939865},
+        "dfs": {"-2": -0.2431567, "-1": 0.4148494, "0": 1.0728555, "1": 1.7308616, "2": 2.3888677}
+    },
+    "gs2": {
+        "os": {"-2": -43.54348, "-1": -40.06991, "0": -36.59634, "1": -33.12277, "2": -29.6492},
+        "dfs": {"-2": -43.34192, "-1": -39.94582, "0": -36.54972, "1": -33.15362, "2": -29.75752}
+    },
+    "gs3": {
+        "os": {"-2": -0.26048004, "-1": -0.08093769, "0": 0.09860467, "1": 0.27814702, "2": 0.45768938},
+        "dfs": {"-2": -0.26653957, "-1": -0.08628749, "0": 0.0939646, "1": 0.27421669, "2": 0.45446877}
+    },
+    "gs4": {
+        "os": {"-2": -1.6086046, "-1": -1.109999, "0": -0.6113933, "1": -0.1127877, "2": 0.3858179},
+        "dfs": {"-2": -1.5821354, "-1": -1.1019201, "0": -0.6217047, "1": -0.1414894, "2": 0.338726}
+    },
+    "gs5": {
+        "os": {"-2": -2.144831, "-1": 1.39765, "0": 4.940131, "1": 8.482613, "2": 12.025094},
+        "dfs": {"-2": -1.836707, "-1": 1.598949, "0": 5.034605, "1": 8.470261, "2": 11.905917}
+    }
+}
+
+
+class Scenario:
+    """
+    A clinical scenario and the endpoint serving it.
+
+    Args:
+        clinical_scenario (str): The clinical scenario code, see clinical_scenarios.
+        endpoint (str): The name of the endpoint.
+        covariates (Sequence[str]): The clinical covariates of the model queries.
+        gene_signature_types (Sequence[str]): The accepted gene_signature_type values.
+        censoring_times (Sequence[str]): The accepted censoring times. With a single one,
+            the censoring_time of the request is ignored.
+        hpv_status (Optional[str]): The HPV status of every patient of the scenario,
+            derived from the tumor region when None.
+        signature_type_error (Optional[str]): The error returned for another gene_signature_type.
+    """
+
+    def __init__(self, clinical_scenario: str, endpoint: str, covariates: Sequence[str],
+                 gene_signature_types: Sequence[str] = ("none",), censoring_times: Sequence[str] = ("24", "60"),
+                 hpv_status: Optional[str] = None, signature_type_error: Optional[str] = None):
+        self.clinical_scenario = clinical_scenario
+        self.endpoint = endpoint
+        self.covariates = list(covariates)
+        self.gene_signature_types = list(gene_signature_types)
+        self.censoring_times = list(censoring_times)
+        self.hpv_status = hpv_status
+        self.signature_type_error = signature_type_error
+
+    @property
+    def gene_signature(self) -> Optional[str]:
+        """
+        The gene signature of the scenario, e.g. "gs1", or None for the clinical model.
+        """
+        prefix = clinical_scenarios[self.clinical_scenario]
+        return prefix if prefix.startswith("gs") else None
+
+    @property
+    def treatments(self) -> List[str]:
+        """
+        The treatment covariates of the scenario.
+        """
+        return [field for field in self.covariates if field in treatment_covariates]
+
+
+class ModelSpec:
+    """
+    A model of the registry: the scenario options it stands for and the fields of its queries.
+    """
+
+    def __init__(self, name: str, scenario: Scenario, outcome: str, gene_signature_type: str, censoring_time: str):
+        self.name = name
+        self.scenario = scenario
+        self.outcome = outcome
+        self.gene_signature_type = gene_signature_type
+        self.censoring_time = censoring_time
+
+        # The gs*_class or gs*_score field of the model, None for the clinical model
+        self.term = None if gene_signature_type == "none" else scenario.gene_signature + "_" + gene_signature_type
+        self.covariates = scenario.covariates + ([self.term] if self.term else [])
+        self.score_levels = gs_score_levels[scenario.gene_signature][outcome] if gene_signature_type == "score" else None
+
+
+class ModelRegistry:
+    """
+    The models of every scenario, keyed on model name and on the options selecting them.
+    """
+
+    def __init__(self, scenarios: Sequence[Scenario]):
+        self.scenarios: Dict[str, Scenario] = {scenario.endpoint: scenario for scenario in scenarios}
+        self.models: Dict[str, ModelSpec] = {}
+        self._selections: Dict[tuple, ModelSpec] = {}
+
+        for scenario in scenarios:
+            for gene_signature_type in scenario.gene_signature_types:
+                for outcome in OUTCOMES:
+                    for censoring_time in scenario.censoring_times:
+                        name = select_model(scenario.clinical_scenario, outcome, gene_signature_type, censoring_time)
+                        model = ModelSpec(name, scenario, outcome, gene_signature_type, censoring_time)
+                        self.models[name] = model
+                        self._selections[(scenario.clinical_scenario, outcome, gene_signature_type,
+                                          censoring_time)] = model
+
+    def __contains__(self, model_name: str) -> bool:
+        return model_name in self.models
+
+    def resolve(self, clinical_scenario: str, outcome: str, gene_signature_type: str, censoring_time) -> ModelSpec:
+        """
+        Looks up the model selected by the options of a request.
+
+        Args:
+            clinical_scenario (str): The clinical scenario code.
+            outcome (str): "os" or "dfs".
+            gene_signature_type (str): "none", "class" or "score".
+            censoring_time: The censoring time in months, as a string or integer.
+
+        Returns:
+            ModelSpec: The selected model.
+
+        Raises:
+            KeyError: If no model matches the options.
+
+        Examples:
+            >>> model_registry.resolve("2", "os", "score", 24).covariates[-1]
+            'gs1_score'
+        """
+        return self._selections[(clinical_scenario, outcome, gene_signature_type, str(censoring_time))]
+
+
+model_registry = ModelRegistry([
+    Scenario("1", "base_model", clinical_covariates),
+    Scenario("2", "hpv_negative", clinical_covariates, ["class", "score"], hpv_status="negative",
+             signature_type_error="Bad request: Score or class required."),
+    Scenario("3", "hpv_positive", clinical_covariates, ["score"], ["24"], hpv_status="positive",
+             signature_type_error="Bad request: only score is accepted."),
+    Scenario("4", "radiosensitivity", clinical_covariates, ["class", "score"],
+             signature_type_error="Bad request: Score or class required."),
+    Scenario("5", "chemosensitivity_platinum", chemosensitivity_covariates["gs4"], ["score"], ["24"],
+             signature_type_error="Bad request: only score available for this gene signature."),
+    Scenario("6", "chemosensitivity_cetuximab", chemosensitivity_covariates["gs5"], ["score"], ["24"],
+             signature_type_error="Bad request: only score available for this gene signature.")
+])
+
+
+def list_model_names() -> List[str]:
+    """
+    Lists every model name the scenario endpoints can select.
+
+    Returns:
+        List[str]: The model names, one per trajectory collection.
+
+    Examples:
+        >>> list_model_names()[:2]
+        ['clinical_base_os_24m', 'clinical_base_os_60m']
+    """
+    return list(model_registry.models)
+
+
+def model_covariates(model_name: str) -> List[str]:
+    """
+    Returns the fields the endpoints filter on for a given model.
+
+    Args:
+        model_name (str): The model name, as returned by select_model.
+
+    Returns:
+        List[str]: The covariate fields of the model query, excluding 'model'.
+
+    Examples:
+        >>> model_covariates("gs1_class_interaction_os_24m")[-1]
+        'gs1_class'
+    """
+    return list(model_registry.models[model_name].covariates)
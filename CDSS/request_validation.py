@@ -0,0 +1,278 @@
+"""
+Request body validators compiled from the Swagger schemas in models.yml.
+
+The schemas are parsed once at startup into one check per field (type, enum,
+range), so malformed requests are rejected before any database work. Fields
+the schema documents in a nested object (e.g. gs1.gs_class) are sent at the
+top level of the body, as the endpoints read them, and are validated there.
+
+Two quirks of the schemas are handled when compiling:
+
+- PyYAML reads the unquoted yes/no enum values as booleans, they are mapped back
+  to the "yes"/"no" strings the API expects;
+- integer fields are also accepted as integer-like strings, as gs_score is sent
+  as "-2".."2" and the endpoints convert the age with int().
+"""
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+import yaml
+
+# Fields that may hold the gene signature score of a patient, see gs_score_value
+SCORE_FIELDS = ("gs_score", "gs_score_value", "gene_expression")
+
+
+def as_integer(value: object) -> Optional[int]:
+    """
+    Returns the integer held by a JSON value, or None if it is not one.
+
+    Examples:
+        >>> as_integer(24), as_integer("-2"), as_integer(60.0), as_integer("24.5"), as_integer(True)
+        (24, -2, 60, None, None)
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    return None
+
+
+def is_number(value: object) -> bool:
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float)):
+        return True
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def enum_values(schema: Mapping[str, object]) -> List[object]:
+    """
+    Returns the enum of a field schema, with the booleans of unquoted yes/no mapped back to strings.
+    """
+    values = []
+    for value in schema["enum"]:
+        if isinstance(value, bool) and schema.get("type") == "string":
+            value = "yes" if value else "no"
+        values.append(value)
+    return values
+
+
+def compile_field(name: str, schema: Mapping[str, object]) -> Callable[[object], Optional[str]]:
+    """
+    Compiles the schema of a field into a check returning an error message, or None if the value is valid.
+
+    Args:
+        name (str): The field name, used in the messages.
+        schema (Mapping[str, object]): The Swagger schema of the field.
+
+    Returns:
+        Callable[[object], Optional[str]]: The check of the field values.
+
+    Examples:
+        >>> check = compile_field("clinical_age_at_diagnosis", {"type": "integer", "minimum": 19, "maximum": 93})
+        >>> check("55"), check(17)
+        (None, 'clinical_age_at_diagnosis must be an integer between 19 and 93')
+    """
+    field_type = schema.get("type")
+
+    if field_type == "integer":
+        allowed = {int(value) for value in schema["enum"]} if "enum" in schema else None
+        minimum = schema.get("minimum", float("-inf"))
+        maximum = schema.get("maximum", float("inf"))
+        if allowed is not None:
+            message = name + " must be one of " + ", ".join(str(value) for value in sorted(allowed))
+        else:
+            message = name + " must be an integer between " + str(minimum) + " and " + str(maximum)
+
+        def check(value):
+            integer = as_integer(value)
+            if integer is None or (allowed is not None and integer not in allowed) or not minimum <= integer <= maximum:
+                return message
+            return None
+
+    elif field_type == "number":
+        message = name + " must be a number"
+
+        def check(value):
+            return None if is_number(value) else message
+
+    elif field_type == "string" and "enum" in schema:
+        # Enums listed as numbers (e.g. clinical_scenario) are sent as strings
+        allowed = {str(value) for value in enum_values(schema)}
+        message = name + " must be one of " + ", ".join(str(value) for value in enum_values(schema))
+
+        def check(value):
+            return None if isinstance(value, str) and value in allowed else message
+
+    elif field_type == "string":
+        message = name + " must be a string"
+
+        def check(value):
+            return None if isinstance(value, str) else message
+
+    elif field_type == "object":
+        message = name + " must be an object of numbers"
+
+        def check(value):
+            if isinstance(value, dict) and all(is_number(item) for item in value.values()):
+                return None
+            return message
+
+    elif field_type == "array":
+        message = name + " must be an array"
+
+        def check(value):
+            return None if isinstance(value, list) else message
+
+    else:
+        def check(value):
+            return None
+
+    return check
+
+
+class RequestValidator:
+    """
+    Validates the JSON body of an endpoint.
+
+    Args:
+        properties (Mapping[str, Mapping[str, object]]): The schema of each field.
+        required (Iterable[Sequence[str]]): Groups of fields, at least one field of each group
+            must be given (not null).
+        required_if (Optional[Mapping[Tuple[str, str], Iterable[Sequence[str]]]]): Groups required
+            only when a field has a given value, keyed on (field, value).
+    """
+
+    def __init__(self, properties: Mapping[str, Mapping[str, object]], required: Iterable[Sequence[str]] = (),
+                 required_if: Optional[Mapping[Tuple[str, str], Iterable[Sequence[str]]]] = None):
+        self.checks = {name: compile_field(name, schema) for name, schema in properties.items()}
+        self.required = [tuple(group) for group in required]
+        self.required_if = {condition: [tuple(group) for group in groups]
+                            for condition, groups in (required_if or {}).items()}
+
+    def validate(self, request_data: object) -> None:
+        """
+        Checks a request body.
+
+        Raises:
+            ValueError: With a "Bad request: ..." message, if the body is not valid.
+        """
+        if not isinstance(request_data, dict):
+            raise ValueError("Bad request: a JSON object is required.")
+
+        for field, value in request_data.items():
+            check = self.checks.get(field)
+            if check is not None and value is not None:
+                error = check(value)
+                if error is not None:
+                    raise ValueError("Bad request: " + error + ".")
+
+        groups = list(self.required)
+        for (field, value), conditional_groups in self.required_if.items():
+            if request_data.get(field) == value:
+                groups.extend(conditional_groups)
+
+        for group in groups:
+            if all(request_data.get(field) is None for field in group):
+                raise ValueError("Bad request: " + " or ".join(group) + " is required.")
+
+
+def load_schemas(path: str) -> Dict[str, Dict[str, Mapping[str, object]]]:
+    """
+    Reads the field schemas of the JSON body of every path in a Swagger file.
+
+    Args:
+        path (str): The Swagger file, i.e. models.yml.
+
+    Returns:
+        Dict[str, Dict[str, Mapping[str, object]]]: The schema of each field, keyed on endpoint
+            name (the path without its leading slash). Nested objects with properties are flattened.
+    """
+    with open(path) as schema_file:
+        document = yaml.safe_load(schema_file)
+
+    schemas = {}
+    for path_name, operations in document["paths"].items():
+        for operation in operations.values():
+            body = operation.get("requestBody", {}).get("content", {}).get("application/json", {})
+            properties = {}
+            for name, schema in body.get("schema", {}).get("properties", {}).items():
+                if schema.get("type") == "object" and "properties" in schema:
+                    properties.update(schema["properties"])
+                else:
+                    properties[name] = schema
+            schemas[path_name.strip("/")] = properties
+
+    return schemas
+
+
+def field_levels(schemas: Mapping[str, Mapping[str, Mapping[str, object]]], endpoint: str, field: str) -> List[object]:
+    """
+    Returns the enum of a field of an endpoint, as sent in the requests.
+
+    Examples:
+        >>> field_levels({"base_model": {"chemo_chemotherapy_treatment": {"type": "string", "enum": [True, False]}}},
+        ...              "base_model", "chemo_chemotherapy_treatment")
+        ['yes', 'no']
+    """
+    return enum_values(schemas[endpoint][field])
+
+
+def compile_validators(schemas: Mapping[str, Mapping[str, Mapping[str, object]]],
+                       registry) -> Dict[str, RequestValidator]:
+    """
+    Compiles the validators of the scenario, hazard ratio and RMST endpoints.
+
+    The required fields of a scenario are its covariates in the model registry, and the
+    signature fields of the gene_signature_type requested. Fields a scenario does not read
+    (a fixed censoring time or HPV status) are not validated.
+
+    Args:
+        schemas (Mapping[str, Mapping[str, Mapping[str, object]]]): The field schemas, see load_schemas.
+        registry: The model registry, see model_registry.
+
+    Returns:
+        Dict[str, RequestValidator]: The validators, keyed on endpoint name.
+    """
+    validators = {}
+
+    for endpoint, scenario in registry.scenarios.items():
+        properties = dict(schemas.get(endpoint, {}))
+        required = [("outcome",)] + [(field,) for field in scenario.covariates if field != "hpv_status"]
+        required_if = {}
+
+        if scenario.gene_signature is not None:
+            required.append(("gene_signature_type",))
+            if "class" in scenario.gene_signature_types:
+                required_if[("gene_signature_type", "class")] = [("gs_class",)]
+            required_if[("gene_signature_type", "score")] = [
+                tuple(field for field in SCORE_FIELDS if field in properties)
+            ]
+
+        if len(scenario.censoring_times) > 1:
+            required.append(("censoring_time",))
+        else:
+            properties.pop("censoring_time", None)
+
+        if scenario.hpv_status is None:
+            required_if[("tumor_region", "oropharynx")] = [("hpv_status",)]
+        else:
+            properties.pop("hpv_status", None)
+
+        validators[endpoint] = RequestValidator(properties, required, required_if)
+
+    for endpoint in ("hazard_ratios", "restricted_mean"):
+        properties = schemas.get(endpoint, {})
+        validators[endpoint] = RequestValidator(properties, [(field,) for field in properties])
+
+    return validators
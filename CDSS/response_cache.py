@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+# Returned by ResponseCache.get when the key is not cached.
+MISSING = object()
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache for endpoint results with an optional time to live.
+
+    Keys are the canonical (model_name, covariate key) pairs built by the endpoints.
+    Once maxsize entries are stored, the least recently used one is evicted.
+
+    Examples:
+        >>> cache = ResponseCache(maxsize=2)
+        >>> cache.set(("clinical_base_os_24m", ()), {"time": [0, 12]})
+        >>> cache.get(("clinical_base_os_24m", ()))
+        {'time': [0, 12]}
+        >>> cache.stats()["hits"]
+        1
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable):
+        """
+        Returns the cached value of a key, or MISSING if it is absent or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl is None or entry[1] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+
+    def set(self, key: Hashable, value) -> None:
+        """
+        Stores a value, evicting the least recently used entry when the cache is full.
+        """
+        if self.maxsize <= 0:
+            return
+
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Drops every entry, e.g. after the model data has been reloaded.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Returns the counters used to size the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl
+        }
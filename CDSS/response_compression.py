@@ -0,0 +1,96 @@
+"""
+Compression of the response bodies, negotiated with the Accept-Encoding header.
+
+gzip is always available; brotli (br) and Zstandard (zstd) are offered when the
+brotli and zstandard packages are installed. Bodies smaller than the size
+threshold are sent uncompressed, as compressing them saves less than it costs.
+"""
+import gzip
+from typing import List, Optional
+
+GZIP = "gzip"
+BROTLI = "br"
+ZSTD = "zstd"
+
+# Encodings in order of preference when the client accepts several with the same quality
+ENCODINGS = [ZSTD, BROTLI, GZIP]
+
+# Compression levels, favouring speed: the bodies are compressed on every request
+LEVELS = {GZIP: 6, BROTLI: 5, ZSTD: 3}
+
+
+def compress_gzip(body: bytes) -> bytes:
+    # mtime=0 keeps the output, and thus the ETag of the response, deterministic
+    return gzip.compress(body, compresslevel=LEVELS[GZIP], mtime=0)
+
+
+def compress_brotli(body: bytes) -> bytes:
+    import brotli
+
+    return brotli.compress(body, quality=LEVELS[BROTLI])
+
+
+def compress_zstd(body: bytes) -> bytes:
+    import zstandard
+
+    return zstandard.ZstdCompressor(level=LEVELS[ZSTD]).compress(body)
+
+
+compressors = {GZIP: compress_gzip, BROTLI: compress_brotli, ZSTD: compress_zstd}
+
+
+def available_encodings() -> List[str]:
+    """
+    Lists the encodings whose library is installed, in order of preference.
+    """
+    encodings = []
+    for encoding in ENCODINGS:
+        try:
+            compressors[encoding](b"")
+        except ImportError:
+            continue
+        encodings.append(encoding)
+    return encodings
+
+
+def negotiate_encoding(accept_encodings, encodings: List[str]) -> Optional[str]:
+    """
+    Selects the content encoding from the Accept-Encoding header of the request.
+
+    Args:
+        accept_encodings: The parsed Accept-Encoding header, i.e. flask.request.accept_encodings.
+        encodings (List[str]): The available encodings, see available_encodings.
+
+    Returns:
+        Optional[str]: The encoding, or None to send the body uncompressed.
+
+    Examples:
+        >>> from werkzeug.datastructures import Accept
+        >>> negotiate_encoding(Accept([("gzip", 1), ("br", 1)]), [ZSTD, BROTLI, GZIP])
+        'br'
+        >>> negotiate_encoding(Accept([("gzip", 1), ("br", 0.5)]), [ZSTD, BROTLI, GZIP])
+        'gzip'
+        >>> negotiate_encoding(Accept([("identity", 1)]), [GZIP]) is None
+        True
+    """
+    return accept_encodings.best_match(encodings)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Examples:
+        >>> gzip.decompress(compress(b'{"time":[0,12]}', GZIP))
+        b'{"time":[0,12]}'
+    """
+    return compressors[encoding](body)
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """
+    Derives the ETag of the compressed representation of a response from the ETag of its body.
+
+    Examples:
+        >>> encoded_etag("acd76ac5", GZIP)
+        'acd76ac5-gzip'
+    """
+    return etag + "-" + encoding
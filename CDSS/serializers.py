@@ -0,0 +1,185 @@
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # The standard library encoder is used instead
+    orjson = None
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+MSGPACK_MIMETYPE = "application/msgpack"
+JSON_MIMETYPE = "application/json"
+
+# Response formats in order of preference when the client accepts several, JSON being the default.
+MIMETYPES = [JSON_MIMETYPE, ARROW_MIMETYPE, MSGPACK_MIMETYPE]
+
+# Columns that are not float64 in the binary formats
+INTEGER_COLUMNS = {"time"}
+STRING_COLUMNS = {"comparison"}
+
+# Columns rounded by the precision parameter of the requests
+PRECISION_COLUMNS = ("survival_probability", "ci_lower", "ci_upper")
+MAX_PRECISION = 17
+
+
+def negotiate(accept_mimetypes) -> str:
+    """
+    Selects the response format from the Accept header of the request.
+
+    Args:
+        accept_mimetypes: The parsed Accept header, i.e. flask.request.accept_mimetypes.
+
+    Returns:
+        str: One of MIMETYPES, JSON when the client has no preference.
+    """
+    return accept_mimetypes.best_match(MIMETYPES, default=JSON_MIMETYPE) or JSON_MIMETYPE
+
+
+def to_json(payload: object) -> bytes:
+    """
+    Encodes a payload as compact JSON with sorted keys, as jsonify did, with orjson when it is installed.
+
+    NaN and infinite values are encoded as null by orjson, and as NaN and Infinity by
+    the standard library.
+
+    Examples:
+        >>> to_json({"time": [0, 12], "survival_probability": [1.0, 0.95]})
+        b'{"survival_probability":[1.0,0.95],"time":[0,12]}'
+    """
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_SORT_KEYS)
+    return json.dumps(payload, separators=(",", ":"), sort_keys=True).encode()
+
+
+def round_significant(values: List[Optional[float]], digits: int) -> List[Optional[float]]:
+    """
+    Rounds values to a number of significant digits.
+
+    Examples:
+        >>> round_significant([0.987654321, 0.0123456789, 0.0, None, 123456.0], 3)
+        [0.988, 0.0123, 0.0, None, 123000.0]
+    """
+    array = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        exponents = digits - 1 - np.floor(np.log10(np.abs(array)))
+    exponents = np.where(np.isfinite(exponents), exponents, 0)
+    # Dividing by an exact power of ten rounds correctly, e.g. to 0.89 rather than 0.8899999999999999
+    scales = 10.0 ** np.abs(exponents)
+    rounded = np.where(exponents >= 0, np.round(array * scales) / scales, np.round(array / scales) * scales)
+
+    if np.isnan(array).any():
+        return [None if value is None else rounded_value for value, rounded_value in zip(values, rounded.tolist())]
+    return rounded.tolist()
+
+
+def round_columns(payload: Dict[str, object], digits: Optional[int]) -> Dict[str, object]:
+    """
+    Rounds the survival probabilities and their confidence bounds of a payload, see PRECISION_COLUMNS.
+
+    Args:
+        payload (Dict[str, object]): Columns, as built by the endpoints. It is not modified,
+            as it may be cached.
+        digits (Optional[int]): The number of significant digits, None to keep full precision.
+
+    Returns:
+        Dict[str, object]: The payload with its rounded columns.
+
+    Examples:
+        >>> round_columns({"time": [0, 12], "survival_probability": [1.0, 0.912345]}, 2)
+        {'time': [0, 12], 'survival_probability': [1.0, 0.91]}
+    """
+    if digits is None or not any(column in payload for column in PRECISION_COLUMNS):
+        return payload
+    return {name: round_significant(values, digits) if name in PRECISION_COLUMNS else values
+            for name, values in payload.items()}
+
+
+def column_type(name: str, values: List[object]) -> str:
+    """
+    Returns the type of a response column in the binary formats.
+
+    Examples:
+        >>> column_type("time", [0, 12, 24])
+        'int32'
+        >>> column_type("time", [0, 0.5, 1])
+        'float64'
+        >>> column_type("hazard_ratio", [1.5, 0.6])
+        'float64'
+    """
+    if name in STRING_COLUMNS:
+        return "string"
+    if name in INTEGER_COLUMNS and all(float(value).is_integer() for value in values):
+        return "int32"
+    return "float64"
+
+
+def to_arrow(payload: Dict[str, List[object]]) -> bytes:
+    """
+    Encodes a column-oriented payload as an Arrow IPC stream with a single record batch.
+
+    Args:
+        payload (Dict[str, List[object]]): Columns of equal length, as built by the endpoints.
+
+    Returns:
+        bytes: The Arrow stream.
+    """
+    import pyarrow as pa
+
+    arrays = []
+    for name, values in payload.items():
+        dtype = column_type(name, values)
+        if dtype == "int32":
+            values = [int(value) for value in values]
+        arrays.append(pa.array(values, type=getattr(pa, dtype)()))
+
+    batch = pa.RecordBatch.from_arrays(arrays, names=list(payload))
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+
+    return sink.getvalue().to_pybytes()
+
+
+def to_msgpack(payload: Dict[str, List[object]]) -> bytes:
+    """
+    Encodes a column-oriented payload as a MessagePack map of arrays, with floats as float64.
+
+    Args:
+        payload (Dict[str, List[object]]): Columns, as built by the endpoints.
+
+    Returns:
+        bytes: The MessagePack document.
+    """
+    import msgpack
+
+    columns = {}
+    for name, values in payload.items():
+        dtype = column_type(name, values)
+        if dtype == "int32":
+            values = [int(value) for value in values]
+        elif dtype == "float64":
+            values = [float(value) for value in values]
+        columns[name] = values
+
+    return msgpack.packb(columns, use_single_float=False)
+
+
+def encode(payload: Dict[str, List[object]], mimetype: str) -> Optional[bytes]:
+    """
+    Encodes a payload in one of the binary formats.
+
+    Args:
+        payload (Dict[str, List[object]]): Columns, as built by the endpoints.
+        mimetype (str): ARROW_MIMETYPE or MSGPACK_MIMETYPE.
+
+    Returns:
+        Optional[bytes]: The encoded payload, or None if the library of the format is not installed.
+    """
+    encoders = {ARROW_MIMETYPE: to_arrow, MSGPACK_MIMETYPE: to_msgpack}
+
+    try:
+        return encoders[mimetype](payload)
+    except ImportError:
+        return None
@@ -0,0 +1,256 @@
+"""
+Versioned on-disk snapshots of the model data, served through memory-mapped files.
+
+A snapshot directory holds one .npy file per numeric column, shared by all models,
+and a manifest.json with the key index of every model: for each covariate tuple
+(trajectories) or model name (hazard ratios, RMST) the offset and length of its
+rows in the column files. The column files are opened with mmap, so the worker
+processes of a server share one physical copy of the data through the page cache.
+
+Layout:
+
+    <root>/CURRENT                  name of the snapshot served by default
+    <root>/<version>/manifest.json
+    <root>/<version>/<table>.<column>.npy
+"""
+import json
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+from model_data import versioned_name
+from trajectory_store import TRAJECTORY_FIELDS
+
+MANIFEST = "manifest.json"
+CURRENT = "CURRENT"
+
+# Numeric and string columns of the hazard_ratios and rmst collections, and the field naming the model
+HAZARD_RATIO_COLUMNS = (("HR", "HR_upper95", "HR_lower95", "P_value"), ("comparison",), "model")
+RESTRICTED_MEAN_COLUMNS = (("RMST_diff", "RMST_diff_upper", "RMST_diff_lower", "timepoint"), ("comparison",), "mod_name")
+
+# Numeric columns returned as integers when all their values are integral
+INTEGER_COLUMNS = {"time", "timepoint"}
+
+
+def column_path(directory: str, table: str, column: str) -> str:
+    return os.path.join(directory, table + "." + column + ".npy")
+
+
+def write_columns(directory: str, table: str, columns: Iterable[str], groups: Iterable[Tuple[object, List[dict]]],
+                  n_rows: int) -> Tuple[List[list], List[str]]:
+    """
+    Writes grouped documents into memory-mappable float64 column files.
+
+    Args:
+        directory (str): The snapshot directory.
+        table (str): The name prefix of the column files.
+        columns (Iterable[str]): The numeric fields to store.
+        groups (Iterable[Tuple[object, List[dict]]]): (key, documents) pairs, the key being JSON serializable.
+        n_rows (int): The total number of documents, used to allocate the files.
+
+    Returns:
+        Tuple[List[list], List[str]]: The [key, offset, length] index of the groups, and the
+            INTEGER_COLUMNS holding only integral values, to be returned as integers.
+    """
+    columns = list(columns)
+    arrays = {
+        column: np.lib.format.open_memmap(column_path(directory, table, column), mode="w+",
+                                          dtype=np.float64, shape=(n_rows,))
+        for column in columns
+    }
+
+    index = []
+    integer_columns = INTEGER_COLUMNS.intersection(columns)
+    offset = 0
+    for key, documents in groups:
+        for column in columns:
+            values = [document[column] for document in documents]
+            arrays[column][offset:offset + len(documents)] = values
+            if column in integer_columns and not all(float(value).is_integer() for value in values):
+                integer_columns.discard(column)
+        index.append([key, offset, len(documents)])
+        offset += len(documents)
+
+    for array in arrays.values():
+        array.flush()
+
+    return index, [column for column in columns if column in integer_columns]
+
+
+def export_snapshot(database, root: str, model_names: Iterable[str], model_covariates,
+                    version: Optional[str] = None, collection_version: Optional[str] = None) -> str:
+    """
+    Dumps the trajectories, hazard ratios and RMST of every model into a new snapshot.
+
+    Args:
+        database: The MongoDB database holding the model data.
+        root (str): The directory holding the snapshot versions.
+        model_names (Iterable[str]): The trajectory models to export, see list_model_names.
+        model_covariates: Function returning the covariate fields of a model, see model_covariates.
+        version (Optional[str]): The snapshot name, a UTC timestamp by default.
+        collection_version (Optional[str]): The version of the collections to export, see model_data.
+
+    Returns:
+        str: The directory of the new snapshot.
+    """
+    version = version or datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    directory = os.path.join(root, version)
+    os.makedirs(directory)
+
+    manifest = {"version": version, "created": datetime.now(timezone.utc).isoformat()}
+
+    # Trajectories: one model in memory at a time, appended to the shared column files
+    model_names = list(model_names)
+    collections = {name: database[versioned_name(collection_version, name)]
+                   for name in model_names + ["hazard_ratios", "rmst"]}
+    n_rows = sum(collections[model_name].count_documents({"model": model_name}) for model_name in model_names)
+
+    def trajectory_groups():
+        for model_name in model_names:
+            covariates = model_covariates(model_name)
+            projection = dict({field: 1 for field in covariates + list(TRAJECTORY_FIELDS)}, _id=0)
+
+            trajectories: Dict[tuple, List[dict]] = {}
+            for timepoint in collections[model_name].find({"model": model_name}, projection):
+                key = tuple(sorted((field, timepoint.get(field)) for field in covariates))
+                trajectories.setdefault(key, []).append(timepoint)
+
+            for key, timepoints in trajectories.items():
+                yield [model_name, [list(pair) for pair in key]], timepoints
+
+    index, integer_columns = write_columns(directory, "trajectories", TRAJECTORY_FIELDS, trajectory_groups(), n_rows)
+
+    manifest["models"] = {model_name: {"covariates": model_covariates(model_name), "index": []}
+                          for model_name in model_names}
+    for (model_name, key), offset, length in index:
+        manifest["models"][model_name]["index"].append([key, offset, length])
+    manifest["trajectories"] = {"integer_columns": integer_columns}
+
+    # Hazard ratios and restricted mean survival times, indexed on model name
+    for table, (numeric, strings, model_field) in (("hazard_ratios", HAZARD_RATIO_COLUMNS),
+                                                   ("rmst", RESTRICTED_MEAN_COLUMNS)):
+        groups: Dict[str, List[dict]] = {}
+        for document in collections[table].find({}, {"_id": 0}):
+            groups.setdefault(document[model_field], []).append(document)
+
+        index, integer_columns = write_columns(directory, table, numeric, groups.items(),
+                                               sum(len(documents) for documents in groups.values()))
+        manifest[table] = {
+            "index": index,
+            "integer_columns": integer_columns,
+            "strings": {
+                column: [document[column] for documents in groups.values() for document in documents]
+                for column in strings
+            }
+        }
+
+    with open(os.path.join(directory, MANIFEST), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    # Point CURRENT to the new snapshot only once it is complete
+    with open(os.path.join(root, CURRENT + ".tmp"), "w") as current_file:
+        current_file.write(version)
+    os.replace(os.path.join(root, CURRENT + ".tmp"), os.path.join(root, CURRENT))
+
+    return directory
+
+
+def resolve_snapshot(path: str) -> str:
+    """
+    Returns the snapshot directory for a snapshot or a root directory holding a CURRENT file.
+    """
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        return path
+
+    with open(os.path.join(path, CURRENT)) as current_file:
+        return os.path.join(path, current_file.read().strip())
+
+
+class TrajectoryIndex:
+    """
+    Key index of the trajectories of one model in a snapshot.
+
+    Has the same get(key) interface as the per-model dictionaries of TrajectoryStore,
+    returning slices of the memory-mapped columns instead of in-memory arrays.
+    """
+
+    def __init__(self, columns: Mapping[str, np.ndarray], model: Dict[str, object], integer_columns: Iterable[str]):
+        self._columns = columns
+        self._integer_columns = list(integer_columns)
+        self._index = {
+            tuple(tuple(pair) for pair in key): (offset, length)
+            for key, offset, length in model["index"]
+        }
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, key: tuple) -> Optional[Dict[str, np.ndarray]]:
+        if key not in self._index:
+            return None
+
+        offset, length = self._index[key]
+        trajectory = {field: self._columns[field][offset:offset + length] for field in TRAJECTORY_FIELDS}
+        for field in self._integer_columns:
+            trajectory[field] = trajectory[field].astype(np.int64)
+
+        return trajectory
+
+
+class Snapshot:
+    """
+    Read-only view of a snapshot directory, with its column files opened through mmap.
+    """
+
+    def __init__(self, path: str):
+        self.directory = resolve_snapshot(path)
+
+        with open(os.path.join(self.directory, MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        self.version = manifest["version"]
+
+        columns = {
+            field: np.load(column_path(self.directory, "trajectories", field), mmap_mode="r")
+            for field in TRAJECTORY_FIELDS
+        }
+        self.models = {
+            model_name: TrajectoryIndex(columns, model, manifest["trajectories"]["integer_columns"])
+            for model_name, model in manifest["models"].items()
+        }
+
+        self._tables = {}
+        for table, (numeric, strings, _) in (("hazard_ratios", HAZARD_RATIO_COLUMNS),
+                                             ("rmst", RESTRICTED_MEAN_COLUMNS)):
+            self._tables[table] = {
+                "index": {model_name: (offset, length) for model_name, offset, length in manifest[table]["index"]},
+                "columns": {column: np.load(column_path(self.directory, table, column), mmap_mode="r")
+                            for column in numeric},
+                "integer_columns": manifest[table]["integer_columns"],
+                "strings": manifest[table]["strings"]
+            }
+
+    def documents(self, table: str, model_name: str) -> List[Dict[str, object]]:
+        """
+        Returns the rows of a model in the hazard_ratios or rmst table, shaped like the MongoDB documents.
+
+        Args:
+            table (str): "hazard_ratios" or "rmst".
+            model_name (str): The model name, as returned by select_model.
+
+        Returns:
+            List[Dict[str, object]]: The documents, empty if the model is not in the snapshot.
+        """
+        table = self._tables[table]
+        if model_name not in table["index"]:
+            return []
+
+        offset, length = table["index"][model_name]
+        columns = {column: values[offset:offset + length].tolist() for column, values in table["columns"].items()}
+        for column in table["integer_columns"]:
+            columns[column] = [int(value) for value in columns[column]]
+        columns.update({column: values[offset:offset + length] for column, values in table["strings"].items()})
+
+        return [{column: values[row] for column, values in columns.items()} for row in range(length)]
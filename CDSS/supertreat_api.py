@@ -1,6 +1,41 @@
-from flask import Flask, request, jsonify
+import contextvars
+import csv
+import functools
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from flask import Flask, Response, g, redirect, request, jsonify, stream_with_context
 from flasgger import Swagger, swag_from
 from flask_cors import CORS
+import numpy as np
+from pymongo import MongoClient
+
+from cohort import DEFAULT_QUANTILES, aggregate, expand_distribution, survival_at, time_grid
+from compact_storage import (COMPACT_PROJECTION, GRID_COLLECTION, GRID_FIELD, collection_migrations,
+                             compact_collection_name, decode_documents, load_trajectories, read_grid)
+from gene_signature_scores import read_delimited, read_parquet, score_levels, signatures
+from metrics import (count_cache, count_trajectories, current_timings, finish_request, registry as metrics_registry,
+                     start_request, timed, timed_cursor)
+from model_data import ModelData, read_current_version, request_model_data
+from model_registry import OUTCOMES, Scenario, gs_score_levels, list_model_names, model_covariates, model_registry
+from request_validation import SCORE_FIELDS, compile_validators, enum_values, field_levels, load_schemas
+from response_cache import MISSING, ResponseCache
+from response_compression import ENCODINGS, available_encodings, compress, encoded_etag, negotiate_encoding
+from serializers import (JSON_MIMETYPE, MAX_PRECISION, PRECISION_COLUMNS, encode, negotiate, round_columns,
+                         round_significant, to_json)
+from snapshot import Snapshot, resolve_snapshot
+from trajectory_store import TRAJECTORY_FIELDS, TRAJECTORY_PROJECTION, make_key
+from warmup import warm_up
 
 app = Flask(__name__)
 
@@ -8,68 +43,40 @@ app.config['SWAGGER'] = {
      'title': 'SuPerTreat API',
      'uiversion': 2
  }
+
+# Deployment settings, overridden by environment variables or configure_app(config)
+app.config.update(
+    MONGO_URI=os.environ.get('SUPERTREAT_MONGO_URI', 'mongodb://localhost:27017/'),
+    MONGO_DATABASE=os.environ.get('SUPERTREAT_MONGO_DATABASE', 'supertreat'),
+    MONGO_MAX_POOL_SIZE=int(os.environ.get('SUPERTREAT_MONGO_MAX_POOL_SIZE', 100)),
+    MONGO_MIN_POOL_SIZE=int(os.environ.get('SUPERTREAT_MONGO_MIN_POOL_SIZE', 0)),
+    MONGO_TIMEOUT_MS=int(os.environ.get('SUPERTREAT_MONGO_TIMEOUT_MS', 5000)),
+    MONGO_READ_PREFERENCE=os.environ.get('SUPERTREAT_MONGO_READ_PREFERENCE', 'primaryPreferred'),
+    PRELOAD_TRAJECTORIES=os.environ.get('SUPERTREAT_PRELOAD', '0') == '1',
+    SNAPSHOT_PATH=os.environ.get('SUPERTREAT_SNAPSHOT'),
+    COMPUTE_TRAJECTORIES=os.environ.get('SUPERTREAT_COMPUTE', '0') == '1',
+    STREAM_BATCH_SIZE=int(os.environ.get('SUPERTREAT_STREAM_BATCH_SIZE', 1000)),
+    COMPACT_STORAGE=os.environ.get('SUPERTREAT_COMPACT', '0') == '1',
+    WARMUP=os.environ.get('SUPERTREAT_WARMUP', '0') == '1',
+    WARMUP_WORKERS=int(os.environ['SUPERTREAT_WARMUP_WORKERS']) if os.environ.get('SUPERTREAT_WARMUP_WORKERS') else None,
+    COHORT_MAX_PATIENTS=int(os.environ.get('SUPERTREAT_COHORT_MAX_PATIENTS', 10000)),
+    CACHE_SIZE=int(os.environ.get('SUPERTREAT_CACHE_SIZE', 4096)),
+    CACHE_TTL=float(os.environ['SUPERTREAT_CACHE_TTL']) if os.environ.get('SUPERTREAT_CACHE_TTL') else None,
+    SERVER_TIMING=os.environ.get('SUPERTREAT_SERVER_TIMING', '0') == '1',
+    DATA_VERSION=os.environ.get('SUPERTREAT_DATA_VERSION'),
+    HTTP_MAX_AGE=int(os.environ.get('SUPERTREAT_HTTP_MAX_AGE', 300)),
+    COMPRESSION=os.environ.get('SUPERTREAT_COMPRESSION', '1') == '1',
+    COMPRESSION_MIN_SIZE=int(os.environ.get('SUPERTREAT_COMPRESSION_MIN_SIZE', 1024)),
+    RELOAD_INTERVAL=float(os.environ['SUPERTREAT_RELOAD_INTERVAL']) if os.environ.get('SUPERTREAT_RELOAD_INTERVAL') else None,
+    RELOAD_TOKEN=os.environ.get('SUPERTREAT_RELOAD_TOKEN'),
+    REPORT_WORKERS=int(os.environ.get('SUPERTREAT_REPORT_WORKERS', 16)),
+    # Werkzeug debugger and reloader of the development server, never to be enabled in production
+    DEBUG=os.environ.get('SUPERTREAT_DEBUG', '0') == '1'
+)
 CORS(app)
 api = Swagger(app)
 
-def select_model(clinical_scenario: str, outcome: str, gene_signature_type: str, censoring_time: int) -> str:
-    """
-    Selects the appropriate model name based on the given parameters.
-
-    Args:
-        clinical_scenario (str): The clinical scenario code.
-        outcome (str): The desired outcome.
-        gene_signature_type (str): The type of gene signature.
-        censoring_time (int): The censoring time in minutes.
-
-    Returns:
-        str: The model name based on the given parameters.
-
-    Raises:
-        KeyError: If the provided clinical scenario or gene signature type is not valid.
-
-    Examples:
-        >>> select_model("3", "dfs", "score", 24)
-        'gs2_score_interaction_dfs_24m'
-
-        >>> select_model("1", "os", "none", 60)
-        'clinical_base_os_60m'
-    """
-    clinical_scenarios = {
-        "1": "clinical_base",
-        "2": "gs1",
-        "3": "gs2",
-        "4": "gs3",
-        "5": "gs4",
-        "6": "gs5"
-    }
-
-    gene_signature_types = {
-        "none": "",
-        "class": "class_interaction_",
-        "score": "score_interaction_"
-    }
-
-    if clinical_scenario == "1":
-        gene_signature_type = "none"
-
-    try:
-        model_name = (
-            clinical_scenarios[clinical_scenario]
-            + "_"
-            + gene_signature_types[gene_signature_type]
-            + outcome
-            + "_"
-            + str(censoring_time)
-            + "m"
-        )
-    except KeyError as e:
-        raise KeyError("Invalid clinical scenario or gene signature type.") from e
-
-    return model_name
-
-
-
-from typing import Dict, Iterable, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 def get_patient_trajectory(single_patient: Iterable[Dict[str, Union[float, int]]]) -> Dict[str, Iterable[Union[float, int]]]:
     """
@@ -117,517 +124,1382 @@ def get_patient_trajectory(single_patient: Iterable[Dict[str, Union[float, int]]
     return result
 
 
-def check_tumor_region(request) -> str:
+# The model data served: its version, in-memory trajectories and caches, replaced as a whole by reload_model_data.
+model_data = ModelData()
+
+# Endpoint results keyed on (data version, model_name, covariate key), see fetch_trajectory.
+# CACHE_SIZE=0 disables the cache, CACHE_TTL is in seconds.
+response_cache = ResponseCache(maxsize=app.config['CACHE_SIZE'], ttl=app.config['CACHE_TTL'])
+
+
+def current_model_data() -> ModelData:
     """
-    Checks the tumor region and returns the corresponding HPV status.
+    Returns the model data bound to the request being served, or the current model data outside of a request.
+    """
+    data = request_model_data.get()
+    return data if data is not None else model_data
+
+
+def invalidate_caches() -> None:
+    """
+    Drops every cached result, to be called whenever the model data is modified in place.
+    """
+    response_cache.clear()
+    model_data.clear()
+
+
+# MongoDB client of the current process, see get_db
+mongo_client = None
+mongo_client_pid = None
+mongo_client_lock = threading.Lock()
+
+
+def mongo_client_options(config) -> Dict[str, object]:
+    """
+    Builds the connection pool options of the MongoDB clients from the app configuration.
 
     Args:
-        tumor_region (str): The tumor region.
+        config: The Flask configuration holding the MONGO_* settings.
 
     Returns:
-        str: The HPV status. Returns 'unknown' if the tumor region is not 'oropharynx'.
+        Dict[str, object]: Keyword arguments for MongoClient (or motor's AsyncIOMotorClient).
+    """
+    return {
+        "maxPoolSize": config['MONGO_MAX_POOL_SIZE'],
+        "minPoolSize": config['MONGO_MIN_POOL_SIZE'],
+        "serverSelectionTimeoutMS": config['MONGO_TIMEOUT_MS'],
+        "connectTimeoutMS": config['MONGO_TIMEOUT_MS'],
+        "socketTimeoutMS": config['MONGO_TIMEOUT_MS'],
+        "readPreference": config['MONGO_READ_PREFERENCE']
+    }
 
-    Examples:
-        >>> check_tumor_region("oropharynx")
-        'negative'
 
-        >>> check_tumor_region("hypopharynx")
-        'unknown'
+def get_db():
+    """
+    Returns the MongoDB database, through a pooled client shared by the threads of this process.
 
-        >>> check_tumor_region("oral cavity")
-        'unknown'
+    A new client is created after a fork, so that every worker of a pre-forking
+    server such as gunicorn gets its own connection pool.
+    """
+    global mongo_client, mongo_client_pid
 
-        >>> check_tumor_region("larynx")
-        'unknown'
+    if mongo_client is None or mongo_client_pid != os.getpid():
+        with mongo_client_lock:
+            if mongo_client is None or mongo_client_pid != os.getpid():
+                mongo_client = MongoClient(app.config['MONGO_URI'], connect=False, **mongo_client_options(app.config))
+                mongo_client_pid = os.getpid()
 
-        >>> check_tumor_region("oropharynx")
-        'positive'
+    return mongo_client[app.config['MONGO_DATABASE']]
+
+
+def preload_trajectories(database, data: Optional[ModelData] = None) -> None:
     """
-    if request.get('tumor_region') != "oropharynx":
-        hpv_status = "unknown"
-    else:
-        hpv_status = request.get('hpv_status')  
+    Loads the trajectories of every model into the in-memory store.
 
-    return hpv_status
+    Args:
+        database: The MongoDB database holding one collection per model.
+        data (Optional[ModelData]): The model data to load into, the one being served by default.
+    """
+    data = data or model_data
+
+    for model_name in list_model_names():
+        if app.config['COMPACT_STORAGE']:
+            collection = database[data.collection_name(compact_collection_name(model_name))]
+            grids = {migration: read_grid(database, model_name, data.collection_name(GRID_COLLECTION), migration)
+                     for migration in collection_migrations(collection, model_name)}
+            trajectories = load_trajectories(collection, model_name, model_covariates(model_name), grids)
+            n_trajectories = data.trajectory_store.add_model(model_name, trajectories)
+        else:
+            n_trajectories = data.trajectory_store.load_model(database[data.collection_name(model_name)], model_name,
+                                                              model_covariates(model_name))
+        app.logger.info("Loaded %d trajectories for %s", n_trajectories, model_name)
 
+    if data is model_data:
+        invalidate_caches()
 
-@app.route('/base_model', methods=['POST'])
-@swag_from('models.yml')
-def base_model():
+
+def load_survival_models(database, data: Optional[ModelData] = None) -> None:
     """
-    Endpoint for retrieving patient trajectory data based on specified query parameters.
+    Loads the baseline survival and coefficients of the models in the model_coefficients collection.
+
+    Args:
+        database: The MongoDB database holding the model_coefficients collection.
+        data (Optional[ModelData]): The model data to load into, the one being served by default.
+    """
+    data = data or model_data
+
+    n_models = data.survival_engine.load(database[data.collection_name("model_coefficients")])
+    app.logger.info("Loaded coefficients of %d models", n_models)
+
+    if data is model_data:
+        invalidate_caches()
+
+
+def load_snapshot(path: str) -> ModelData:
+    """
+    Opens a snapshot exported with manage.py, to serve the trajectories, hazard ratios and RMST from.
+
+    Args:
+        path (str): A snapshot directory, or the root directory of the snapshots holding a CURRENT file.
 
     Returns:
-        flask.Response: A JSON response containing the patient trajectory data.
+        ModelData: The model data of the snapshot, to be swapped in.
+    """
+    snapshot = Snapshot(path)
+    data = ModelData(snapshot=snapshot)
+    data.trajectory_store.load_snapshot(snapshot)
+    app.logger.info("Opened model data snapshot %s", snapshot.version)
 
-    Raises:
-        None
+    return data
 
-    Example:
 
+def load_model_data() -> ModelData:
+    """
+    Loads the current version of the model data, as set up by the configuration, into a new ModelData.
+
+    The model data being served is left untouched, so this can run while requests are served.
 
+    Returns:
+        ModelData: The new model data, to be swapped in.
     """
-    
-    #
-    try:
-        request_data = request.json
-        
-        # Retrieve query parameters
-        outcome = request_data.get('outcome') 
-        censoring_time = request_data.get('censoring_time')
+    if app.config['SNAPSHOT_PATH']:
+        return load_snapshot(app.config['SNAPSHOT_PATH'])
 
-        #[clinical_scenario, outcome, gene_signature_type, censoring_time, request_data.get("clinical_sex")]
-        model_name = select_model("1", 
-                                outcome, 
-                                "none", 
-                                censoring_time)
-        
-        collection = db[model_name]
-
-        query = {"model": model_name,
-                    "clinical_sex": request_data.get('clinical_sex'),
-                    "clinical_age_at_diagnosis": int(request_data.get('clinical_age_at_diagnosis')),
-                    "ctn_disease_extension_diagnosis": request_data.get('ctn_disease_extension_diagnosis'),
-                    "surge_undergone_cancer_surgery": request_data.get('surge_undergone_cancer_surgery'),
-                    "radio_radiotherapy_treatment": request_data.get('radio_radiotherapy_treatment'),
-                    "chemo_chemotherapy_treatment": request_data.get('chemo_chemotherapy_treatment'),
-                    "smoking_category": request_data.get('smoking_category'),
-                    "tumor_region": request_data.get('tumor_region'),
-                    "hpv_status": check_tumor_region(request_data)
-                    }
+    database = get_db()
+    data = ModelData(read_current_version(database))
 
+    if app.config['PRELOAD_TRAJECTORIES']:
+        preload_trajectories(database, data)
 
-        # Query the result
-        single_patient_records = collection.find(query)
+    if app.config['COMPUTE_TRAJECTORIES']:
+        load_survival_models(database, data)
 
-        result = get_patient_trajectory(single_patient_records)
+    return data
 
-        return jsonify(result)
-    
-    except Exception as e:
-        return jsonify({'error': str(e)}), 400
 
+# Serializes the reloads of the model data
+reload_lock = threading.Lock()
 
-@app.route('/hpv_negative', methods=['POST'])
-@swag_from('models.yml')
-def hpv_negative():
+# Background reload started by POST /reload, and the error of the last failed reload
+reload_thread = None
+reload_thread_lock = threading.Lock()
+reload_error = None
+
+
+def reload_model_data() -> ModelData:
     """
-    Endpoint for model scenario 2.
+    Loads the current version of the model data and swaps it in.
 
-    Retrieves query parameters from the request and performs a query based on the provided parameters.
-    The result is returned as a JSON response.
+    The new version is loaded, and its hazard ratios and RMST retrieved, while the
+    previous one keeps serving. The swap is a single assignment: requests started
+    before it finish on the previous version, see bind_model_data.
 
     Returns:
-        JSON response containing the patient trajectory.
-
-    Raises:
-        ValueError: If the gene_signature_type is not "class" or "score".
-        Exception: If any error occurs during the execution.
+        ModelData: The model data now served.
     """
-    try:
-        request_data = request.json
+    global model_data
 
-        # Retrieve query parameters
-        outcome = request_data.get('outcome') 
-        gene_signature_type = request_data.get('gene_signature_type') 
-        censoring_time = request_data.get('censoring_time')
+    with reload_lock:
+        data = load_model_data()
 
-        #[clinical_scenario, outcome, gene_signature_type, censoring_time, request_data.get("clinical_sex")]
-        model_name = select_model("2", 
-                                outcome, 
-                                gene_signature_type, 
-                                censoring_time)
-        
-        collection = db[model_name]
+        # Pages the collections of the new version into the MongoDB cache before they are served
+        if app.config['WARMUP'] and not app.config['SNAPSHOT_PATH']:
+            report = warm_up(app.config, workers=app.config['WARMUP_WORKERS'], data=data)
+            app.logger.info("Warm-up of version %s: %d of %d covariate combinations have a trajectory",
+                            data.version, report["found"], report["expected"])
 
-    
+        # Hazard ratios and RMST are small, they are retrieved before the swap so that requests do not wait for them
+        for model in model_registry.models.values():
+            if model.scenario.gene_signature is not None:
+                get_hazard_ratios(model.name, data)
+                get_restricted_mean(model.name, data)
 
-        gs1_os_dict = {
-                    "-2": -0.2931846, 
-                    "-1": 0.4036082, 
-                    "0": 1.100401, 
-                    "1": 1.7971937, 
-                    "2": 2.4939865}
-        
-        gs1_dfs_dict = {
-                        "-2": -0.2431567, 
-                        "-1": 0.4148494, 
-                        "0":  1.0728555, 
-                        "1":  1.7308616, 
-                        "2":  2.3888677
-                        }
-
-        query = {"model": model_name,
-                    "clinical_sex": request_data.get('clinical_sex'),
-                    "clinical_age_at_diagnosis": int(request_data.get('clinical_age_at_diagnosis')),
-                    "ctn_disease_extension_diagnosis": request_data.get('ctn_disease_extension_diagnosis'),
-                    "surge_undergone_cancer_surgery": request_data.get('surge_undergone_cancer_surgery'),
-                    "radio_radiotherapy_treatment": request_data.get('radio_radiotherapy_treatment'),
-                    "chemo_chemotherapy_treatment": request_data.get('chemo_chemotherapy_treatment'),
-                    "smoking_category": request_data.get('smoking_category'),
-                    "tumor_region": request_data.get('tumor_region'),
-                    "hpv_status": "negative"
-                    }
-
-        if request_data.get("gene_signature_type") == "class":
-            query["gs1_class"] = request_data.get('gs_class')
-        elif request_data.get("gene_signature_type") == "score":
-            if outcome == "os":
-                query["gs1_score"] = gs1_os_dict[request_data.get('gs_score')]
-            elif outcome == "dfs":
-                query["gs1_score"] = gs1_dfs_dict[request_data.get('gs_score')]
-        else:
-            return "Bad request: Score or class required.", 400
+        previous, model_data = model_data, data
+
+    app.logger.info("Serving model data version %s, previously %s", data.version, previous.version)
+
+    return data
 
-        # Query the result
-        single_patient_records = collection.find(query)
 
-        result = get_patient_trajectory(single_patient_records)
+def background_reload() -> None:
+    global reload_error
 
-        return jsonify(result)
+    try:
+        reload_model_data()
+        reload_error = None
     except Exception as e:
-        return jsonify({'error': str(e)}), 400
+        app.logger.exception("Reloading the model data failed, still serving version %s", model_data.version)
+        reload_error = str(e)
 
-@app.route('/hpv_positive', methods=['POST'])
-@swag_from('models.yml')
-def hpv_positive():
+
+def start_reload() -> bool:
     """
-    Endpoint for Clinical Scenario 3: Gene signature model for HPV-Positive.
-    
-    Retrieves the query parameters from the request and uses them to query the database
-    and obtain the patient trajectory based on the selected model and input parameters.
-    
-    Returns the patient trajectory as a JSON response.
+    Starts reloading the model data in a background thread.
+
+    Returns:
+        bool: False if a reload is already running.
     """
-    request_data = request.json
+    global reload_thread
 
-    # Retrieve query parameters
-    outcome = request_data.get('outcome') 
-    gene_signature_type = request_data.get('gene_signature_type') 
-    censoring_time = "24"
+    with reload_thread_lock:
+        if reload_thread is not None and reload_thread.is_alive():
+            return False
+        reload_thread = threading.Thread(target=background_reload, name="model-data-reload", daemon=True)
+        reload_thread.start()
 
-    #[clinical_scenario, outcome, gene_signature_type, censoring_time, request_data.get("clinical_sex")]
-    model_name = select_model("3", 
-                              outcome, 
-                              "score", 
-                              censoring_time)
-    
-    collection = db[model_name]
+    return True
 
- 
 
-    gs2_os_dict = {
-        "-2": -43.54348,
-        "-1": -40.06991,
-        "0": -36.59634,
-        "1": -33.12277, 
-        "2": -29.6492
-    }
+def reload_pending() -> bool:
+    """
+    Tells whether a version other than the one being served has been published.
+    """
+    if app.config['SNAPSHOT_PATH']:
+        return resolve_snapshot(app.config['SNAPSHOT_PATH']) != model_data.snapshot.directory
+    return read_current_version(get_db()) != model_data.collection_version
 
-    gs2_dfs_dict = {
-        "-2": -43.34192,
-        "-1": -39.94582,
-        "0": -36.54972,
-        "1": -33.15362,
-        "2": -29.75752
-    }
 
-    query = {"model": model_name,
-                "clinical_sex": request_data.get('clinical_sex'),
-                "clinical_age_at_diagnosis": int(request_data.get('clinical_age_at_diagnosis')),
-                "ctn_disease_extension_diagnosis": request_data.get('ctn_disease_extension_diagnosis'),
-                "surge_undergone_cancer_surgery": request_data.get('surge_undergone_cancer_surgery'),
-                "radio_radiotherapy_treatment": request_data.get('radio_radiotherapy_treatment'),
-                "chemo_chemotherapy_treatment": request_data.get('chemo_chemotherapy_treatment'),
-                "smoking_category": request_data.get('smoking_category'),
-                "tumor_region": request_data.get('tumor_region'),
-                "hpv_status": "positive"
-                }
-
-    if request_data.get("gene_signature_type") == "score":
-        if outcome == "os":
-            query["gs2_score"] = gs2_os_dict[request_data.get('gs_score')]
-        elif outcome == "dfs":
-            query["gs2_score"] = gs2_dfs_dict[request_data.get('gs_score')]
-    else:
-        return "Bad request: only score is accepted.", 400
+# Process running the version poller, see start_version_poller
+version_poller_pid = None
 
-  
-    # Query the result
-    single_patient_records = collection.find(query)
 
-    result = get_patient_trajectory(single_patient_records)
+def poll_versions() -> None:
+    while True:
+        time.sleep(app.config['RELOAD_INTERVAL'])
+        try:
+            if reload_pending():
+                background_reload()
+        except Exception:
+            app.logger.exception("Checking the published version of the model data failed")
 
-    return jsonify(result)
 
+def start_version_poller() -> None:
+    """
+    Starts checking for a newly published version every RELOAD_INTERVAL seconds, once per process.
 
-@app.route('/radiosensitivity', methods=['POST'])
-@swag_from('models.yml')
-def radiosensitivity():
+    Every worker of a pre-forking server reloads on its own, whereas POST /reload only reaches one worker.
     """
-    Endpoint for Clinical Scenario 4: Gene signature model for radiosensitivity
-    
-    Retrieves the query parameters from the request and uses them to query the database
-    and obtain the patient trajectory based on the selected model and input parameters.
-    
-    Returns the patient trajectory as a JSON response.
+    global version_poller_pid
+
+    if app.config['RELOAD_INTERVAL'] and version_poller_pid != os.getpid():
+        with reload_thread_lock:
+            if version_poller_pid != os.getpid():
+                threading.Thread(target=poll_versions, name="model-data-poller", daemon=True).start()
+                version_poller_pid = os.getpid()
+
+
+def in_memory_trajectories(model_name: str, queries: List[Dict[str, object]]) -> Optional[List[Dict[str, list]]]:
     """
-    
-    request_data = request.json
+    Retrieves trajectories without querying MongoDB, when the model is served from memory.
 
-    # Retrieve query parameters
-    outcome = request_data.get('outcome') 
-    gene_signature_type = request_data.get('gene_signature_type') 
-    censoring_time = request_data.get('censoring_time')
+    Trajectories are computed from the model coefficients when the survival engine
+    holds the model, or looked up in the trajectory store (preloaded or snapshot).
 
-  
-    model_name = select_model("4", 
-                              outcome, 
-                              gene_signature_type, 
-                              censoring_time)
-    
-    collection = db[model_name]
+    Args:
+        model_name (str): The model name, as returned by select_model.
+        queries (List[Dict[str, object]]): The queries built by the endpoint, one per patient.
 
+    Returns:
+        Optional[List[Dict[str, list]]]: The patient trajectories in the order of the queries,
+            or None if the model is only available in MongoDB.
+    """
+    data = current_model_data()
+    if model_name in data.survival_engine:
+        return data.survival_engine.predict(model_name, queries)
+
+    if model_name not in data.trajectory_store:
+        return None
+
+    results = []
+    for query in queries:
+        trajectory = data.trajectory_store.get(model_name, query)
+        if trajectory is None:
+            results.append({field: [] for field in TRAJECTORY_FIELDS})
+        else:
+            results.append({field: trajectory[field].tolist() for field in TRAJECTORY_FIELDS})
 
-    gs3_os_dict = {
-        '-2': -0.26048004,
-        '-1': -0.08093769,
-        '0': 0.09860467,
-        '1': 0.27814702,
-        '2': 0.45768938
-    }
+    return results
 
-    
-    gs3_dfs_dict = {
-        '-2': -0.26653957,
-        '-1': -0.08628749,
-        '0': 0.0939646,
-        '1': 0.27421669,
-        '2': 0.45446877
-    }
 
+def compact_trajectories(model_name: str, queries: List[Dict[str, object]]) -> List[Dict[str, List[Union[float, int]]]]:
+    """
+    Retrieves trajectories from the compact collection of a model, one document per patient.
+
+    Args:
+        model_name (str): The model name, as returned by select_model.
+        queries (List[Dict[str, object]]): The queries built by the endpoint, one per patient.
 
-    query = {"model": model_name,
-                "clinical_sex": request_data.get('clinical_sex'),
-                "clinical_age_at_diagnosis": int(request_data.get('clinical_age_at_diagnosis')),
-                "ctn_disease_extension_diagnosis": request_data.get('ctn_disease_extension_diagnosis'),
-                "surge_undergone_cancer_surgery": request_data.get('surge_undergone_cancer_surgery'),
-                "radio_radiotherapy_treatment": request_data.get('radio_radiotherapy_treatment'),
-                "chemo_chemotherapy_treatment": request_data.get('chemo_chemotherapy_treatment'),
-                "smoking_category": request_data.get('smoking_category'),
-                "tumor_region": request_data.get('tumor_region'),
-                "hpv_status":  check_tumor_region(request_data)
-                }
-
-    if request_data.get("gene_signature_type") == "class":
-        query["gs3_class"] = request_data.get('gs_class')
-    elif request_data.get("gene_signature_type") == "score":
-        if outcome == "os":
-            query["gs3_score"] = gs3_os_dict[request_data.get('gs_score')]
-        elif outcome == "dfs":
-            query["gs3_score"] = gs3_dfs_dict[request_data.get('gs_score')]
+    Returns:
+        List[Dict[str, List[Union[float, int]]]]: The decoded trajectories, in the order of the queries.
+    """
+    data = current_model_data()
+    database = get_db()
+    collection = database[data.collection_name(compact_collection_name(model_name))]
+    if len(queries) == 1:
+        cursor = collection.find(queries[0], COMPACT_PROJECTION)
     else:
-        return "Bad request: Score or class required.", 400
+        cursor = collection.find({"model": model_name, "$or": queries}, COMPACT_PROJECTION)
 
+    # The grids are keyed on migration id, so a re-converted model never uses a cached grid of its previous conversion
+    documents = list(timed_cursor(cursor))
+    grids = {}
+    for migration in {document.get(GRID_FIELD) for document in documents}:
+        grids[migration] = data.time_grids.get((model_name, migration))
+        if grids[migration] is None:
+            grids[migration] = read_grid(database, model_name, data.collection_name(GRID_COLLECTION), migration)
+            # No grid yet means the model has not been converted, so it is not cached
+            if grids[migration]:
+                data.time_grids[(model_name, migration)] = grids[migration]
+
+    return decode_documents(documents, queries, grids)
 
-    # Query the result
-    single_patient_records = collection.find(query)
 
-    result = get_patient_trajectory(single_patient_records)
+def fetch_trajectory(model_name: str, query: Dict[str, object]) -> Dict[str, List[Union[float, int]]]:
+    """
+    Retrieves the patient trajectory for a query built by an endpoint.
 
-    return jsonify(result)
+    The trajectory is computed or taken from memory when the model is served
+    from memory (see in_memory_trajectories), otherwise the model collection
+    (or its compact collection with COMPACT_STORAGE) is queried in MongoDB.
 
+    Args:
+        model_name (str): The model name, as returned by select_model.
+        query (Dict[str, object]): The query built by the endpoint.
 
-@app.route('/chemosensitivity_platinum', methods=['POST'])
-@swag_from('models.yml')
-def chemosensitivity_platinum():
+    Returns:
+        Dict[str, List[Union[float, int]]]: The patient trajectory, as returned by get_patient_trajectory.
     """
-    Clinical Scenario 5: Gene signature model for chemosensitivity to platinum
+    data = current_model_data()
+    cache_key = (data.version, model_name, make_key(query))
+    result = response_cache.get(cache_key)
+    if result is not MISSING:
+        count_cache("response", 1, 0)
+        return result
+    count_cache("response", 0, 1)
+
+    in_memory = in_memory_trajectories(model_name, [query])
+    if in_memory is not None:
+        result = in_memory[0]
+    elif app.config['COMPACT_STORAGE']:
+        result = compact_trajectories(model_name, [query])[0]
+    else:
+        collection = get_db()[data.collection_name(model_name)]
+        result = get_patient_trajectory(timed_cursor(collection.find(query, TRAJECTORY_PROJECTION)))
+    count_trajectories([result])
 
-    Endpoint for retrieving the patient trajectory data for chemosensitivity to platinum.
-    
-    Retrieves the request body parameters and queries the database to retrieve the patient trajectory data
-    based on the selected outcome, gene signature type, and censoring time.
-    
-    Returns the patient trajectory data as a JSON response.
+    response_cache.set(cache_key, result)
+
+    return result
+
+
+def stream_trajectory(model_name: str, query: Dict[str, object], precision: Optional[int] = None) -> Iterator[str]:
     """
-    
-    request_data = request.json
+    Writes the JSON of a patient trajectory incrementally, one column at a time.
 
-    # Retrieve query parameters
-    outcome = request_data.get('outcome') 
-    gene_signature_type = "score"
-    censoring_time = "24"
+    Each column is read with its own cursor, projected on that field and sorted by
+    time and then _id so that ties come in the same order in every column, and
+    written as the documents arrive, in chunks of STREAM_BATCH_SIZE values. At most
+    one batch of one column is held in memory, whatever the trajectory length. A
+    field missing from a document is written as null, so the columns always line up.
 
-    # Select the appropriate model based on the clinical scenario, outcome, gene signature type, and censoring time
-    model_name = select_model("5", outcome, gene_signature_type, censoring_time)
-    
-    # Get the MongoDB collection based on the selected model
-    collection = db[model_name]
-
-    # Define dictionaries for gene signature scores for overall survival (OS) and disease-free survival (DFS)
-    gs4_os_dict = {
-        "-2": -1.6086046,
-        "-1": -1.109999,
-        "0": -0.6113933,
-        "1": -0.1127877,
-        "2": 0.3858179
-    }
-    
-    gs4_dfs_dict =  {
-        "-2": -1.5821354,
-        "-1": -1.1019201,
-        "0": -0.6217047,
-        "1": -0.1414894,
-        "2": 0.338726
-    }
+    Args:
+        model_name (str): The model name, as returned by select_model.
+        query (Dict[str, object]): The query built by the endpoint.
+        precision (Optional[int]): The significant digits of the survival probabilities, see request_precision.
 
-    # Construct the query for retrieving the patient trajectory data
-    query = {
-        "model": model_name,
-        "clinical_sex": request_data.get("clinical_sex"),
-        "clinical_age_at_diagnosis": int(request_data.get("clinical_age_at_diagnosis")),
-        "ctn_stage_7ed_modified": request_data.get("ctn_stage_7ed_modified"),
-        "chemo_platin_agent": request_data.get("chemo_platin_agent"),
-        "smoking_category": request_data.get("smoking_category"),
-        "tumor_region": request_data.get("tumor_region"),
-        "hpv_status": check_tumor_region(request_data)
-    }
+    Yields:
+        str: Consecutive chunks of the JSON document.
+    """
+    batch_size = app.config['STREAM_BATCH_SIZE']
+    in_memory = in_memory_trajectories(model_name, [query])
+    if in_memory is None and app.config['COMPACT_STORAGE']:
+        # A compact trajectory is a single small document, decoded at once
+        in_memory = compact_trajectories(model_name, [query])
+
+    def column_values(field: str) -> Iterable[object]:
+        if in_memory is not None:
+            return in_memory[0][field]
+        collection = get_db()[current_model_data().collection_name(model_name)]
+        cursor = collection.find(query, {field: 1, "_id": 0}, batch_size=batch_size).sort([("time", 1), ("_id", 1)])
+        return (timepoint.get(field) for timepoint in timed_cursor(cursor))
+
+    yield "{"
+    for position, field in enumerate(TRAJECTORY_FIELDS):
+        yield ("," if position else "") + json.dumps(field) + ":["
+        rounded = precision is not None and field in PRECISION_COLUMNS
+
+        separator = ""
+        for chunk in chunked(column_values(field), batch_size):
+            if rounded:
+                chunk = round_significant(chunk, precision)
+            yield separator + to_json(chunk).decode()[1:-1]
+            separator = ","
+
+        yield "]"
+    yield "}"
+
+
+def chunked(values: Iterable[object], size: int) -> Iterator[List[object]]:
+    """
+    Groups an iterable into lists of at most size elements.
 
-    # Check if the gene signature type is "score" and update the query accordingly
-    if request_data.get("gene_signature_type") == "score":
-        if outcome == "os":
-            query["gs4_score"] = gs4_os_dict[request_data.get('gs_score')]
-        elif outcome == "dfs":
-            query["gs4_score"] = gs4_dfs_dict[request_data.get('gs_score')]
-    else:
-        return "Bad request: only score available for this gene signature.", 400
+    Examples:
+        >>> list(chunked(range(5), 2))
+        [[0, 1], [2, 3], [4]]
+    """
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-    # Query the result
-    single_patient_records = collection.find(query)
 
-    # Process the patient trajectory data
-    result = get_patient_trajectory(single_patient_records)
+def trajectory_response(model_name: str, query: Dict[str, object]) -> Response:
+    """
+    Builds the response of a scenario endpoint.
 
-    return jsonify(result)
+    The trajectory is streamed when the request has the query parameter stream=1,
+    and returned as a single JSON document otherwise.
 
+    Args:
+        model_name (str): The model name, as returned by select_model.
+        query (Dict[str, object]): The query built by the endpoint.
 
-@app.route('/chemosensitivity_cetuximab', methods=['POST'])
-@swag_from('models.yml')
-def chemosensitivity_cetuximab():
+    Returns:
+        flask.Response: The JSON response with the patient trajectory.
     """
+    if request.args.get('stream') in ('1', 'true'):
+        return Response(stream_with_context(stream_trajectory(model_name, query, request_precision())),
+                        mimetype='application/json')
 
-    Clinical scenario 6: Gene signature model for chemosensitivity to cetuximab.
+    return render(fetch_trajectory(model_name, query))
 
-    Endpoint for retrieving the patient trajectory data for chemosensitivity to cetuximab.
-    
-    Retrieves the request body parameters and queries the database to retrieve the patient trajectory data
-    based on the selected outcome, gene signature type, and censoring time.
-    
-    Returns the patient trajectory data as a JSON response.
+
+def render(payload: Dict[str, list]) -> Response:
     """
-    
-    request_data = request.json
-    
-    # Retrieve query parameters
-    outcome = request_data.get('outcome') 
-    gene_signature_type = "score"
-    censoring_time = "24"
+    Serializes a column-oriented payload in the format negotiated with the Accept header.
 
-    # Select the appropriate model based on the clinical scenario, outcome, gene signature type, and censoring time
-    model_name = select_model("6", outcome, gene_signature_type, censoring_time)
-    
-    # Get the MongoDB collection based on the selected model
-    collection = db[model_name]
-
-    # Define dictionaries for gene signature scores for overall survival (OS) and disease-free survival (DFS)
-    gs5_os_dict = {
-        "-2": -2.144831,
-        "-1": 1.39765,
-        "0": 4.940131,
-        "1": 8.482613,
-        "2": 12.025094
-    }
+    JSON is the default; application/vnd.apache.arrow.stream and application/msgpack
+    return the same columns as typed binary arrays. The survival probabilities are
+    rounded to the precision requested, if any.
 
-    gs5_dfs_dict = {
-        '-2': -1.836707,
-        '-1': 1.598949,
-        '0': 5.034605,
-        '1': 8.470261,
-        '2': 11.905917
-    }
+    Args:
+        payload (Dict[str, list]): The columns built by the endpoint.
 
-    request_data = request.json
-    
-    # Construct the query for retrieving the patient trajectory data
-    query = {
-        "model": model_name,
-        "clinical_sex": request_data.get("clinical_sex"),
-        "clinical_age_at_diagnosis": int(request_data.get("clinical_age_at_diagnosis")),
-        "ctn_stage_7ed_modified": request_data.get("ctn_stage_7ed_modified"),
-        "chemo_cetuximab_agent": request_data.get("chemo_cetuximab_agent"),
-        "smoking_category": request_data.get("smoking_category"),
-        "tumor_region": request_data.get("tumor_region"),
-        "hpv_status": check_tumor_region(request_data)
-    }
+    Returns:
+        flask.Response: The serialized payload, or 406 if the requested format is not available.
+    """
+    mimetype = negotiate(request.accept_mimetypes)
 
-    # Check if the gene signature type is "score" and update the query accordingly
-    if request_data.get("gene_signature_type") == "score":
-        if outcome == "os":
-            query["gs5_score"] = gs5_os_dict[request_data.get('gs_score')]
-        elif outcome == "dfs":
-            query["gs5_score"] = gs5_dfs_dict[request_data.get('gs_score')]
-    else:
-        return "Bad request: only score available for this gene signature.", 400
+    with timed("serialization"):
+        payload = round_columns(payload, request_precision())
+        if mimetype == JSON_MIMETYPE:
+            response = json_response(payload)
+        else:
+            body = encode(payload, mimetype)
+            if body is None:
+                return "Not acceptable: " + mimetype + " is not available on this server.", 406
+            response = Response(body, mimetype=mimetype)
 
-    # Query the result
-    single_patient_records = collection.find(query)
+    response.vary.add('Accept')
 
-    # Process the patient trajectory data
-    result = get_patient_trajectory(single_patient_records)
+    return response
 
-    return jsonify(result)
 
+def json_response(payload: object) -> Response:
+    return Response(to_json(payload), mimetype=JSON_MIMETYPE)
 
-@app.route('/hazard_ratios', methods=['POST'])
-@swag_from('models.yml')
-def hazard_ratios():
+
+def request_precision() -> Optional[int]:
     """
-    Endpoint for retrieving hazard ratios for the gene signature models.
-    
-    Retrieves the request body parameters and calculates the hazard ratios
-    based on the selected outcome, gene signature type, and censoring time.
-    
-    Returns the hazard ratios along with confidence intervals, p-value, and comparison as a JSON response.
+    Returns the number of significant digits of the survival probabilities requested
+    with the precision query parameter, None for full precision.
+
+    Raises:
+        ValueError: If precision is not an integer between 1 and MAX_PRECISION.
     """
-    
-    # Retrieve request body parameters
-    request_data = request.json
-    outcome = request_data.get('outcome')
-    gene_signature_type = request_data.get('gene_signature_type')
-    censoring_time = request_data.get('censoring_time')
-    clinical_scenario = request_data.get('clinical_scenario')
-
-    model_name = select_model(clinical_scenario, outcome, gene_signature_type, censoring_time)
-   
-    collection = db["hazard_ratios"]
-    # Construct the query for retrieving the hazard ratios from MongoDB
-    query = {
-        "model": {
-            "$regex": model_name
-        }
-    }
-    
-    # Query the MongoDB collection to retrieve the hazard ratios
-    hazard_ratio_data = collection.find(query)
+    precision = request.args.get('precision')
+    if precision in (None, ""):
+        return None
+    if not precision.isdigit() or not 1 <= int(precision) <= MAX_PRECISION:
+        raise ValueError("Bad request: precision must be an integer between 1 and " + str(MAX_PRECISION) + ".")
+    return int(precision)
 
-    #if hazard_ratio_data.count() == 0:
-    #    return "Invalid input parameters", 400
 
-    # Extract the relevant data from the retrieved documents
-    hazard_ratio = []
-    hr_upper_ci = []
-    hr_lower_ci = []
+def fetch_trajectories(model_name: str, queries: List[Dict[str, object]]) -> List[Dict[str, List[Union[float, int]]]]:
+    """
+    Retrieves the trajectories of several patients of the same model with a single lookup.
+
+    Without a preloaded model, the queries are combined into one MongoDB query with $or
+    and the returned time points are split back per patient.
+
+    Args:
+        model_name (str): The model name, as returned by select_model.
+        queries (List[Dict[str, object]]): The queries built by the endpoint, one per patient.
+
+    Returns:
+        List[Dict[str, List[Union[float, int]]]]: The patient trajectories, in the order of the queries.
+    """
+    data = current_model_data()
+    keys = [make_key(query) for query in queries]
+    results = {key: response_cache.get((data.version, model_name, key)) for key in keys}
+    missing_queries = {key: dict(key) for key, result in results.items() if result is MISSING}
+    count_cache("response", len(results) - len(missing_queries), len(missing_queries))
+
+    in_memory = in_memory_trajectories(model_name, list(missing_queries.values()))
+    if in_memory is None and missing_queries and app.config['COMPACT_STORAGE']:
+        in_memory = compact_trajectories(model_name, list(missing_queries.values()))
+
+    if in_memory is not None:
+        for key, result in zip(missing_queries, in_memory):
+            results[key] = result
+            response_cache.set((data.version, model_name, key), result)
+    elif missing_queries:
+        covariates = [field for field in queries[0] if field != "model"]
+        projection = {field: 1 for field in covariates + list(TRAJECTORY_FIELDS)}
+        projection["_id"] = 0
+
+        timepoints = {key: [] for key in missing_queries}
+        collection = get_db()[data.collection_name(model_name)]
+        cursor = collection.find({"model": model_name, "$or": list(missing_queries.values())}, projection)
+        for timepoint in timed_cursor(cursor):
+            key = tuple(sorted((field, timepoint.get(field)) for field in covariates))
+            if key in timepoints:
+                timepoints[key].append(timepoint)
+
+        for key in missing_queries:
+            results[key] = get_patient_trajectory(timepoints[key])
+            response_cache.set((data.version, model_name, key), results[key])
+
+    count_trajectories(results[key] for key in missing_queries)
+
+    return [results[key] for key in keys]
+
+
+def gs_score_value(score_level_values: Dict[str, float], request_data: Dict[str, object],
+                   gene_signature: Optional[str] = None) -> float:
+    """
+    Returns the gene signature score of a request.
+
+    The score is normally one of the five gs_score levels, mapped to its value
+    with score_level_values. Models computed from their coefficients also accept
+    any continuous score, given as gs_score_value. For signatures ported to Python
+    (see gene_signature_scores), the raw gene_expression of the patient can be sent
+    instead: its linear predictor is binned to the nearest level.
+
+    Args:
+        score_level_values (Dict[str, float]): The score value of each gs_score level.
+        request_data (Dict[str, object]): The request body of the patient.
+        gene_signature (Optional[str]): The signature of the model, e.g. "gs4".
+
+    Returns:
+        float: The gene signature score used in the query.
+
+    Raises:
+        KeyError: If gs_score is not one of the levels.
+        ValueError: If gene_expression has none of the signature genes.
+
+    Examples:
+        >>> gs_score_value({"0": 1.100401}, {"gs_score": "0"})
+        1.100401
+
+        >>> gs_score_value({"0": 1.100401}, {"gs_score_value": 0.8})
+        0.8
+    """
+    if request_data.get('gs_score_value') is not None:
+        return float(request_data.get('gs_score_value'))
+
+    gene_expression = request_data.get('gene_expression')
+    if gene_expression is not None and gene_signature in signatures:
+        # Only the signature genes are read, as in read_delimited and read_parquet
+        genes = [gene for gene in gene_expression if gene in signatures[gene_signature].genes]
+        if not genes:
+            raise ValueError("Bad request: none of the signature genes are in gene_expression.")
+        expression = np.array([[gene_expression[gene] for gene in genes]], dtype=np.float64)
+        linear_predictor = signatures[gene_signature].linear_predictor(expression, genes)
+        return score_level_values[score_levels(linear_predictor, score_level_values)[0]]
+
+    return score_level_values[str(request_data.get('gs_score'))]
+
+
+def check_tumor_region(request) -> str:
+    """
+    Checks the tumor region and returns the corresponding HPV status.
+
+    Args:
+        tumor_region (str): The tumor region.
+
+    Returns:
+        str: The HPV status. Returns 'unknown' if the tumor region is not 'oropharynx'.
+
+    Examples:
+        >>> check_tumor_region("oropharynx")
+        'negative'
+
+        >>> check_tumor_region("hypopharynx")
+        'unknown'
+
+        >>> check_tumor_region("oral cavity")
+        'unknown'
+
+        >>> check_tumor_region("larynx")
+        'unknown'
+
+        >>> check_tumor_region("oropharynx")
+        'positive'
+    """
+    if request.get('tumor_region') != "oropharynx":
+        hpv_status = "unknown"
+    else:
+        hpv_status = request.get('hpv_status')  
+
+    return hpv_status
+
+
+def scenario_query(scenario: Scenario, request_data: Dict[str, object]) -> Tuple[str, Dict[str, object]]:
+    """
+    Builds the model name and trajectory query of a scenario endpoint from its registry entry.
+
+    Args:
+        scenario (Scenario): The clinical scenario, see model_registry.
+        request_data (Dict[str, object]): The request body of the patient.
+
+    Returns:
+        Tuple[str, Dict[str, object]]: The selected model name and the query for its collection.
+
+    Raises:
+        ValueError: If the request is not valid against models.yml, or no model matches
+            the outcome and censoring time.
+    """
+    with timed("validation"):
+        request_validators[scenario.endpoint].validate(request_data)
+
+    with timed("model_selection"):
+        return select_scenario_model(scenario, request_data)
+
+
+def select_scenario_model(scenario: Scenario, request_data: Dict[str, object]) -> Tuple[str, Dict[str, object]]:
+    """
+    Selects the model of a validated scenario request and builds its query, see scenario_query.
+    """
+    if scenario.gene_signature is None:
+        gene_signature_type = "none"
+    else:
+        gene_signature_type = request_data.get('gene_signature_type')
+        if gene_signature_type not in scenario.gene_signature_types:
+            raise ValueError(scenario.signature_type_error)
+
+    # Scenarios fitted at a single censoring time ignore the one requested
+    if len(scenario.censoring_times) == 1:
+        censoring_time = scenario.censoring_times[0]
+    else:
+        censoring_time = request_data.get('censoring_time')
+
+    try:
+        model = model_registry.resolve(scenario.clinical_scenario, request_data.get('outcome'),
+                                       gene_signature_type, censoring_time)
+    except KeyError:
+        raise ValueError("Bad request: unknown outcome or censoring time.")
+
+    query = {"model": model.name}
+    for field in scenario.covariates:
+        query[field] = request_data.get(field)
+    query["clinical_age_at_diagnosis"] = int(request_data.get('clinical_age_at_diagnosis'))
+    query["hpv_status"] = scenario.hpv_status or check_tumor_region(request_data)
+
+    if gene_signature_type == "class":
+        query[model.term] = request_data.get('gs_class')
+    elif gene_signature_type == "score":
+        # Precomputed trajectories only exist for the gs_score levels
+        if request_data.get('gs_score_value') is not None and model.name not in current_model_data().survival_engine:
+            raise ValueError("Bad request: gs_score_value is only accepted for models computed from their "
+                             "coefficients, send gs_score instead.")
+        query[model.term] = gs_score_value(model.score_levels, request_data, scenario.gene_signature)
+
+    return model.name, query
+
+
+# Schemas of the request bodies in models.yml, and the validators compiled from them.
+request_schemas = load_schemas(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models.yml'))
+request_validators = compile_validators(request_schemas, model_registry)
+
+
+# Query builders of the scenario endpoints, keyed on the endpoint name.
+scenario_queries = {
+    endpoint: functools.partial(scenario_query, scenario)
+    for endpoint, scenario in model_registry.scenarios.items()
+}
+
+
+@app.route('/base_model', methods=['POST'])
+@swag_from('models.yml')
+def base_model():
+    """
+    Endpoint for retrieving patient trajectory data based on specified query parameters.
+
+    Returns:
+        flask.Response: A JSON response containing the patient trajectory data.
+
+    Raises:
+        None
+
+    Example:
+
+
+    """
+    
+    #
+    try:
+        request_data = request.json
+
+        model_name, query = scenario_queries['base_model'](request_data)
+
+        # Query the result
+        return trajectory_response(model_name, query)
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/hpv_negative', methods=['POST'])
+@swag_from('models.yml')
+def hpv_negative():
+    """
+    Endpoint for model scenario 2.
+
+    Retrieves query parameters from the request and performs a query based on the provided parameters.
+    The result is returned as a JSON response.
+
+    Returns:
+        JSON response containing the patient trajectory.
+
+    Raises:
+        ValueError: If the gene_signature_type is not "class" or "score".
+        Exception: If any error occurs during the execution.
+    """
+    try:
+        request_data = request.json
+
+        model_name, query = scenario_queries['hpv_negative'](request_data)
+
+        # Query the result
+        return trajectory_response(model_name, query)
+    except ValueError as e:
+        return str(e), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/hpv_positive', methods=['POST'])
+@swag_from('models.yml')
+def hpv_positive():
+    """
+    Endpoint for Clinical Scenario 3: Gene signature model for HPV-Positive.
+    
+    Retrieves the query parameters from the request and uses them to query the database
+    and obtain the patient trajectory based on the selected model and input parameters.
+    
+    Returns the patient trajectory as a JSON response.
+    """
+    request_data = request.json
+
+    try:
+        model_name, query = scenario_queries['hpv_positive'](request_data)
+    except ValueError as e:
+        return str(e), 400
+
+    # Query the result
+    return trajectory_response(model_name, query)
+
+
+@app.route('/radiosensitivity', methods=['POST'])
+@swag_from('models.yml')
+def radiosensitivity():
+    """
+    Endpoint for Clinical Scenario 4: Gene signature model for radiosensitivity
+    
+    Retrieves the query parameters from the request and uses them to query the database
+    and obtain the patient trajectory based on the selected model and input parameters.
+    
+    Returns the patient trajectory as a JSON response.
+    """
+    
+    request_data = request.json
+
+    try:
+        model_name, query = scenario_queries['radiosensitivity'](request_data)
+    except ValueError as e:
+        return str(e), 400
+
+    # Query the result
+    return trajectory_response(model_name, query)
+
+
+@app.route('/chemosensitivity_platinum', methods=['POST'])
+@swag_from('models.yml')
+def chemosensitivity_platinum():
+    """
+    Clinical Scenario 5: Gene signature model for chemosensitivity to platinum
+
+    Endpoint for retrieving the patient trajectory data for chemosensitivity to platinum.
+    
+    Retrieves the request body parameters and queries the database to retrieve the patient trajectory data
+    based on the selected outcome, gene signature type, and censoring time.
+    
+    Returns the patient trajectory data as a JSON response.
+    """
+    
+    request_data = request.json
+
+    try:
+        model_name, query = scenario_queries['chemosensitivity_platinum'](request_data)
+    except ValueError as e:
+        return str(e), 400
+
+    # Query the result
+    return trajectory_response(model_name, query)
+
+
+@app.route('/chemosensitivity_cetuximab', methods=['POST'])
+@swag_from('models.yml')
+def chemosensitivity_cetuximab():
+    """
+
+    Clinical scenario 6: Gene signature model for chemosensitivity to cetuximab.
+
+    Endpoint for retrieving the patient trajectory data for chemosensitivity to cetuximab.
+    
+    Retrieves the request body parameters and queries the database to retrieve the patient trajectory data
+    based on the selected outcome, gene signature type, and censoring time.
+    
+    Returns the patient trajectory data as a JSON response.
+    """
+    
+    request_data = request.json
+
+    try:
+        model_name, query = scenario_queries['chemosensitivity_cetuximab'](request_data)
+    except ValueError as e:
+        return str(e), 400
+
+    # Query the result
+    return trajectory_response(model_name, query)
+
+
+def fetch_patients(patients: List[Dict[str, object]]) -> List[Dict[str, object]]:
+    """
+    Retrieves the trajectories of patients of any scenario, with one lookup per selected model.
+
+    Args:
+        patients (List[Dict[str, object]]): The request body of each patient, with an 'endpoint'
+            key naming its scenario endpoint (e.g. "hpv_negative").
+
+    Returns:
+        List[Dict[str, object]]: The trajectories in input order, or an 'error' entry for each
+            patient that could not be resolved.
+    """
+    results = [None] * len(patients)
+    groups = {}
+
+    # Build the query of every patient and group them by model
+    for index, patient in enumerate(patients):
+        if not isinstance(patient, dict) or patient.get('endpoint') not in scenario_queries:
+            results[index] = {'error': "Bad request: unknown endpoint."}
+            continue
+
+        try:
+            model_name, query = scenario_queries[patient['endpoint']](patient)
+        except Exception as e:
+            results[index] = {'error': str(e)}
+            continue
+
+        groups.setdefault(model_name, []).append((index, query))
+
+    # Query the result, one lookup per model
+    for model_name, members in groups.items():
+        try:
+            trajectories = fetch_trajectories(model_name, [query for _, query in members])
+        except Exception as e:
+            trajectories = [{'error': str(e)}] * len(members)
+
+        for (index, _), trajectory in zip(members, trajectories):
+            results[index] = trajectory
+
+    return results
+
+
+@app.route('/batch', methods=['POST'])
+@swag_from('models.yml')
+def batch():
+    """
+    Endpoint for retrieving the trajectories of a whole cohort in one request.
+
+    The request body holds a list of patients, each with the payload of a scenario
+    endpoint plus an 'endpoint' key naming it (e.g. "hpv_negative"). Patients are
+    grouped by selected model and each group is resolved with a single lookup.
+
+    Returns the trajectories in input order as a JSON response. Patients that cannot
+    be resolved get an 'error' entry instead, without failing the whole batch.
+    """
+    request_data = request.json
+    if not isinstance(request_data, dict) or not isinstance(request_data.get('patients'), list):
+        return "Bad request: a list of patients is required.", 400
+
+    patients = request_data['patients']
+
+    results = fetch_patients(patients)
+
+    with timed("serialization"):
+        precision = request_precision()
+        return json_response({"results": [round_columns(result, precision) for result in results]})
+
+
+@app.route('/cohort', methods=['POST'])
+@swag_from('models.yml')
+def cohort():
+    """
+    Endpoint for the population survival curve of a cohort under each treatment option.
+
+    The cohort is a list of 'patients', or the 'distribution' of some covariates (the
+    proportion of each level) around the shared fields of 'patient'; every patient is
+    sent to the scenario 'endpoint'. 'counterfactuals' lists levels of the treatment
+    fields to impose on the whole cohort, one arm per combination of levels.
+
+    Returns, for each arm, the weighted mean survival curve, its pointwise quantile bands
+    and its difference to the first arm as a JSON response.
+    """
+    request_data = request.json
+    if not isinstance(request_data, dict) or request_data.get('endpoint') not in scenario_queries:
+        return "Bad request: unknown endpoint.", 400
+
+    endpoint = request_data['endpoint']
+    if isinstance(request_data.get('patients'), list):
+        patients = request_data['patients']
+        weights = [1.0] * len(patients)
+        if not all(isinstance(patient, dict) for patient in patients):
+            return "Bad request: every patient must be a JSON object.", 400
+    elif isinstance(request_data.get('distribution'), dict) and isinstance(request_data.get('patient', {}), dict):
+        try:
+            patients, weights = expand_distribution(request_data.get('patient', {}), request_data['distribution'])
+        except ValueError as e:
+            return str(e), 400
+    else:
+        return "Bad request: a list of patients or a covariate distribution is required.", 400
+
+    counterfactuals = request_data.get('counterfactuals', {})
+    quantiles = request_data.get('quantiles', list(DEFAULT_QUANTILES))
+    if not isinstance(counterfactuals, dict) or not all(isinstance(levels, list) and levels
+                                                        for levels in counterfactuals.values()):
+        return "Bad request: counterfactuals must map each field to a non-empty list of levels.", 400
+    if not isinstance(quantiles, list) or not all(isinstance(q, (int, float)) and not isinstance(q, bool)
+                                                  and 0 <= q <= 1 for q in quantiles):
+        return "Bad request: quantiles must be a list of numbers between 0 and 1.", 400
+
+    arms = [dict(zip(counterfactuals, levels)) for levels in itertools.product(*counterfactuals.values())]
+    if len(arms) * len(patients) > app.config['COHORT_MAX_PATIENTS']:
+        return "Bad request: the cohort exceeds " + str(app.config['COHORT_MAX_PATIENTS']) + " patients.", 400
+
+    # Every patient of every arm in one batch, one lookup per model
+    results = fetch_patients([{**patient, **arm, 'endpoint': endpoint} for arm in arms for patient in patients])
+    for index, result in enumerate(results):
+        if 'error' in result:
+            return result['error'] + " (patient " + str(index % len(patients)) + ")", 400
+
+    grid = time_grid(results)
+    response = []
+    for position, arm in enumerate(arms):
+        summary = aggregate(results[position * len(patients):(position + 1) * len(patients)], weights, grid, quantiles)
+        summary["covariates"] = arm
+        response.append(summary)
+
+    # Marginal effect of each arm: its mean curve minus the one of the first arm
+    for summary in response:
+        summary["difference"] = [
+            None if value is None or reference is None else value - reference
+            for value, reference in zip(summary["survival_probability"], response[0]["survival_probability"])
+        ]
+
+    with timed("serialization"):
+        return json_response({"arms": response})
+
+
+@app.route('/treatment_comparison', methods=['POST'])
+@swag_from('models.yml')
+def treatment_comparison():
+    """
+    Endpoint comparing every treatment option of a patient in one request.
+
+    The request body is the payload of the scenario 'endpoint' of the patient. The
+    treatment covariates of the scenario (surgery, radiotherapy, chemotherapy or the
+    chemotherapy agent) are set to every combination of their levels in models.yml,
+    and the trajectories of all arms are fetched with a single multi-key lookup.
+
+    Returns the trajectory of each arm, its survival probability at the requested
+    'timepoints' (24 and 60 months by default) and its difference to the treatment
+    given in the request as a JSON response.
+    """
+    request_data = request.json
+    if not isinstance(request_data, dict) or request_data.get('endpoint') not in scenario_queries:
+        return "Bad request: unknown endpoint.", 400
+
+    endpoint = request_data['endpoint']
+    timepoints = request_data.get('timepoints', [24, 60])
+    if not isinstance(timepoints, list) or not all(isinstance(t, (int, float)) and not isinstance(t, bool)
+                                                   for t in timepoints):
+        return "Bad request: timepoints must be a list of numbers.", 400
+
+    # The treatment given is the reference arm, so it is validated as a request of the scenario first
+    try:
+        scenario_queries[endpoint](request_data)
+    except ValueError as e:
+        return str(e), 400
+
+    treatments = model_registry.scenarios[endpoint].treatments
+    arms = [
+        dict(zip(treatments, levels))
+        for levels in itertools.product(*(field_levels(request_schemas, endpoint, field) for field in treatments))
+    ]
+
+    try:
+        queries = [scenario_queries[endpoint]({**request_data, **arm}) for arm in arms]
+    except ValueError as e:
+        return str(e), 400
+
+    # The arms only differ in treatment covariates, so they all select the same model
+    trajectories = fetch_trajectories(queries[0][0], [query for _, query in queries])
+
+    reference = {field: request_data.get(field) for field in treatments}
+    reference_survival = survival_at(trajectories[arms.index(reference)], timepoints)
+
+    response = []
+    for arm, trajectory in zip(arms, trajectories):
+        survival = survival_at(trajectory, timepoints)
+        response.append({
+            "treatments": arm,
+            "trajectory": trajectory,
+            "survival": {str(t): value for t, value in zip(timepoints, survival)},
+            "difference": {
+                str(t): None if value is None or reference_value is None else value - reference_value
+                for t, value, reference_value in zip(timepoints, survival, reference_survival)
+            }
+        })
+
+    with timed("serialization"):
+        precision = request_precision()
+        for arm in response:
+            arm["trajectory"] = round_columns(arm["trajectory"], precision)
+        return json_response({"reference": reference, "arms": response})
+
+
+# Thread pool running the lookups of /report, created in each worker process, as threads do not survive a fork
+report_executor = None
+report_executor_pid = None
+report_executor_lock = threading.Lock()
+
+
+def get_report_executor() -> ThreadPoolExecutor:
+    global report_executor, report_executor_pid
+    if report_executor is None or report_executor_pid != os.getpid():
+        with report_executor_lock:
+            if report_executor is None or report_executor_pid != os.getpid():
+                report_executor = ThreadPoolExecutor(max_workers=app.config['REPORT_WORKERS'],
+                                                     thread_name_prefix="report")
+                report_executor_pid = os.getpid()
+    return report_executor
+
+
+def submit_in_context(function: callable, *args):
+    """
+    Runs a function in the report thread pool, in a copy of the context of the caller.
+
+    The copy carries the model data bound to the request and its timings, so the lookup
+    reads the same version as the rest of the request and its phases are recorded.
+    """
+    return get_report_executor().submit(contextvars.copy_context().run, function, *args)
+
+
+def report_signature_types(scenario: Scenario, request_data: Dict[str, object]) -> List[str]:
+    """
+    Lists the gene_signature_type values a report requests for a scenario.
+
+    The gene_signature_type of the request if given, otherwise the types of the scenario
+    the patient has data for: gs_class for "class", a score or gene expression for "score".
+    Without any, every type is tried so that the report explains what is missing.
+
+    Examples:
+        >>> report_signature_types(model_registry.scenarios["base_model"], {})
+        ['none']
+        >>> report_signature_types(model_registry.scenarios["radiosensitivity"], {"gs_score": 0})
+        ['score']
+    """
+    if scenario.gene_signature is None:
+        return ["none"]
+    if request_data.get('gene_signature_type') is not None:
+        return [request_data['gene_signature_type']]
+
+    available = {"class": request_data.get('gs_class') is not None,
+                 "score": any(request_data.get(field) is not None for field in SCORE_FIELDS)}
+    return [t for t in scenario.gene_signature_types if available.get(t)] or list(scenario.gene_signature_types)
+
+
+def report_requests(patient: Dict[str, object], scenarios: Dict[str, Dict[str, object]], outcomes: List[str],
+                    censoring_times: Optional[List[int]]) -> List[Dict[str, object]]:
+    """
+    Enumerates the scenario requests of a report and selects their models.
+
+    Args:
+        patient (Dict[str, object]): The patient record shared by every scenario.
+        scenarios (Dict[str, Dict[str, object]]): The fields of each scenario endpoint reported,
+            added to the patient record (e.g. the gs_score of its signature).
+        outcomes (List[str]): The outcomes reported.
+        censoring_times (Optional[List[int]]): The censoring times reported, every censoring time
+            of each scenario if None.
+
+    Returns:
+        List[Dict[str, object]]: One entry per scenario, outcome, censoring time and gene
+            signature type, with its 'model' and 'query', or the 'error' of its request.
+    """
+    entries = []
+    for endpoint, fields in scenarios.items():
+        scenario = model_registry.scenarios[endpoint]
+        request_data = {**patient, **fields}
+        for gene_signature_type in report_signature_types(scenario, request_data):
+            for outcome in outcomes:
+                for censoring_time in scenario.censoring_times:
+                    if censoring_times is not None and int(censoring_time) not in censoring_times:
+                        continue
+
+                    entry = {"endpoint": endpoint, "clinical_scenario": scenario.clinical_scenario,
+                             "outcome": outcome, "censoring_time": int(censoring_time),
+                             "gene_signature_type": gene_signature_type}
+                    try:
+                        entry["model"], entry["query"] = scenario_queries[endpoint](dict(
+                            request_data, outcome=outcome, censoring_time=int(censoring_time),
+                            gene_signature_type=gene_signature_type))
+                    except ValueError as e:
+                        entry["error"] = str(e)
+                    entries.append(entry)
+
+    return entries
+
+
+def fetch_report(entries: List[Dict[str, object]]) -> None:
+    """
+    Fills the trajectory, hazard ratios and RMST of the report entries, see report_requests.
+
+    The queries are grouped by model, and the lookups of the distinct models (the
+    trajectories, and the hazard ratios and RMST of the gene signature models) run
+    concurrently in the report thread pool. A failed lookup turns the entries of its
+    model into 'error' entries.
+    """
+    groups = {}
+    for entry in entries:
+        if "model" in entry:
+            groups.setdefault(entry["model"], []).append(entry)
+
+    lookups = {}
+    for model_name, members in groups.items():
+        lookups[model_name] = [submit_in_context(fetch_trajectories, model_name, [entry["query"] for entry in members])]
+        if model_registry.models[model_name].scenario.gene_signature is not None:
+            lookups[model_name].append(submit_in_context(get_hazard_ratios, model_name))
+            lookups[model_name].append(submit_in_context(get_restricted_mean, model_name))
+
+    for model_name, members in groups.items():
+        try:
+            trajectories, *summaries = [future.result() for future in lookups[model_name]]
+        except Exception as e:
+            for entry in members:
+                entry["error"] = str(e)
+            continue
+
+        hazard_ratios, restricted_mean = summaries or (None, None)
+        for entry, trajectory in zip(members, trajectories):
+            entry.update(trajectory=trajectory, hazard_ratios=hazard_ratios, restricted_mean=restricted_mean)
+
+    for entry in entries:
+        entry.pop("query", None)
+        if "error" in entry:
+            entry.pop("model", None)
+
+
+@app.route('/report', methods=['POST'])
+@swag_from('models.yml')
+def report():
+    """
+    Endpoint for the full report of a patient across the clinical scenarios.
+
+    The request body holds the 'patient' record and, optionally, the 'scenarios' to
+    report (every scenario endpoint by default) with fields of their own such as the
+    gs_score of their signature, and the 'outcomes' and 'censoring_times' to report
+    (all of them by default). Every combination is resolved to its model, and the
+    lookups of the distinct models run concurrently, so the latency of the report is
+    that of its slowest lookup rather than their sum.
+
+    Returns the trajectory of each combination, with the hazard ratios and RMST of the
+    gene signature models, as a JSON response. Combinations the patient record does not
+    allow get an 'error' entry instead, without failing the whole report.
+    """
+    request_data = request.json
+    if not isinstance(request_data, dict) or not isinstance(request_data.get('patient'), dict):
+        return "Bad request: a patient record is required.", 400
+
+    scenarios = request_data.get('scenarios', {endpoint: {} for endpoint in scenario_queries})
+    outcomes = request_data.get('outcomes', list(OUTCOMES))
+    censoring_times = request_data.get('censoring_times')
+
+    # Empty selections are rejected rather than answered with an empty report
+    if not isinstance(scenarios, dict) or not scenarios or not all(
+            endpoint in scenario_queries and isinstance(fields, dict) for endpoint, fields in scenarios.items()):
+        return "Bad request: scenarios must map scenario endpoints to their fields.", 400
+    if not isinstance(outcomes, list) or not outcomes or not all(outcome in OUTCOMES for outcome in outcomes):
+        return "Bad request: outcomes must be a non-empty list of " + " or ".join(OUTCOMES) + ".", 400
+    if censoring_times is not None and (not isinstance(censoring_times, list) or not censoring_times or not all(
+            isinstance(t, int) and not isinstance(t, bool) for t in censoring_times)):
+        return "Bad request: censoring_times must be a non-empty list of integers.", 400
+
+    entries = report_requests(request_data['patient'], scenarios, outcomes, censoring_times)
+    fetch_report(entries)
+
+    with timed("serialization"):
+        precision = request_precision()
+        for entry in entries:
+            if "trajectory" in entry:
+                entry["trajectory"] = round_columns(entry["trajectory"], precision)
+        return json_response({"scenarios": entries})
+
+
+# Content types of the expression matrices accepted by /signature_scores, CSV being the default.
+EXPRESSION_DELIMITERS = {"text/csv": ",", "text/tab-separated-values": "\t"}
+PARQUET_MIMETYPES = {"application/vnd.apache.parquet", "application/x-parquet"}
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def score_expression(gene_signature: str, levels: Dict[str, float], genes: List[str],
+                     chunks: Iterable[Tuple[List[str], np.ndarray, Dict[int, str]]], ndjson: bool = False) -> Iterator[str]:
+    """
+    Scores an expression matrix chunk by chunk and writes the results as they are computed.
+
+    Args:
+        gene_signature (str): The signature, one of gene_signature_scores.signatures.
+        levels (Dict[str, float]): The score value of each gs_score level, e.g. gs_score_levels["gs4"]["os"].
+        genes (List[str]): The genes of the matrix columns, as returned by read_delimited.
+        chunks (Iterable[Tuple[List[str], np.ndarray, Dict[int, str]]]): The (sample ids, expression,
+            errors) chunks.
+        ndjson (bool): Writes one JSON object per sample instead of CSV rows.
+
+    Yields:
+        str: The header, if any, then the rows of each chunk: sample id, linear predictor,
+            response probability and gs_score level, or sample id and error for the malformed rows.
+    """
+    signature = signatures[gene_signature]
+
+    if not ndjson:
+        yield "sample,gs_score_value,probability,gs_score,error\r\n"
+
+    for samples, matrix, errors in chunks:
+        linear_predictor = signature.linear_predictor(matrix, genes)
+        probability = 1.0 / (1.0 + np.exp(-linear_predictor))
+        rows = zip(samples, linear_predictor.tolist(), probability.tolist(), score_levels(linear_predictor, levels))
+
+        output = io.StringIO()
+        writer = None if ndjson else csv.writer(output)
+        for position, (sample, value, p, level) in enumerate(rows):
+            error = errors.get(position)
+            if ndjson:
+                record = {"sample": sample, "error": error} if error else \
+                    {"sample": sample, "gs_score_value": value, "probability": p, "gs_score": level}
+                output.write(json.dumps(record) + "\n")
+            else:
+                writer.writerow([sample, "", "", "", error] if error else [sample, value, p, level, ""])
+        yield output.getvalue()
+
+
+@app.route('/signature_scores', methods=['POST'])
+@swag_from('models.yml')
+def signature_scores():
+    """
+    Endpoint for scoring the gene signature of a whole cohort from its expression matrix.
+
+    The request body is a samples x genes matrix in CSV, TSV or Parquet, selected with
+    the Content-Type header, and may be sent with chunked transfer encoding. Rows are
+    parsed and scored in chunks of STREAM_BATCH_SIZE samples, keeping only the signature
+    genes, and the scores are streamed back as CSV (or NDJSON with Accept: application/x-ndjson).
+
+    The gs_score level of each sample is the one expected by the scenario endpoints
+    for the outcome given in the query parameters, e.g. ?signature=gs4&outcome=dfs.
+    """
+    gene_signature = request.args.get('signature', 'gs4')
+    outcome = request.args.get('outcome', 'os')
+
+    if gene_signature not in signatures or outcome not in gs_score_levels.get(gene_signature, {}):
+        return "Bad request: unknown gene signature or outcome.", 400
+
+    genes = signatures[gene_signature].genes
+    chunk_size = app.config['STREAM_BATCH_SIZE']
+    upload = None
+
+    try:
+        if request.mimetype in PARQUET_MIMETYPES:
+            # The Parquet metadata is at the end of the file, so the upload is spooled to disk first
+            upload = tempfile.TemporaryFile()
+            shutil.copyfileobj(request.stream, upload)
+            upload.seek(0)
+            found, chunks = read_parquet(upload, genes, chunk_size)
+        else:
+            lines = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+            delimiter = EXPRESSION_DELIMITERS.get(request.mimetype, ",")
+            found, chunks = read_delimited(lines, genes, delimiter, chunk_size)
+    except ValueError as e:
+        if upload is not None:
+            upload.close()
+        return str(e), 400
+
+    ndjson = request.accept_mimetypes.best_match(["text/csv", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+    def generate():
+        try:
+            yield from score_expression(gene_signature, gs_score_levels[gene_signature][outcome],
+                                        found, chunks, ndjson)
+        finally:
+            if upload is not None:
+                upload.close()
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE if ndjson else "text/csv")
+
+
+# Fields of the hazard_ratios and rmst documents used in the responses.
+HAZARD_RATIO_PROJECTION = {"_id": 0, "HR": 1, "HR_upper95": 1, "HR_lower95": 1, "P_value": 1, "comparison": 1}
+RESTRICTED_MEAN_PROJECTION = {"_id": 0, "RMST_diff": 1, "RMST_diff_upper": 1, "RMST_diff_lower": 1,
+                              "timepoint": 1, "comparison": 1}
+
+def create_hazard_ratio_index(database, collection_name: str = "hazard_ratios") -> None:
+    """
+    Creates the index on the model name used by get_hazard_ratios.
+
+    Args:
+        database: The MongoDB database holding the hazard_ratios collection.
+        collection_name (str): The name of the collection, see ModelData.collection_name.
+    """
+    database[collection_name].create_index("model")
+
+
+def get_hazard_ratio_summary(hazard_ratio_data: Iterable[Dict[str, object]]) -> Dict[str, list]:
+    """
+    Extracts the hazard ratios from the documents of the hazard_ratios collection.
+
+    Args:
+        hazard_ratio_data (Iterable[Dict[str, object]]): The documents retrieved for a model.
+
+    Returns:
+        Dict[str, list]: The hazard ratios with confidence intervals, p-values and comparisons.
+    """
+    # Extract the relevant data from the retrieved documents
+    hazard_ratio = []
+    hr_upper_ci = []
+    hr_lower_ci = []
     p_value = []
     comparison = []
     for row in hazard_ratio_data:  
@@ -646,42 +1518,124 @@ def hazard_ratios():
         "comparison": comparison
     }
 
-    return jsonify(response)
+    return response
 
 
-@app.route('/restricted_mean', methods=['POST'])
+def get_hazard_ratios(model_name: str, data: Optional[ModelData] = None) -> Dict[str, list]:
+    """
+    Retrieves the hazard ratios of a model with an exact match on its name.
+
+    Args:
+        model_name (str): The model name, as returned by select_model.
+        data (Optional[ModelData]): The model data to read, the one bound to the request by default.
+
+    Returns:
+        Dict[str, list]: The hazard ratios with confidence intervals, p-values and comparisons.
+    """
+    # The hazard_ratios collection is static within a version, so each model is queried once
+    data = data or current_model_data()
+    hazard_ratio_cache = data.hazard_ratios
+    if model_name in hazard_ratio_cache:
+        count_cache("hazard_ratios", 1, 0)
+        return hazard_ratio_cache[model_name]
+    count_cache("hazard_ratios", 0, 1)
+
+    if data.snapshot is not None:
+        response = get_hazard_ratio_summary(data.snapshot.documents("hazard_ratios", model_name))
+        if response["hazard_ratio"]:
+            hazard_ratio_cache[model_name] = response
+        return response
+
+    collection = get_db()[data.collection_name("hazard_ratios")]
+    # Construct the query for retrieving the hazard ratios from MongoDB
+    query = {
+        "model": model_name
+    }
+    
+    # Query the MongoDB collection to retrieve the hazard ratios
+    hazard_ratio_data = timed_cursor(collection.find(query, HAZARD_RATIO_PROJECTION))
+
+    response = get_hazard_ratio_summary(hazard_ratio_data)
+
+    # Only models present in the collection are cached, to keep the cache bounded
+    if response["hazard_ratio"]:
+        hazard_ratio_cache[model_name] = response
+
+    return response
+
+
+@app.route('/hazard_ratios', methods=['POST'])
 @swag_from('models.yml')
-def restricted_mean():
+def hazard_ratios():
     """
-    Endpoint for calculating restricted mean survival time for gene signature models.
+    Endpoint for retrieving hazard ratios for the gene signature models.
     
-    Retrieves the request body parameters and calculates the restricted mean survival time
-    based on the selected clinical scenario, outcome, gene signature type, and censoring time.
+    Retrieves the request body parameters and calculates the hazard ratios
+    based on the selected outcome, gene signature type, and censoring time.
     
-    Returns the restricted mean survival time along with confidence intervals, time points,
-    and comparisons as a JSON response.
+    Returns the hazard ratios along with confidence intervals, p-value, and comparison as a JSON response.
     """
     
     # Retrieve request body parameters
     request_data = request.json
-    clinical_scenario = request_data.get('clinical_scenario')
-    outcome = request_data.get('outcome')
-    gene_signature_type = request_data.get('gene_signature_type')
-    censoring_time = request_data.get('censoring_time')
 
-    model_name = select_model(clinical_scenario, outcome, gene_signature_type, censoring_time)
+    try:
+        return hazard_ratio_response(request_data)
+    except ValueError as e:
+        return str(e), 400
 
-    collection = db["rmst"]
 
-    print(model_name)
-    # Construct the query for retrieving the restricted mean survival time data from MongoDB
-    query = {
-        "mod_name":  model_name
-    }
-    
-    # Query the MongoDB collection to retrieve the restricted mean survival time data
-    restricted_mean_data = collection.find(query)
+def signature_model(request_data: Dict[str, object]) -> str:
+    """
+    Resolves the model of a /hazard_ratios or /restricted_mean request through the model registry.
+
+    Args:
+        request_data (Dict[str, object]): The validated request body.
+
+    Returns:
+        str: The model name.
+
+    Raises:
+        ValueError: If no model was fitted for the clinical scenario, gene signature type
+            and censoring time, e.g. a class model of scenario 3.
+    """
+    with timed("model_selection"):
+        try:
+            model = model_registry.resolve(str(request_data.get('clinical_scenario')), request_data.get('outcome'),
+                                           request_data.get('gene_signature_type'), request_data.get('censoring_time'))
+        except KeyError:
+            raise ValueError("Bad request: no model for this clinical scenario, gene signature type "
+                             "and censoring time.")
+    return model.name
+
+
+def hazard_ratio_response(request_data: Dict[str, object]) -> Response:
+    """
+    Builds the response of /hazard_ratios, for its POST and GET variants.
+
+    Raises:
+        ValueError: If the request is not valid against models.yml, or selects no model.
+    """
+    with timed("validation"):
+        request_validators['hazard_ratios'].validate(request_data)
+
+    model_name = signature_model(request_data)
+    response = get_hazard_ratios(model_name)
+
+    return render(response)
+
+
+def get_restricted_mean_summary(restricted_mean_data: Iterable[Dict[str, object]]) -> Dict[str, list]:
+    """
+    Extracts the restricted mean survival time differences from the documents of the rmst collection.
+
+    Args:
+        restricted_mean_data (Iterable[Dict[str, object]]): The documents retrieved for a model.
 
+    Returns:
+        Dict[str, list]: The restricted mean survival time differences with confidence intervals,
+            time points and comparisons.
+    """
     # Extract the relevant data from the retrieved documents
     rmst_diff = []
     rmst_diff_upper_ci = []
@@ -704,15 +1658,427 @@ def restricted_mean():
         "comparison": comparison
     }
 
-    return jsonify(response)
+    return response
 
 
-if __name__ == '__main__':
-    from pymongo import MongoClient
+def get_restricted_mean(model_name: str, data: Optional[ModelData] = None) -> Dict[str, list]:
+    """
+    Retrieves the restricted mean survival time differences of a model.
+
+    Args:
+        model_name (str): The model name, as returned by select_model.
+        data (Optional[ModelData]): The model data to read, the one bound to the request by default.
+
+    Returns:
+        Dict[str, list]: The restricted mean survival time differences with confidence intervals,
+            time points and comparisons.
+    """
+    data = data or current_model_data()
+    cache_key = (data.version, "rmst", model_name)
+    response = response_cache.get(cache_key)
+    if response is not MISSING:
+        count_cache("response", 1, 0)
+        return response
+    count_cache("response", 0, 1)
+
+    if data.snapshot is not None:
+        response = get_restricted_mean_summary(data.snapshot.documents("rmst", model_name))
+        if response["rmst_diff"]:
+            response_cache.set(cache_key, response)
+        return response
+
+    collection = get_db()[data.collection_name("rmst")]
+
+    # Construct the query for retrieving the restricted mean survival time data from MongoDB
+    query = {
+        "mod_name":  model_name
+    }
+    
+    # Query the MongoDB collection to retrieve the restricted mean survival time data
+    restricted_mean_data = timed_cursor(collection.find(query, RESTRICTED_MEAN_PROJECTION))
+
+    response = get_restricted_mean_summary(restricted_mean_data)
+
+    # As for the hazard ratios, models missing from the collection are not cached
+    if response["rmst_diff"]:
+        response_cache.set(cache_key, response)
+
+    return response
 
-    client = MongoClient('mongodb://localhost:27017/')  
-    db = client['supertreat'] 
+
+@app.route('/restricted_mean', methods=['POST'])
+@swag_from('models.yml')
+def restricted_mean():
+    """
+    Endpoint for calculating restricted mean survival time for gene signature models.
+    
+    Retrieves the request body parameters and calculates the restricted mean survival time
+    based on the selected clinical scenario, outcome, gene signature type, and censoring time.
+    
+    Returns the restricted mean survival time along with confidence intervals, time points,
+    and comparisons as a JSON response.
+    """
     
-    app.run(port=8001, debug=True)
+    # Retrieve request body parameters
+    request_data = request.json
+
+    try:
+        return restricted_mean_response(request_data)
+    except ValueError as e:
+        return str(e), 400
+
+
+def restricted_mean_response(request_data: Dict[str, object]) -> Response:
+    """
+    Builds the response of /restricted_mean, for its POST and GET variants.
+
+    Raises:
+        ValueError: If the request is not valid against models.yml, or selects no model.
+    """
+    with timed("validation"):
+        request_validators['restricted_mean'].validate(request_data)
+
+    model_name = signature_model(request_data)
+    response = get_restricted_mean(model_name)
+
+    return render(response)
+
+
+def scenario_response(endpoint: str, request_data: Dict[str, object]) -> Response:
+    """
+    Builds the response of a scenario endpoint, for its GET variant.
+
+    Raises:
+        ValueError: If the request is not valid against models.yml.
+    """
+    model_name, query = scenario_queries[endpoint](request_data)
+
+    return trajectory_response(model_name, query)
+
+
+# Builders of the responses served by the GET variants, keyed on endpoint name.
+get_responses = dict(
+    {endpoint: functools.partial(scenario_response, endpoint) for endpoint in scenario_queries},
+    hazard_ratios=hazard_ratio_response,
+    restricted_mean=restricted_mean_response
+)
+
+
+def data_version() -> str:
+    """
+    Returns the version of the model data served, which the ETags are derived from.
+
+    The published version of the collections, or the version of the snapshot served.
+    For the unversioned collections, DATA_VERSION when set (e.g. the data release loaded
+    in MongoDB), otherwise the time the data was last loaded by this process.
+    """
+    data = current_model_data()
+    if data.collection_version is None and data.snapshot is None and app.config['DATA_VERSION']:
+        return app.config['DATA_VERSION']
+    return data.version
+
+
+def query_fields(endpoint: str) -> List[str]:
+    """
+    Lists the fields a GET variant accepts as query parameters: the scalar fields its validator checks.
+    """
+    properties = request_schemas[endpoint]
+    return sorted(field for field in request_validators[endpoint].checks
+                  if properties[field].get("type") not in ("object", "array"))
+
+
+def canonical_query(args, fields: Iterable[str]) -> str:
+    """
+    Builds the canonical query string of a GET variant: the known, non-empty fields
+    (and precision) in alphabetical order.
+
+    Examples:
+        >>> canonical_query({"outcome": "os", "stream": "1", "clinical_sex": "male", "hpv_status": ""},
+        ...                 ["clinical_sex", "hpv_status", "outcome"])
+        'clinical_sex=male&outcome=os'
+    """
+    fields = list(fields) + ["precision"]
+    return urlencode(sorted((field, args[field]) for field in fields if args.get(field) not in (None, "")))
+
+
+def response_etag(endpoint: str, query_string: str, mimetype: str) -> str:
+    """
+    Derives the strong ETag of a GET response from the data version and the canonical request.
+
+    The response of a canonical request only depends on the model data, so the ETag is
+    known before any work, and conditional requests are answered without querying MongoDB.
+    """
+    digest = hashlib.sha256("\n".join([data_version(), endpoint, query_string, mimetype]).encode())
+    return digest.hexdigest()[:32]
+
+
+def set_cache_headers(response: Response, etag: str) -> Response:
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['HTTP_MAX_AGE']
+    response.vary.add('Accept')
+    return response
+
+
+def query_parameters_spec(endpoint: str) -> Dict[str, object]:
+    """
+    Builds the Swagger spec of a GET variant from the request body schema of its POST route in models.yml.
+    """
+    parameters = []
+    for field in query_fields(endpoint):
+        schema = request_schemas[endpoint][field]
+        parameter = {"name": field, "in": "query", "type": schema.get("type", "string")}
+        for option in ("description", "minimum", "maximum"):
+            if option in schema:
+                parameter[option] = schema[option]
+        if "enum" in schema:
+            parameter["enum"] = enum_values(schema)
+        parameters.append(parameter)
+    parameters.append({"name": "precision", "in": "query", "type": "integer", "minimum": 1, "maximum": MAX_PRECISION,
+                       "description": "Significant digits of the survival probabilities, full precision by default"})
+
+    return {
+        "summary": "Cacheable variant of POST /" + endpoint,
+        "description": "Same response as POST /" + endpoint + ", with the request fields as query parameters "
+                       "in alphabetical order. Non-canonical URLs are redirected to the canonical one.",
+        "parameters": parameters,
+        "responses": {
+            "200": {"description": "Same as POST /" + endpoint + ", with an ETag and Cache-Control headers"},
+            "304": {"description": "Not modified, the ETag in If-None-Match is current"},
+            "308": {"description": "Redirect to the canonical URL"},
+            "400": {"description": "Bad request"}
+        }
+    }
+
+
+def cacheable_get(endpoint: str) -> callable:
+    """
+    Builds the GET variant of an endpoint, answering conditional requests with 304 Not Modified.
+    """
+    fields = query_fields(endpoint)
+
+    @swag_from(query_parameters_spec(endpoint))
+    def view():
+        query_string = canonical_query(request.args, fields)
+        if request.query_string.decode('latin-1') != query_string:
+            return redirect(request.path + ("?" + query_string if query_string else ""), code=308)
+
+        etag = response_etag(endpoint, query_string, negotiate(request.accept_mimetypes))
+        # The client holds either the uncompressed or a compressed representation, see compress_response
+        for current in [etag] + [encoded_etag(etag, encoding) for encoding in ENCODINGS]:
+            if current in request.if_none_match:
+                not_modified = set_cache_headers(Response(status=304), current)
+                # The 200 response varies on Accept-Encoding too when compressed, see compress_response
+                if app.config['COMPRESSION']:
+                    not_modified.vary.add('Accept-Encoding')
+                return not_modified
+
+        try:
+            response = get_responses[endpoint](request.args.to_dict())
+        except ValueError as e:
+            return str(e), 400
+
+        if response.status_code == 200:
+            set_cache_headers(response, etag)
+        return response
+
+    return view
+
+
+for get_endpoint in get_responses:
+    app.add_url_rule('/' + get_endpoint, get_endpoint + '_get', cacheable_get(get_endpoint), methods=['GET'])
+
+
+@app.route('/cache_stats', methods=['GET'])
+@swag_from('models.yml')
+def cache_stats():
+    """
+    Endpoint for monitoring the response cache.
+
+    Returns the hit and miss counters, evictions and size of the cache as a JSON response.
+    """
+    return jsonify(response_cache.stats())
+
+
+@app.route('/reload', methods=['POST'])
+@swag_from('models.yml')
+def reload():
+    """
+    Endpoint reloading the model data, e.g. once a new version has been published.
+
+    The new version is loaded in the background while the current one keeps serving, and
+    swapped in once complete. The caller must send the RELOAD_TOKEN of the configuration in
+    the X-Reload-Token header; without a token configured, reloads are only done by the
+    version poller. Returns 202 with the version served, 403 for a missing or wrong token,
+    or 409 if a reload is already running.
+    """
+    token = app.config['RELOAD_TOKEN']
+    if not token:
+        return "Forbidden: reloading is disabled, set SUPERTREAT_RELOAD_TOKEN to enable it.", 403
+    if not hmac.compare_digest(request.headers.get('X-Reload-Token', '').encode(), token.encode()):
+        return "Forbidden: invalid reload token.", 403
+
+    if not start_reload():
+        return "Conflict: the model data is already being reloaded.", 409
+
+    return jsonify(data_version_status()), 202
+
+
+@app.route('/data_version', methods=['GET'])
+@swag_from('models.yml')
+def data_version_info():
+    """
+    Endpoint reporting the version of the model data served and the state of its reload.
+    """
+    return jsonify(data_version_status())
+
+
+def data_version_status() -> Dict[str, object]:
+    return {
+        "version": model_data.version,
+        "collection_version": model_data.collection_version,
+        "snapshot": model_data.snapshot.version if model_data.snapshot is not None else None,
+        "loaded_at": model_data.loaded_at,
+        "reloading": reload_thread is not None and reload_thread.is_alive(),
+        "error": reload_error
+    }
+
+
+@app.route('/metrics', methods=['GET'])
+@swag_from('models.yml')
+def metrics():
+    """
+    Endpoint for Prometheus.
+
+    Returns the latency histograms of every route and phase, and the document, empty
+    trajectory and cache counters of this process in the Prometheus text format.
+    """
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.before_request
+def start_timing():
+    start_request(request.endpoint)
+
+
+@app.before_request
+def bind_model_data():
+    """
+    Binds the model data served when the request starts, which the request uses until it ends.
+    """
+    start_version_poller()
+    g.model_data_token = request_model_data.set(model_data)
+
+
+@app.teardown_request
+def unbind_model_data(exception=None):
+    token = g.pop('model_data_token', None)
+    if token is not None:
+        request_model_data.reset(token)
+
+
+@app.before_request
+def check_precision():
+    try:
+        request_precision()
+    except ValueError as e:
+        return str(e), 400
+
+
+@app.after_request
+def record_timing(response: Response) -> Response:
+    """
+    Records the duration of the request, and adds its phases as a Server-Timing header when SERVER_TIMING is set.
+    """
+    timings = current_timings.get()
+    if timings is not None:
+        duration = finish_request(timings, response.status_code)
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = timings.server_timing(total=duration)
+
+    return response
+
+
+# Content encodings whose library is installed, in order of preference
+content_encodings = available_encodings()
+
+
+# Registered after record_timing, so that it runs before it and the compression is timed
+@app.after_request
+def compress_response(response: Response) -> Response:
+    """
+    Compresses the body of the response in the encoding negotiated with the Accept-Encoding
+    header, when COMPRESSION is set and the body is at least COMPRESSION_MIN_SIZE bytes.
+
+    Streamed responses are sent as they are written, uncompressed.
+    """
+    if not app.config['COMPRESSION'] or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if response.content_length < app.config['COMPRESSION_MIN_SIZE']:
+        return response
+    encoding = negotiate_encoding(request.accept_encodings, content_encodings)
+    if encoding is None:
+        return response
+
+    with timed("compression"):
+        response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(encoded_etag(etag, encoding), weak)
+
+    return response
+
+
+def configure_app(config: Dict[str, object] = None) -> Flask:
+    """
+    Configures the application of this module and loads its model data, for the WSGI/ASGI
+    entry points and the development server.
+
+    The routes are registered on the module-level app, so there is a single application
+    per process: this configures and returns it rather than building a new one.
+
+    Args:
+        config (Dict[str, object]): Settings overriding the defaults read from the environment.
+
+    Returns:
+        Flask: The configured application.
+    """
+    if config:
+        app.config.update(config)
+
+    response_cache.maxsize = app.config['CACHE_SIZE']
+    response_cache.ttl = app.config['CACHE_TTL']
+
+    global model_data
+
+    model_data = load_model_data()
+
+    # A snapshot replaces MongoDB altogether
+    if app.config['SNAPSHOT_PATH']:
+        return app
+
+    create_hazard_ratio_index(get_db(), model_data.collection_name("hazard_ratios"))
+
+    if app.config['WARMUP']:
+        report = warm_up(app.config, workers=app.config['WARMUP_WORKERS'])
+        app.logger.info("Warm-up: %d of %d covariate combinations have a trajectory",
+                        report["found"], report["expected"])
+        for model in report["models"]:
+            if model["n_gaps"]:
+                app.logger.warning("%s: %d covariate combinations without trajectory", model["model"], model["n_gaps"])
+
+    return app
+
+
+if __name__ == '__main__':
+    configure_app()
+
+    app.run(port=8001, debug=app.config['DEBUG'])
 
 
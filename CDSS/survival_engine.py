@@ -0,0 +1,178 @@
+"""
+On-the-fly survival predictions from the fitted Cox model coefficients.
+
+Instead of looking up one precomputed trajectory per covariate combination,
+each model is stored once as its baseline survival S0(t) and coefficient
+vector beta, and the trajectory of a patient with covariates x is
+
+    S(t|x) = S0(t) ^ exp((x - center) beta)
+
+with pointwise confidence intervals on the log(-log) scale,
+
+    S(t|x) ^ exp(-/+ z se(t|x)),  se(t|x)^2 = x_c Sigma x_c' + var(log H0(t)),
+
+where Sigma is the covariance matrix of beta and H0 = -log S0 the baseline
+cumulative hazard. Predictions are vectorized over patients and time points.
+
+The model documents live in the model_coefficients collection:
+
+    {
+        "model": "gs1_score_interaction_os_24m",
+        "time": [0, 1, ...],
+        "baseline_survival": [1.0, 0.99, ...],
+        "terms": ["clinical_age_at_diagnosis", "clinical_sex=male", "gs1_score",
+                  "gs1_score:chemo_chemotherapy_treatment=yes", ...],
+        "coefficients": [0.02, 0.3, ...],
+        "center": [60.1, 0.7, ...],                  # optional
+        "covariance": [[...], ...],                  # optional
+        "baseline_log_cumhaz_variance": [0.0, ...]   # optional
+    }
+
+A term is a numeric field ("gs1_score"), an indicator ("clinical_sex=male")
+or an interaction of both joined by ":".
+"""
+from typing import Dict, Iterable, List, Mapping, Optional
+
+import numpy as np
+
+from trajectory_store import TRAJECTORY_FIELDS
+
+# Quantile of the standard normal distribution for 95% confidence intervals
+Z_95 = 1.959963984540054
+
+
+def term_value(term: str, covariates: Mapping[str, object]) -> float:
+    """
+    Evaluates one model term for a patient.
+
+    Args:
+        term (str): A numeric field, an indicator "field=level", or an interaction "a:b".
+        covariates (Mapping[str, object]): The covariates of the patient, e.g. an endpoint query.
+
+    Returns:
+        float: The value of the term in the design matrix.
+
+    Examples:
+        >>> term_value("clinical_sex=male", {"clinical_sex": "male"})
+        1.0
+        >>> term_value("gs1_score:chemo_chemotherapy_treatment=yes", {"gs1_score": 0.4, "chemo_chemotherapy_treatment": "no"})
+        0.0
+    """
+    value = 1.0
+    for factor in term.split(":"):
+        if "=" in factor:
+            field, level = factor.split("=", 1)
+            value *= 1.0 if str(covariates.get(field)) == level else 0.0
+        else:
+            value *= float(covariates[factor])
+    return value
+
+
+class CoxModel:
+    """
+    A fitted Cox proportional hazards model: baseline survival and coefficients.
+    """
+
+    def __init__(self, time: Iterable[float], baseline_survival: Iterable[float], terms: List[str],
+                 coefficients: Iterable[float], center: Optional[Iterable[float]] = None,
+                 covariance: Optional[Iterable[Iterable[float]]] = None,
+                 baseline_log_cumhaz_variance: Optional[Iterable[float]] = None):
+        self.time = np.asarray(time)
+        self.baseline_survival = np.asarray(baseline_survival, dtype=np.float64)
+        self.terms = list(terms)
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+        self.center = np.zeros(len(self.terms)) if center is None else np.asarray(center, dtype=np.float64)
+        self.covariance = None if covariance is None else np.asarray(covariance, dtype=np.float64)
+        self.baseline_log_cumhaz_variance = (np.zeros(len(self.time)) if baseline_log_cumhaz_variance is None
+                                             else np.asarray(baseline_log_cumhaz_variance, dtype=np.float64))
+
+    @classmethod
+    def from_document(cls, document: Mapping[str, object]) -> "CoxModel":
+        return cls(document["time"], document["baseline_survival"], document["terms"], document["coefficients"],
+                   document.get("center"), document.get("covariance"), document.get("baseline_log_cumhaz_variance"))
+
+    def design_matrix(self, patients: Iterable[Mapping[str, object]]) -> np.ndarray:
+        """
+        Builds the centered patients x terms design matrix.
+        """
+        values = [[term_value(term, patient) for term in self.terms] for patient in patients]
+        return np.asarray(values, dtype=np.float64).reshape(-1, len(self.terms)) - self.center
+
+    def predict(self, patients: Iterable[Mapping[str, object]], z: float = Z_95) -> Dict[str, np.ndarray]:
+        """
+        Computes the survival trajectories of several patients at once.
+
+        Args:
+            patients (Iterable[Mapping[str, object]]): The covariates of each patient.
+            z (float): The normal quantile of the confidence intervals.
+
+        Returns:
+            Dict[str, np.ndarray]: 'survival_probability', 'ci_lower' and 'ci_upper' as
+                patients x time points arrays, and the shared 'time' grid.
+        """
+        x = self.design_matrix(patients)
+        linear_predictor = x @ self.coefficients
+
+        # S(t|x) = S0(t)^exp(x beta), computed on the log scale
+        log_survival = np.log(self.baseline_survival)[np.newaxis, :] * np.exp(linear_predictor)[:, np.newaxis]
+        survival = np.exp(log_survival)
+
+        variance = np.broadcast_to(self.baseline_log_cumhaz_variance, survival.shape)
+        if self.covariance is not None:
+            variance = variance + np.einsum("ij,jk,ik->i", x, self.covariance, x)[:, np.newaxis]
+        se = np.sqrt(variance)
+
+        return {
+            "survival_probability": survival,
+            "time": self.time,
+            "ci_lower": survival ** np.exp(z * se),
+            "ci_upper": survival ** np.exp(-z * se)
+        }
+
+
+class SurvivalEngine:
+    """
+    Registry of the Cox models computing trajectories on the fly, keyed on model name.
+    """
+
+    def __init__(self):
+        self._models: Dict[str, CoxModel] = {}
+
+    def __contains__(self, model_name: str) -> bool:
+        return model_name in self._models
+
+    def load(self, collection) -> int:
+        """
+        Loads every model of the model_coefficients collection.
+
+        Returns:
+            int: The number of models loaded.
+        """
+        for document in collection.find({}, {"_id": 0}):
+            self._models[document["model"]] = CoxModel.from_document(document)
+        return len(self._models)
+
+    def predict(self, model_name: str, queries: List[Mapping[str, object]]) -> List[Dict[str, list]]:
+        """
+        Computes the trajectories of the patients described by endpoint queries.
+
+        Args:
+            model_name (str): The model name, as returned by select_model.
+            queries (List[Mapping[str, object]]): The queries built by the endpoint, one per patient.
+
+        Returns:
+            List[Dict[str, list]]: The patient trajectories, as returned by get_patient_trajectory.
+        """
+        if not queries:
+            return []
+
+        prediction = self._models[model_name].predict(queries)
+        time = prediction["time"].tolist()
+
+        return [
+            {field: time if field == "time" else prediction[field][patient].tolist() for field in TRAJECTORY_FIELDS}
+            for patient in range(len(queries))
+        ]
+
+    def clear(self):
+        self._models.clear()
@@ -0,0 +1,75 @@
+"""
+Tests of the compact storage of the trajectories and of its serving, see conftest.py for the fixtures.
+"""
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import supertreat_api
+from compact_storage import GRID_COLLECTION, GRID_FIELD, QUANTIZATION_ERROR, compact_collection_name, migrate_model
+from model_registry import model_covariates
+from supertreat_api import scenario_queries
+
+
+def test_migrate_model_writes_grid_before_rename(database, payloads, monkeypatch):
+    model_name, _ = scenario_queries["base_model"](payloads["base_model"][0])
+    grids = []
+    rename = mongomock.collection.Collection.rename
+
+    def checked_rename(collection, new_name, **kwargs):
+        grids.append(database[GRID_COLLECTION].find_one({"model": model_name}))
+        return rename(collection, new_name, **kwargs)
+
+    monkeypatch.setattr(mongomock.collection.Collection, "rename", checked_rename)
+    stats = migrate_model(database, model_name, model_covariates(model_name))
+
+    assert stats["trajectories"] > 0
+    assert len(grids) == 1 and grids[0]["time"] == list(range(13))
+    assert database[compact_collection_name(model_name)].count_documents({}) == stats["trajectories"]
+
+
+def test_compact_trajectories(client, database, payloads):
+    body = payloads["base_model"][0]
+    model_name, _ = scenario_queries["base_model"](body)
+    original = client.post("/base_model", json=body).json
+
+    client.application.config.update(COMPACT_STORAGE=True)
+    supertreat_api.response_cache.clear()
+
+    # Before the conversion there is no grid, which is not cached
+    assert client.post("/base_model", json=body).json["time"] == []
+    assert not supertreat_api.model_data.time_grids
+
+    migrate_model(database, model_name, model_covariates(model_name))
+    supertreat_api.response_cache.clear()
+
+    compact = client.post("/base_model", json=body).json
+    assert compact["time"] == original["time"]
+    for field in ("survival_probability", "ci_lower", "ci_upper"):
+        assert compact[field] == pytest.approx(original[field], abs=QUANTIZATION_ERROR)
+    assert list(supertreat_api.model_data.time_grids.values()) == [original["time"]]
+
+
+def test_remigration_does_not_reuse_cached_grid(client, database, payloads):
+    body = payloads["base_model"][0]
+    model_name, _ = scenario_queries["base_model"](body)
+    client.application.config.update(COMPACT_STORAGE=True)
+
+    migrate_model(database, model_name, model_covariates(model_name))
+    first = client.post("/base_model", json=body).json
+    [(key, grid)] = supertreat_api.model_data.time_grids.items()
+
+    # Re-converted on a shorter time axis while the first grid is cached
+    database[model_name].delete_many({"model": model_name, "time": {"$gt": 6}})
+    migrate_model(database, model_name, model_covariates(model_name))
+    supertreat_api.response_cache.clear()
+
+    second = client.post("/base_model", json=body).json
+    assert second["time"] == first["time"][:7]
+    assert second["survival_probability"] == pytest.approx(first["survival_probability"][:7], abs=QUANTIZATION_ERROR)
+    assert supertreat_api.model_data.time_grids[key] == grid
+
+    # Only the grids of the current and the replaced conversions are kept
+    migrate_model(database, model_name, model_covariates(model_name))
+    migrations = [document[GRID_FIELD] for document in database[GRID_COLLECTION].find({"model": model_name})]
+    assert len(migrations) == 2 and key[1] not in migrations
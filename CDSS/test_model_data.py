@@ -0,0 +1,65 @@
+"""
+Tests of the versioned model data and its hot reload, see conftest.py for the fixtures.
+"""
+import supertreat_api
+from manage import publish
+from model_data import versioned_name
+from model_registry import list_model_names
+
+TOKEN = "secret"
+
+
+def copy_version(database, version, scale):
+    """
+    Copies the unversioned collections into the collections of a version, scaling the survival probabilities.
+    """
+    for name in list_model_names():
+        documents = [dict(document, survival_probability=document["survival_probability"] * scale)
+                     for document in database[name].find({}, {"_id": 0})]
+        database[versioned_name(version, name)].insert_many(documents)
+    for name in ("hazard_ratios", "rmst"):
+        database[versioned_name(version, name)].insert_many(list(database[name].find({}, {"_id": 0})))
+
+
+def reload(client, token=TOKEN):
+    response = client.post("/reload", headers={"X-Reload-Token": token} if token is not None else {})
+    if response.status_code == 202:
+        supertreat_api.reload_thread.join()
+    return response
+
+
+def test_reload_requires_token(client):
+    client.application.config.update(RELOAD_TOKEN=None)
+    assert reload(client).status_code == 403
+
+    client.application.config.update(RELOAD_TOKEN=TOKEN)
+    assert reload(client, token=None).status_code == 403
+    assert reload(client, token="wrong").status_code == 403
+    assert reload(client).status_code == 202
+
+
+def test_publish_and_reload(client, database, payloads):
+    client.application.config.update(RELOAD_TOKEN=TOKEN)
+    body = payloads["base_model"][0]
+    before = client.post("/base_model", json=body).json
+    assert client.get("/data_version").json["collection_version"] is None
+
+    # A version is only published once all of its collections exist
+    assert not publish(database, "2024-05")
+    copy_version(database, "2024-05", 0.5)
+    assert publish(database, "2024-05")
+
+    # The published version is served after the reload, the cached response of the previous one is not
+    assert client.post("/base_model", json=body).json == before
+    assert reload(client).status_code == 202
+    status = client.get("/data_version").json
+    assert status["version"] == status["collection_version"] == "2024-05"
+    assert status["error"] is None and not status["reloading"]
+
+    after = client.post("/base_model", json=body).json
+    assert after["time"] == before["time"]
+    assert after["survival_probability"] == [value * 0.5 for value in before["survival_probability"]]
+
+    # The hazard ratios of the new version are retrieved before the swap
+    model_name, _ = supertreat_api.scenario_queries["radiosensitivity"](payloads["radiosensitivity"][0])
+    assert supertreat_api.model_data.hazard_ratios[model_name]["hazard_ratio"]
@@ -0,0 +1,423 @@
+"""
+Tests of the API endpoints through the Flask test client, see conftest.py for the fixtures.
+"""
+import csv
+import gzip
+import io
+import json
+import math
+
+import pytest
+
+import supertreat_api
+from gene_signature_scores import signatures
+from model_registry import list_model_names, model_covariates, model_registry
+from serializers import round_significant
+from conftest import TIME_POINTS
+from snapshot import export_snapshot
+from supertreat_api import canonical_query, query_fields, scenario_queries
+
+
+def query_string(endpoint, payload, **extra):
+    """
+    Builds the canonical query string of the GET variant of a request body.
+    """
+    args = {field: str(value) for field, value in dict(payload, **extra).items() if value is not None}
+    return canonical_query(args, query_fields(endpoint))
+
+
+def test_scenario_endpoints(client, payloads):
+    for endpoint, bodies in payloads.items():
+        response = client.post("/" + endpoint, json=bodies[0])
+        assert response.status_code == 200, endpoint
+        trajectory = response.json
+        assert len(trajectory["time"]) == len(trajectory["survival_probability"]) > 0
+
+
+def test_scenario_endpoint_rejects_invalid_request(client, payloads):
+    response = client.post("/base_model", json=dict(payloads["base_model"][0], clinical_age_at_diagnosis=200))
+    assert response.status_code == 400
+    assert b"clinical_age_at_diagnosis" in response.data
+
+    response = client.post("/base_model", json=dict(payloads["base_model"][0], outcome=None))
+    assert response.status_code == 400
+
+
+def test_gs_score_value(client, database, payloads):
+    body = dict(payloads["radiosensitivity"][0], gene_signature_type="score", gs_score=None, gs_score_value=0.25)
+    model_name, _ = scenario_queries["radiosensitivity"](dict(body, gs_score_value=None, gs_score=0))
+
+    # Precomputed trajectories only exist for the gs_score levels
+    response = client.post("/radiosensitivity", json=body)
+    assert response.status_code == 400
+    assert b"gs_score_value" in response.data
+
+    term = model_registry.models[model_name].term
+    database["model_coefficients"].insert_one({
+        "model": model_name, "time": [0, 12, 24], "baseline_survival": [1.0, 0.9, 0.8],
+        "terms": [term], "coefficients": [1.0]
+    })
+    supertreat_api.load_survival_models(database)
+
+    response = client.post("/radiosensitivity", json=body)
+    assert response.status_code == 200
+    assert response.json["survival_probability"] == pytest.approx([1.0, 0.9 ** math.exp(0.25), 0.8 ** math.exp(0.25)])
+
+
+def test_gene_expression(client, payloads):
+    body = dict(payloads["chemosensitivity_platinum"][0], gene_signature_type="score", gs_score=None)
+    response = client.post("/chemosensitivity_platinum", json=dict(body, gene_expression={"SLFN11": 1.0}))
+    assert response.status_code == 200
+
+    for gene_expression in ({}, {"GAPDH": 1.0}):
+        response = client.post("/chemosensitivity_platinum", json=dict(body, gene_expression=gene_expression))
+        assert response.status_code == 400
+        assert response.data == b"Bad request: none of the signature genes are in gene_expression."
+
+
+def signature_model_request(payloads, endpoint="radiosensitivity"):
+    body = payloads[endpoint][0]
+    model_name, _ = scenario_queries[endpoint](body)
+    model = model_registry.models[model_name]
+    return model_name, {"clinical_scenario": model.scenario.clinical_scenario, "outcome": model.outcome,
+                        "gene_signature_type": model.gene_signature_type, "censoring_time": int(model.censoring_time)}
+
+
+def test_hazard_ratios_and_restricted_mean(client, database, payloads):
+    model_name, body = signature_model_request(payloads)
+
+    hazard_ratios = client.post("/hazard_ratios", json=body)
+    assert hazard_ratios.status_code == 200
+    document = database["hazard_ratios"].find_one({"model": model_name})
+    assert hazard_ratios.json["hazard_ratio"] == [document["HR"]]
+
+    restricted_mean = client.post("/restricted_mean", json=body)
+    assert restricted_mean.status_code == 200
+    assert restricted_mean.json["time"] == [24, 60]
+
+    for endpoint in ("/hazard_ratios", "/restricted_mean"):
+        assert client.post(endpoint, json=dict(body, outcome="x")).status_code == 400
+        assert client.post(endpoint, json={"outcome": "os"}).status_code == 400
+
+
+@pytest.mark.parametrize("options", [
+    {"clinical_scenario": "3", "gene_signature_type": "class", "censoring_time": 24},
+    {"clinical_scenario": "5", "gene_signature_type": "score", "censoring_time": 60},
+    {"clinical_scenario": "6", "gene_signature_type": "score", "censoring_time": 60},
+])
+def test_signature_endpoints_reject_unknown_model(client, options):
+    for endpoint in ("/hazard_ratios", "/restricted_mean"):
+        response = client.post(endpoint, json=dict(options, outcome="os"))
+        assert response.status_code == 400
+        assert response.data.startswith(b"Bad request: no model")
+
+
+def test_restricted_mean_does_not_cache_missing_model(client, database, payloads):
+    model_name, body = signature_model_request(payloads)
+    documents = list(database["rmst"].find({"mod_name": model_name}))
+    database["rmst"].delete_many({"mod_name": model_name})
+    assert client.post("/restricted_mean", json=body).json["rmst_diff"] == []
+
+    database["rmst"].insert_many(documents)
+    assert len(client.post("/restricted_mean", json=body).json["rmst_diff"]) == len(documents)
+
+
+def test_content_negotiation(client, payloads):
+    msgpack = pytest.importorskip("msgpack")
+    body = payloads["base_model"][0]
+
+    response = client.post("/base_model", json=body, headers={"Accept": "application/msgpack"})
+    assert response.mimetype == "application/msgpack"
+    trajectory = msgpack.unpackb(response.data)
+    expected = client.post("/base_model", json=body).json
+    assert trajectory["time"] == expected["time"]
+    assert trajectory["survival_probability"] == pytest.approx(expected["survival_probability"])
+
+
+def test_preloaded_trajectories(client, database, payloads):
+    expected = {endpoint: client.post("/" + endpoint, json=bodies[0]).json for endpoint, bodies in payloads.items()}
+
+    supertreat_api.preload_trajectories(database)
+    database.client.drop_database(database.name)
+
+    for endpoint, bodies in payloads.items():
+        assert client.post("/" + endpoint, json=bodies[0]).json == expected[endpoint]
+
+
+def test_snapshot(client, database, payloads, tmp_path):
+    model_name, body = signature_model_request(payloads)
+    expected = {endpoint: client.post("/" + endpoint, json=bodies[0]).json for endpoint, bodies in payloads.items()}
+    hazard_ratios = client.post("/hazard_ratios", json=body).json
+
+    directory = export_snapshot(database, str(tmp_path), list_model_names(), model_covariates, version="v1")
+    supertreat_api.model_data = supertreat_api.load_snapshot(directory)
+    database.client.drop_database(database.name)
+
+    assert client.get("/data_version").json["snapshot"] == "v1"
+    for endpoint, bodies in payloads.items():
+        assert client.post("/" + endpoint, json=bodies[0]).json == expected[endpoint]
+    assert client.post("/hazard_ratios", json=body).json == hazard_ratios
+
+
+def test_precision(client, payloads):
+    full = client.post("/base_model", json=payloads["base_model"][0]).json
+    response = client.post("/base_model?precision=2", json=payloads["base_model"][0])
+    assert response.status_code == 200
+    assert response.json["survival_probability"] == round_significant(full["survival_probability"], 2)
+    assert response.json["time"] == full["time"]
+
+    assert client.post("/base_model?precision=0", json=payloads["base_model"][0]).status_code == 400
+
+
+def test_stream(client, payloads):
+    body = payloads["hpv_negative"][0]
+    streamed = client.post("/hpv_negative?stream=1", json=body)
+    assert streamed.status_code == 200
+    assert json.loads(streamed.get_data()) == client.post("/hpv_negative", json=body).json
+
+
+def test_stream_keeps_columns_aligned(client, database, payloads):
+    body = payloads["base_model"][0]
+    model_name, query = scenario_queries["base_model"](body)
+    database[model_name].delete_many(query)
+    # Inserted out of order, with a tie at time 12 and a document without ci_upper
+    database[model_name].insert_many([
+        dict(query, time=24, survival_probability=0.7, ci_lower=0.6, ci_upper=0.8),
+        dict(query, time=12, survival_probability=0.9, ci_lower=0.8, ci_upper=0.95),
+        dict(query, time=0, survival_probability=1.0, ci_lower=1.0),
+        dict(query, time=12, survival_probability=0.85, ci_lower=0.75, ci_upper=0.9),
+    ])
+
+    streamed = json.loads(client.post("/base_model?stream=1", json=body).get_data())
+    assert streamed == {"survival_probability": [1.0, 0.9, 0.85, 0.7], "time": [0, 12, 12, 24],
+                        "ci_lower": [1.0, 0.8, 0.75, 0.6], "ci_upper": [None, 0.95, 0.9, 0.8]}
+
+
+def test_batch(client, payloads):
+    patients = [dict(payloads[endpoint][0], endpoint=endpoint) for endpoint in payloads]
+    patients.append(dict(payloads["base_model"][0], endpoint="unknown"))
+
+    response = client.post("/batch", json={"patients": patients})
+    assert response.status_code == 200
+    results = response.json["results"]
+    assert len(results) == len(patients)
+    for patient, result in zip(patients[:-1], results):
+        assert result == client.post("/" + patient["endpoint"], json=patient).json
+    assert results[-1] == {"error": "Bad request: unknown endpoint."}
+
+    for body in ({"patients": "all"}, patients, "patients"):
+        response = client.post("/batch", json=body)
+        assert response.status_code == 400
+        assert response.data == b"Bad request: a list of patients is required."
+
+
+def test_cohort(client, payloads):
+    response = client.post("/cohort", json={
+        "endpoint": "base_model", "patients": payloads["base_model"],
+        "counterfactuals": {"chemo_chemotherapy_treatment": ["yes", "no"]}
+    })
+    assert response.status_code == 200
+    arms = response.json["arms"]
+    assert [arm["covariates"] for arm in arms] == [{"chemo_chemotherapy_treatment": "yes"},
+                                                   {"chemo_chemotherapy_treatment": "no"}]
+    assert all(difference in (0, None) for difference in arms[0]["difference"])
+
+    assert client.post("/cohort", json={"endpoint": "unknown", "patients": []}).status_code == 400
+    assert client.post("/cohort", json={"endpoint": "base_model"}).status_code == 400
+    assert client.post("/cohort", json=payloads["base_model"]).status_code == 400
+
+
+@pytest.mark.parametrize("body", [
+    {"patients": [5]},
+    {"patients": [{}], "counterfactuals": {"chemo_chemotherapy_treatment": []}},
+    {"patients": [{}], "quantiles": [True]},
+    {"distribution": {"clinical_sex": {"male": -0.5, "female": 1.5}}},
+    {"distribution": {"clinical_sex": {"male": 0, "female": 0}}},
+    {"distribution": {"clinical_sex": {}}},
+    {"distribution": {"clinical_sex": {"male": "most"}}},
+])
+def test_cohort_rejects_invalid_request(client, body):
+    response = client.post("/cohort", json=dict(body, endpoint="base_model"))
+    assert response.status_code == 400
+    assert response.data.startswith(b"Bad request")
+
+
+def test_cohort_does_not_extend_trajectories(client, database, payloads):
+    short, full = payloads["base_model"][:2]
+    model_name, query = scenario_queries["base_model"](short)
+    database[model_name].delete_many(dict(query, time={"$gt": TIME_POINTS // 2}))
+    trajectory = client.post("/base_model", json=full).json
+
+    response = client.post("/cohort", json={"endpoint": "base_model", "patients": [short, full]})
+    assert response.status_code == 200
+    arm = response.json["arms"][0]
+    assert arm["time"] == trajectory["time"]
+    # Beyond the end of the short trajectory, only the full one is left
+    end = TIME_POINTS // 2 + 1
+    assert arm["survival_probability"][end:] == pytest.approx(trajectory["survival_probability"][end:])
+    assert arm["quantiles"]["0.05"][end:] == pytest.approx(trajectory["survival_probability"][end:])
+
+
+def test_treatment_comparison(client, payloads):
+    body = dict(payloads["base_model"][0], endpoint="base_model")
+    response = client.post("/treatment_comparison", json=body)
+    assert response.status_code == 200
+    arms = response.json["arms"]
+    assert len(arms) == 8
+    reference = [arm for arm in arms if arm["treatments"] == response.json["reference"]]
+    assert len(reference) == 1
+    assert all(value in (0, None) for value in reference[0]["difference"].values())
+
+    assert client.post("/treatment_comparison", json=dict(body, timepoints="24")).status_code == 400
+    assert client.post("/treatment_comparison", json=dict(body, timepoints=[True])).status_code == 400
+    assert client.post("/treatment_comparison", json=[body]).status_code == 400
+
+    # The reference treatment is validated before the arms are built
+    for field, value, error in (("chemo_chemotherapy_treatment", None, "is required"),
+                                ("radio_radiotherapy_treatment", "maybe", "must be one of")):
+        response = client.post("/treatment_comparison", json=dict(body, **{field: value}))
+        assert response.status_code == 400
+        assert field + " " + error in response.get_data(as_text=True)
+    missing = {key: value for key, value in body.items() if key != "surge_undergone_cancer_surgery"}
+    response = client.post("/treatment_comparison", json=missing)
+    assert response.status_code == 400
+    assert b"surge_undergone_cancer_surgery is required" in response.data
+
+
+def test_report(client, payloads):
+    patient = payloads["base_model"][0]
+    response = client.post("/report", json={"patient": patient, "outcomes": [patient["outcome"]]})
+    assert response.status_code == 200
+    entries = response.json["scenarios"]
+    assert {entry["endpoint"] for entry in entries} == set(payloads)
+
+    base_model = [entry for entry in entries if entry["endpoint"] == "base_model"]
+    assert len(base_model) == 2
+    for entry in base_model:
+        assert entry["hazard_ratios"] is None and entry["restricted_mean"] is None
+        body = dict(patient, censoring_time=entry["censoring_time"])
+        assert entry["trajectory"] == client.post("/base_model", json=body).json
+
+    # The patient record has no gene signature, so the signature scenarios report what is missing
+    assert all("error" in entry for entry in entries if entry["endpoint"] != "base_model")
+
+    body = payloads["radiosensitivity"][0]
+    response = client.post("/report", json={"patient": patient, "scenarios": {"radiosensitivity": body},
+                                            "outcomes": [body["outcome"]],
+                                            "censoring_times": [int(body["censoring_time"])]})
+    [entry] = response.json["scenarios"]
+    assert entry["trajectory"] == client.post("/radiosensitivity", json=body).json
+    assert entry["hazard_ratios"]["hazard_ratio"] and entry["restricted_mean"]["rmst_diff"]
+
+    for selection in ({"outcomes": ["x"]}, {"outcomes": []}, {"scenarios": {"unknown": {}}}, {"scenarios": {}},
+                      {"censoring_times": [True]}, {"censoring_times": []}):
+        assert client.post("/report", json=dict(selection, patient=patient)).status_code == 400, selection
+
+
+def test_get_variant(client, payloads):
+    body = payloads["base_model"][0]
+    url = "/base_model?" + query_string("base_model", body)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.json == client.post("/base_model", json=body).json
+    assert response.headers["ETag"] and "max-age" in response.headers["Cache-Control"]
+
+    not_modified = client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+    assert not_modified.status_code == 304
+    assert not not_modified.data
+
+    # Query strings out of order are redirected to the canonical URL
+    reversed_query = "&".join(reversed(url.split("?")[1].split("&")))
+    redirect = client.get("/base_model?" + reversed_query)
+    assert redirect.status_code == 308
+    assert redirect.headers["Location"].endswith(url)
+
+    assert client.get("/base_model?" + query_string("base_model", body, outcome="x")).status_code == 400
+
+
+def test_compression(client, payloads):
+    client.application.config.update(COMPRESSION=True, COMPRESSION_MIN_SIZE=10)
+    body = payloads["base_model"][0]
+
+    response = client.post("/base_model", json=body, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert json.loads(gzip.decompress(response.data)) == client.post("/base_model", json=body).json
+
+    # Conditional GETs keep the same Vary as the 200 response
+    url = "/base_model?" + query_string("base_model", body)
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    not_modified = client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+    assert not_modified.status_code == 304
+    assert set(not_modified.headers["Vary"].split(", ")) == set(response.headers["Vary"].split(", "))
+
+    client.application.config.update(COMPRESSION_MIN_SIZE=10 ** 6)
+    response = client.post("/base_model", json=body, headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+def test_metrics(client, payloads):
+    client.application.config.update(SERVER_TIMING=True)
+    response = client.post("/base_model", json=payloads["base_model"][0])
+    assert "validation;dur=" in response.headers["Server-Timing"]
+    assert "total;dur=" in response.headers["Server-Timing"]
+
+    metrics = client.get("/metrics").get_data(as_text=True)
+    assert 'supertreat_request_duration_seconds_count{route="base_model",status="200"}' in metrics
+    assert 'supertreat_phase_duration_seconds_count{route="base_model",phase="validation"}' in metrics
+
+
+def expression_csv(rows):
+    genes = signatures["gs4"].genes
+    return "\n".join([",".join(["sample"] + genes)] + [",".join(row) for row in rows]) + "\n"
+
+
+def test_signature_scores(client):
+    n_genes = len(signatures["gs4"].genes)
+    data = expression_csv([["a"] + ["1.0"] * n_genes, ["b"] + ["NA"] * n_genes])
+
+    response = client.post("/signature_scores?signature=gs4", data=data, content_type="text/csv")
+    assert response.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [row["sample"] for row in rows] == ["a", "b"]
+    assert rows[0]["gs_score"] and not rows[0]["error"]
+    assert float(rows[1]["gs_score_value"]) == 0.0
+
+    assert client.post("/signature_scores?signature=gs4", data="sample,GAPDH\na,1\n",
+                       content_type="text/csv").status_code == 400
+
+
+def test_signature_scores_malformed_rows(client):
+    n_genes = len(signatures["gs4"].genes)
+    data = expression_csv([["a"] + ["1.0"] * n_genes, ["b", "1.0"], ["c", "x"] + ["1.0"] * (n_genes - 1),
+                           ["d"] + ["2.0"] * n_genes])
+
+    response = client.post("/signature_scores?signature=gs4", data=data, content_type="text/csv")
+    assert response.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [row["sample"] for row in rows] == ["a", "b", "c", "d"]
+    assert rows[1]["error"] == "line 3: expected " + str(n_genes + 1) + " columns, got 2"
+    assert rows[2]["error"] == "line 4: " + signatures["gs4"].genes[0] + " is not a number"
+    assert not rows[1]["gs_score"] and not rows[2]["gs_score"]
+    assert rows[3]["gs_score"] and not rows[3]["error"]
+
+    response = client.post("/signature_scores?signature=gs4", data=data, content_type="text/csv",
+                           headers={"Accept": "application/x-ndjson"})
+    records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert records[2] == {"sample": "c", "error": "line 4: " + signatures["gs4"].genes[0] + " is not a number"}
+    assert "gs_score" in records[3]
+
+
+def test_signature_scores_parquet_column_types(client):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    genes = signatures["gs4"].genes
+    for values, status in ((["1.0"], 400), ([1.0], 200)):
+        table = pa.table({"sample": ["a"], **{gene: values for gene in genes}})
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer)
+        response = client.post("/signature_scores?signature=gs4", data=buffer.getvalue(),
+                               content_type="application/vnd.apache.parquet")
+        assert response.status_code == status
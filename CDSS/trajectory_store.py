@@ -0,0 +1,121 @@
+from typing import Dict, Iterable, Mapping, Optional, Tuple
+
+import numpy as np
+
+# Fields of a trajectory document that are returned to the client,
+# in the order used by get_patient_trajectory.
+TRAJECTORY_FIELDS = ("survival_probability", "time", "ci_lower", "ci_upper")
+
+# MongoDB projection returning only the trajectory fields.
+TRAJECTORY_PROJECTION = dict({field: 1 for field in TRAJECTORY_FIELDS}, _id=0)
+
+
+def make_key(query: Mapping[str, object]) -> Tuple:
+    """
+    Builds the hashable covariate key of a trajectory query.
+
+    Args:
+        query (Mapping[str, object]): The MongoDB query built by an endpoint.
+            The 'model' entry is ignored since each model has its own index.
+
+    Returns:
+        Tuple: The sorted (field, value) pairs of the query.
+
+    Examples:
+        >>> make_key({"model": "clinical_base_os_24m", "clinical_sex": "male", "clinical_age_at_diagnosis": 60})
+        (('clinical_age_at_diagnosis', 60), ('clinical_sex', 'male'))
+    """
+    return tuple(sorted((field, value) for field, value in query.items() if field != "model"))
+
+
+class TrajectoryStore:
+    """
+    In-memory index of the precomputed survival trajectories.
+
+    Each model collection is loaded once into a dictionary keyed on the
+    covariate tuple of the patient. Every key maps to column-oriented
+    numpy arrays for time, survival_probability, ci_lower and ci_upper,
+    so a prediction is a single dictionary lookup instead of a MongoDB query.
+    """
+
+    def __init__(self):
+        self._models: Dict[str, Dict[Tuple, Dict[str, np.ndarray]]] = {}
+
+    def __contains__(self, model_name: str) -> bool:
+        return model_name in self._models
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def load_model(self, collection, model_name: str, covariates: Iterable[str]) -> int:
+        """
+        Loads all trajectories of a model collection into the store.
+
+        Args:
+            collection: The MongoDB collection holding the model trajectories.
+            model_name (str): The model name, as returned by select_model.
+            covariates (Iterable[str]): The fields the endpoints filter on.
+
+        Returns:
+            int: The number of trajectories (covariate combinations) loaded.
+        """
+        covariates = list(covariates)
+        projection = {field: 1 for field in covariates + list(TRAJECTORY_FIELDS)}
+        projection["_id"] = 0
+
+        columns: Dict[Tuple, Dict[str, list]] = {}
+        for timepoint in collection.find({"model": model_name}, projection):
+            key = tuple(sorted((field, timepoint.get(field)) for field in covariates))
+            trajectory = columns.setdefault(key, {field: [] for field in TRAJECTORY_FIELDS})
+            for field in TRAJECTORY_FIELDS:
+                trajectory[field].append(timepoint[field])
+
+        self._models[model_name] = {
+            key: {
+                field: np.asarray(values) if field == "time" else np.asarray(values, dtype=np.float64)
+                for field, values in trajectory.items()
+            }
+            for key, trajectory in columns.items()
+        }
+
+        return len(columns)
+
+    def add_model(self, model_name: str, trajectories: Mapping[Tuple, Dict[str, np.ndarray]]) -> int:
+        """
+        Stores trajectories already decoded into columns, e.g. by compact_storage.load_trajectories.
+
+        Returns:
+            int: The number of trajectories stored.
+        """
+        self._models[model_name] = dict(trajectories)
+
+        return len(trajectories)
+
+    def load_snapshot(self, snapshot) -> None:
+        """
+        Serves the trajectories of every model of a snapshot from its memory-mapped files.
+
+        Args:
+            snapshot (snapshot.Snapshot): The opened snapshot.
+        """
+        self._models.update(snapshot.models)
+
+    def get(self, model_name: str, query: Mapping[str, object]) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Looks up the trajectory matching an endpoint query.
+
+        Args:
+            model_name (str): The model name, as returned by select_model.
+            query (Mapping[str, object]): The MongoDB query built by the endpoint.
+
+        Returns:
+            Optional[Dict[str, np.ndarray]]: The trajectory columns, or None if
+                no trajectory exists for the given covariates.
+
+        Raises:
+            KeyError: If the model has not been loaded into the store.
+        """
+        return self._models[model_name].get(make_key(query))
+
+    def clear(self):
+        self._models.clear()
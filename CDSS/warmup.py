@@ -0,0 +1,191 @@
+"""
+Warm-up job materializing the full covariate grid of every model before serving.
+
+The grid of a model is every request its endpoint accepts, enumerated from the
+enums and ranges of models.yml and the gs_score level tables, and turned into
+trajectory queries by the endpoint query builders. Each model collection is then
+scanned once in a pool of worker processes, which pages the collections into the
+MongoDB cache and reports the coverage gaps: combinations of the grid with no
+trajectory in the database. The hazard ratios and RMST of every model are loaded
+into the serving caches of the calling process.
+"""
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Mapping, Optional
+
+from pymongo import MongoClient
+
+from compact_storage import compact_collection_name
+from model_data import ModelData, versioned_name
+from model_registry import ModelSpec, gs_score_levels, model_registry
+from request_validation import enum_values
+from trajectory_store import make_key
+
+
+def covariate_levels(model: ModelSpec, schemas: Mapping[str, Mapping[str, Mapping[str, object]]]) -> Dict[str, List[object]]:
+    """
+    Lists the accepted values of every field of the requests selecting a model.
+
+    Args:
+        model (ModelSpec): The model, see model_registry.
+        schemas (Mapping[str, Mapping[str, Mapping[str, object]]]): The field schemas of models.yml,
+            see request_validation.load_schemas.
+
+    Returns:
+        Dict[str, List[object]]: The values of each field, from the enums and ranges of models.yml
+            and the gs_score levels. hpv_status is [None] when fixed by the scenario, and is only
+            read for oropharynx tumors otherwise.
+    """
+    scenario = model.scenario
+    properties = schemas[scenario.endpoint]
+
+    levels = {"outcome": [model.outcome], "censoring_time": [model.censoring_time],
+              "gene_signature_type": [model.gene_signature_type]}
+    for field in scenario.covariates:
+        if field == "hpv_status":
+            continue
+        schema = properties[field]
+        if "enum" in schema:
+            levels[field] = enum_values(schema)
+        else:
+            levels[field] = list(range(schema["minimum"], schema["maximum"] + 1))
+
+    if model.gene_signature_type == "class":
+        levels["gs_class"] = enum_values(properties["gs_class"])
+    elif model.gene_signature_type == "score":
+        levels["gs_score"] = list(gs_score_levels[scenario.gene_signature][model.outcome])
+
+    levels["hpv_status"] = enum_values(properties["hpv_status"]) if scenario.hpv_status is None else [None]
+
+    return levels
+
+
+def model_payloads(model: ModelSpec, schemas: Mapping[str, Mapping[str, Mapping[str, object]]]) -> Iterator[Dict[str, object]]:
+    """
+    Enumerates every request body selecting a model.
+
+    Args:
+        model (ModelSpec): The model, see model_registry.
+        schemas (Mapping[str, Mapping[str, Mapping[str, object]]]): The field schemas of models.yml,
+            see request_validation.load_schemas.
+
+    Yields:
+        Dict[str, object]: The request bodies, one per combination of covariate levels.
+    """
+    levels = covariate_levels(model, schemas)
+    hpv_levels = levels.pop("hpv_status")
+
+    for values in itertools.product(*levels.values()):
+        payload = dict(zip(levels, values))
+        # The HPV status is only read for oropharynx tumors
+        for hpv_status in (hpv_levels if payload["tumor_region"] == "oropharynx" else [None]):
+            yield dict(payload, hpv_status=hpv_status)
+
+
+def check_model(model_name: str, mongo_uri: str, database_name: str, client_options: Mapping[str, object],
+                max_gaps: int = 20, compact: bool = False, collection_version: Optional[str] = None) -> Dict[str, object]:
+    """
+    Scans the collection of a model and compares its trajectories with the covariate grid.
+
+    Runs in a worker process, with its own MongoDB client.
+
+    Args:
+        model_name (str): The model name, see model_registry.
+        mongo_uri (str): The MongoDB connection string.
+        database_name (str): The database holding the model collections.
+        client_options (Mapping[str, object]): Options of the client, see mongo_client_options.
+        max_gaps (int): The number of missing combinations listed in the report.
+        compact (bool): Scans the compact collection of the model instead, see compact_storage.
+        collection_version (Optional[str]): The version of the collections, see model_data.
+
+    Returns:
+        Dict[str, object]: The numbers of combinations in the grid ('expected') and in the
+            database ('found'), of documents scanned, and the first missing combinations.
+    """
+    # The endpoint query builders, imported here as the workers are spawned
+    from supertreat_api import request_schemas, scenario_queries
+
+    model = model_registry.models[model_name]
+    build_query = scenario_queries[model.scenario.endpoint]
+    expected = {make_key(build_query(payload)[1]) for payload in model_payloads(model, request_schemas)}
+
+    client = MongoClient(mongo_uri, **client_options)
+    try:
+        projection = dict({field: 1 for field in model.covariates}, _id=0)
+        found = set()
+        n_documents = 0
+        collection_name = versioned_name(collection_version, compact_collection_name(model_name) if compact else model_name)
+        for document in client[database_name][collection_name].find({"model": model_name}, projection):
+            found.add(tuple(sorted((field, document.get(field)) for field in model.covariates)))
+            n_documents += 1
+    finally:
+        client.close()
+
+    gaps = expected - found
+
+    return {
+        "model": model_name,
+        "expected": len(expected),
+        "found": len(expected) - len(gaps),
+        "documents": n_documents,
+        "n_gaps": len(gaps),
+        "gaps": [dict(key) for key in sorted(gaps, key=repr)[:max_gaps]]
+    }
+
+
+def warm_up(config: Mapping[str, object], model_names: Optional[List[str]] = None, workers: Optional[int] = None,
+            max_gaps: int = 20, data: Optional[ModelData] = None) -> Dict[str, object]:
+    """
+    Warms MongoDB and the serving caches up, and reports the coverage of the model data.
+
+    Args:
+        config (Mapping[str, object]): The app configuration holding the MONGO_* settings.
+        model_names (Optional[List[str]]): The models to check, every model of the registry by default.
+        workers (Optional[int]): The number of worker processes, the number of CPUs by default.
+            0 checks the models in the calling process.
+        max_gaps (int): The number of missing combinations listed per model.
+        data (Optional[ModelData]): The model data to warm up, e.g. a version about to be swapped in,
+            the one being served by default.
+
+    Returns:
+        Dict[str, object]: The report of each model, the models without hazard ratios or RMST,
+            and the overall coverage of the grid.
+    """
+    import supertreat_api
+
+    data = data or supertreat_api.current_model_data()
+    model_names = list(model_names or model_registry.models)
+    arguments = (config['MONGO_URI'], config['MONGO_DATABASE'], supertreat_api.mongo_client_options(config), max_gaps,
+                 config.get('COMPACT_STORAGE', False), data.collection_version)
+
+    if workers == 0:
+        models = [check_model(model_name, *arguments) for model_name in model_names]
+    else:
+        # Spawned rather than forked, as the parent may already hold MongoDB connections and threads
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [pool.submit(check_model, model_name, *arguments) for model_name in model_names]
+            models = [future.result() for future in futures]
+
+    # Hazard ratios and RMST are small, they are loaded into the caches of this process
+    missing_hazard_ratios, missing_restricted_means = [], []
+    for model_name in model_names:
+        if model_registry.models[model_name].scenario.gene_signature is None:
+            continue
+        if not supertreat_api.get_hazard_ratios(model_name, data)["hazard_ratio"]:
+            missing_hazard_ratios.append(model_name)
+        if not supertreat_api.get_restricted_mean(model_name, data)["rmst_diff"]:
+            missing_restricted_means.append(model_name)
+
+    expected = sum(model["expected"] for model in models)
+    found = sum(model["found"] for model in models)
+
+    return {
+        "models": models,
+        "missing_hazard_ratios": missing_hazard_ratios,
+        "missing_restricted_means": missing_restricted_means,
+        "expected": expected,
+        "found": found,
+        "coverage": found / expected if expected else 1.0
+    }
@@ -0,0 +1,8 @@
+"""
+WSGI entry point of the SuPerTreat API, for production servers such as gunicorn:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from supertreat_api import configure_app
+
+app = configure_app()